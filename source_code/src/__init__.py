@@ -1,3 +1,4 @@
 from . import data
 from . import plot_helpers
 from . import visualization
+from . import benchmarks
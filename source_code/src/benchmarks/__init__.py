@@ -0,0 +1 @@
+from . import synthetic_data
@@ -0,0 +1,283 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import matplotlib
+# Agg must be set before pyplot is imported
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+from src.benchmarks import synthetic_data  # noqa: E402
+from src.data import causer_pays_chunkpression  # noqa: E402
+from src.data import merge_mappings  # noqa: E402
+from src.visualization import generic_plots  # noqa: E402
+
+sizes = {
+    'small': {'n_files': 5, 'timestamps_per_file': 15, 'n_elements': 50,
+              'n_intervals': 12, 'n_duids': 100},
+    'medium': {'n_files': 20, 'timestamps_per_file': 75, 'n_elements': 200,
+               'n_intervals': 288, 'n_duids': 400},
+    'large': {'n_files': 60, 'timestamps_per_file': 75, 'n_elements': 373,
+              'n_intervals': 2016, 'n_duids': 600}
+}
+
+
+def arg_parser():
+    description = ("Time ingest, merge and plot hot paths on synthetic data"
+                   + " and append results to a history file")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-size', type=str, default='small',
+                        choices=sorted(sizes.keys()),
+                        help='synthetic data size preset')
+    parser.add_argument('-repeat', type=int, default=3,
+                        help='times to run each benchmark')
+    parser.add_argument('-history', type=str,
+                        default='benchmark_history.jsonl',
+                        help='JSON lines file results are appended to')
+    parser.add_argument('-tolerance', type=float, default=0.25,
+                        help='fractional slowdown reported as a regression')
+    parser.add_argument('-fail_on_regression', action='store_true',
+                        help='exit with status 1 if a regression is found')
+    args = parser.parse_args()
+    return args
+
+
+def time_call(func, repeat, setup=None):
+    '''
+    Runs func repeat times and returns wall times in seconds.
+    setup is run before each call and is not timed
+    '''
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def load_mappings():
+    raw, proc = synthetic_data.raw_dir, synthetic_data.proc_dir
+    ext = os.path.join(os.path.dirname(raw), 'external')
+    return {
+        'elements': pd.read_csv(os.path.join(raw,
+                                             'elements_causpays_mapping.csv')),
+        'variables': pd.read_csv(os.path.join(
+            raw, 'variables_causpays_mapping.csv')),
+        'ems_duid': pd.read_csv(os.path.join(ext, 'emsname_duid.csv')),
+        'gen_loads': pd.read_csv(os.path.join(proc, 'cleaned_gen_loads.csv')),
+        'fcas': pd.read_csv(os.path.join(proc, 'unique_fcas_providers.csv'))
+    }
+
+
+def _remove_chunks(path):
+    for chunk in causer_pays_chunkpression.chunk_paths(path):
+        os.remove(chunk)
+
+
+def ingest_benchmarks(params, repeat, workdir):
+    files = synthetic_data.write_causer_pays_files(
+        workdir, params['n_files'], params['timestamps_per_file'],
+        params['n_elements'])
+    results = {}
+    results['read_dataframes'] = time_call(
+        lambda: causer_pays_chunkpression.read_dataframes('csv', files[0]),
+        repeat)
+    # memory limit small enough to exercise several chunk writes
+    total_mb = sum(os.path.getsize(f) for f in files) / 1e6
+    results['pathfiles_to_chunks'] = time_call(
+        lambda: causer_pays_chunkpression.pathfiles_to_chunks(
+            workdir, 'csv', max(total_mb / 3, 1e-3)),
+        repeat, setup=lambda: _remove_chunks(workdir))
+    results['read_arrow'] = time_call(
+        lambda: causer_pays_chunkpression.read_arrow('csv', files[0]),
+        repeat)
+    results['pathfiles_to_chunks_arrow'] = time_call(
+        lambda: causer_pays_chunkpression.pathfiles_to_chunks(
+            workdir, 'csv', max(total_mb / 3, 1e-3), engine='arrow'),
+        repeat, setup=lambda: _remove_chunks(workdir))
+    cp_df = pd.concat([causer_pays_chunkpression.read_dataframes('csv', f)
+                       for f in files])
+    return results, cp_df.reset_index()
+
+
+def merge_benchmarks(cp_df, dispatch_df, maps, repeat):
+    results = {}
+    results['merge_causpays_mappings'] = time_call(
+        lambda: merge_mappings.merge_causpays_mappings(
+            cp_df, maps['elements'], maps['variables'],
+            ems_duid=maps['ems_duid'], gen_loads=maps['gen_loads']),
+        repeat)
+    results['merge_duid_mappings'] = time_call(
+        lambda: merge_mappings.merge_duid_mappings(
+            dispatch_df, maps['gen_loads'], maps['fcas']),
+        repeat)
+    return results
+
+
+def plot_benchmarks(cp_merged, dispatch_merged, repeat):
+    results = {}
+    elements_df = cp_merged[cp_merged['variablenumber'] == 2]
+
+    def value_by_element():
+        fig, ax = plt.subplots()
+        generic_plots.plot_value_by_element(elements_df, 'datetime',
+                                            'EMSNAME', 'fcas_value', ax,
+                                            plt.cm.viridis)
+        fig.canvas.draw()
+        plt.close(fig)
+
+    def nonzero_by_category():
+        fig, ax = plt.subplots()
+        generic_plots.plot_nonzero_elements_by_category(
+            ax, dispatch_merged, 'SETTLEMENTDATE', 'TOTALCLEARED', 'DUID',
+            'NSW1', 'Region', cmap=plt.cm.viridis)
+        fig.canvas.draw()
+        plt.close(fig)
+
+    def nofb_plot():
+        fig, ax = plt.subplots()
+        generic_plots.nofb_plot(generic_plots.nofb(elements_df, 'datetime'),
+                                ax)
+        fig.canvas.draw()
+        plt.close(fig)
+
+    services = ['RAISEREG', 'LOWERREG']
+    stacked = dispatch_merged.groupby(['SETTLEMENTDATE', 'Region'])[services]
+    stacked = stacked.sum().reset_index()
+    stacked = stacked.melt(id_vars=['SETTLEMENTDATE', 'Region'],
+                           var_name='service')
+    regions = sorted(stacked['Region'].unique())
+
+    def stacked_bar():
+        fig, ax = generic_plots.stacked_bar_subplots(
+            stacked, (7, 7), 'viridis', 'SETTLEMENTDATE', 'value',
+            regions, 'Region', services, 'service', 'MW', 'enablement')
+        fig.canvas.draw()
+        plt.close(fig)
+
+    results['plot_value_by_element'] = time_call(value_by_element, repeat)
+    results['plot_nonzero_elements_by_category'] = time_call(
+        nonzero_by_category, repeat)
+    results['nofb_plot'] = time_call(nofb_plot, repeat)
+    results['stacked_bar_subplots'] = time_call(stacked_bar, repeat)
+    return results
+
+
+def run_benchmarks(size='small', repeat=3):
+    '''
+    Generates synthetic data for the size preset and times the ingest,
+    merge and plot hot paths. Everything runs offline in a temp directory
+
+    Args:
+        size (str): key of sizes
+        repeat (int): times to run each benchmark
+
+    Returns:
+        dict of benchmark name to list of wall times (s)
+    '''
+    params = sizes[size]
+    maps = load_mappings()
+    with tempfile.TemporaryDirectory() as workdir:
+        results, cp_df = ingest_benchmarks(params, repeat, workdir)
+
+    duids = maps['gen_loads']['DUID'].dropna().unique()[:params['n_duids']]
+    dispatch_df = synthetic_data.dispatchload_frame(
+        '2020/03/01 00:05:00', params['n_intervals'], duids)
+    results.update(merge_benchmarks(cp_df, dispatch_df, maps, repeat))
+
+    cp_merged = merge_mappings.merge_causpays_mappings(
+        cp_df, maps['elements'], maps['variables'])
+    dispatch_merged = merge_mappings.merge_duid_mappings(
+        dispatch_df, maps['gen_loads'], maps['fcas'])
+    dispatch_merged['SETTLEMENTDATE'] = pd.to_datetime(
+        dispatch_merged['SETTLEMENTDATE'])
+    results.update(plot_benchmarks(cp_merged, dispatch_merged, repeat))
+    return results
+
+
+def _git_revision():
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=os.path.dirname(__file__))
+        return rev.stdout.decode().strip() or None
+    except OSError:
+        return None
+
+
+def read_history(history):
+    if not os.path.exists(history):
+        return []
+    with open(history) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(record, history, tolerance, window=5):
+    '''
+    Compares the best time of each benchmark in record with the median best
+    time of the last window runs of the same size in history
+
+    Returns:
+        dict of benchmark name to (best time, baseline)
+    '''
+    previous = [r for r in history if r['size'] == record['size']][-window:]
+    regressions = {}
+    for name, result in record['results'].items():
+        baseline = [r['results'][name]['min'] for r in previous
+                    if name in r['results']]
+        if not baseline:
+            continue
+        baseline = statistics.median(baseline)
+        if result['min'] > baseline * (1 + tolerance):
+            regressions[name] = (result['min'], baseline)
+    return regressions
+
+
+def main():
+    logging.basicConfig(format='\n%(levelname)s:%(message)s',
+                        level=logging.WARNING)
+    args = arg_parser()
+    results = run_benchmarks(args.size, args.repeat)
+    record = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_revision': _git_revision(),
+        'size': args.size,
+        'params': sizes[args.size],
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'matplotlib': matplotlib.__version__,
+        'results': {name: {'min': min(times),
+                           'median': statistics.median(times),
+                           'repeat': len(times)}
+                    for name, times in results.items()}
+    }
+    regressions = find_regressions(record, read_history(args.history),
+                                   args.tolerance)
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    for name, result in record['results'].items():
+        flag = ' REGRESSION' if name in regressions else ''
+        print(f"{name:<36}{result['min']:>10.4f}s{flag}")
+    for name, (best, baseline) in regressions.items():
+        print(f'{name} slowed from {baseline:.4f}s to {best:.4f}s')
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import os as _os
+
+import numpy as _np
+import pandas as _pd
+
+_project_dir = _os.path.abspath(_os.path.join(_os.path.dirname(__file__),
+                                              _os.pardir, _os.pardir,
+                                              _os.pardir))
+raw_dir = _os.path.join(_project_dir, 'data', 'raw')
+proc_dir = _os.path.join(_project_dir, 'data', 'processed')
+
+_dt_fmt = '%Y/%m/%d %H:%M:%S'
+_fcas_cols = ['RAISE6SEC', 'RAISE60SEC', 'RAISE5MIN', 'RAISEREG',
+              'LOWER6SEC', 'LOWER60SEC', 'LOWER5MIN', 'LOWERREG']
+
+
+def causer_pays_numbers(raw_loc=raw_dir):
+    '''
+    Reads element and variable numbers from the Causer Pays mappings so
+    synthetic data can be merged with the real mapping tables
+
+    Args:
+        raw_loc (str or path, optional): directory with *_causpays_mapping.csv
+
+    Returns:
+        Tuple of (element numbers, variable numbers) as numpy arrays
+    '''
+    elements = _pd.read_csv(_os.path.join(raw_loc,
+                                          'elements_causpays_mapping.csv'))
+    variables = _pd.read_csv(_os.path.join(raw_loc,
+                                           'variables_causpays_mapping.csv'))
+    return (elements['ELEMENTNUMBER'].values,
+            variables['VARIABLENUMBER'].values)
+
+
+def sample_elements(n_elements, seed=0, raw_loc=raw_dir):
+    '''
+    Draws n_elements element numbers from the Causer Pays elements mapping
+    '''
+    rng = _np.random.RandomState(seed)
+    all_elements, _ = causer_pays_numbers(raw_loc)
+    return _np.sort(rng.choice(all_elements,
+                               min(n_elements, len(all_elements)),
+                               replace=False))
+
+
+def causer_pays_frame(start, n_timestamps, n_elements, n_variables=5,
+                      seed=0, raw_loc=raw_dir, elements=None):
+    '''
+    Generates 4s Causer Pays data in the raw AEMO format. Each element
+    reports the same n_variables every 4s. Values are random walks and
+    roughly 1% of readings have a bad VALUEQUALITY
+
+    Args:
+        start (str or Timestamp): first timestamp
+        n_timestamps (int): number of 4s timestamps
+        n_elements (int): number of elements drawn from the mapping
+        n_variables (int, optional): number of variables drawn from mapping
+        seed (int, optional): random seed
+        raw_loc (str or path, optional): directory with *_causpays_mapping.csv
+        elements (array-like, optional): element numbers to use instead of
+                                         drawing n_elements
+
+    Returns:
+        DataFrame with TIMESTAMP, ELEMENTNUMBER, VARIABLENUMBER, VALUE and
+        VALUEQUALITY columns
+    '''
+    rng = _np.random.RandomState(seed)
+    _, all_variables = causer_pays_numbers(raw_loc)
+    if elements is None:
+        elements = sample_elements(n_elements, seed=seed, raw_loc=raw_loc)
+    variables = all_variables[:n_variables]
+    times = _pd.date_range(start, periods=n_timestamps, freq='4S')
+
+    n_series = len(elements) * len(variables)
+    walk = rng.normal(0, 1, (n_timestamps, n_series)).cumsum(axis=0)
+    walk += rng.uniform(0, 300, n_series)
+    quality = (rng.uniform(size=(n_timestamps, n_series)) < 0.01)
+    df = _pd.DataFrame({
+        'TIMESTAMP': _np.repeat(times.strftime(_dt_fmt), n_series),
+        'ELEMENTNUMBER': _np.tile(_np.repeat(elements, len(variables)),
+                                  n_timestamps),
+        'VARIABLENUMBER': _np.tile(variables, len(elements) * n_timestamps),
+        'VALUE': walk.ravel().round(3),
+        'VALUEQUALITY': quality.ravel().astype(_np.int64)
+    })
+    return df
+
+
+def write_causer_pays_files(path, n_files, timestamps_per_file, n_elements,
+                            fformat='csv', start='2020/03/01 00:00:00',
+                            seed=0, raw_loc=raw_dir):
+    '''
+    Writes n_files of consecutive synthetic 4s Causer Pays data to path
+
+    Args:
+        path (str or path): directory to write files to
+        n_files (int): number of files
+        timestamps_per_file (int): 4s timestamps in each file
+        n_elements (int): elements reporting in each file
+        fformat (str, optional): csv or parquet
+        start (str, optional): first timestamp
+        seed (int, optional): random seed
+        raw_loc (str or path, optional): directory with *_causpays_mapping.csv
+
+    Returns:
+        List of written file paths
+    '''
+    files = []
+    file_start = _pd.Timestamp(start)
+    elements = sample_elements(n_elements, seed=seed, raw_loc=raw_loc)
+    for i in range(n_files):
+        df = causer_pays_frame(file_start, timestamps_per_file, n_elements,
+                               seed=seed + i, raw_loc=raw_loc,
+                               elements=elements)
+        fname = _os.path.join(path,
+                              f"FCAS_{file_start.strftime('%Y%m%d%H%M%S')}"
+                              + f'.{fformat}')
+        if fformat == 'csv':
+            df.to_csv(fname, index=False)
+        elif fformat == 'parquet':
+            df.to_parquet(fname, index=False)
+        else:
+            raise ValueError("fformat should be csv or parquet")
+        files.append(fname)
+        file_start += _pd.Timedelta(seconds=4 * timestamps_per_file)
+    return files
+
+
+def dispatchload_frame(start, n_intervals, duids, seed=0):
+    '''
+    Generates a DISPATCHLOAD-like table as compiled by NEMOSIS, with
+    SETTLEMENTDATE as a string and a row per DUID per dispatch interval
+
+    Args:
+        start (str or Timestamp): first dispatch interval
+        n_intervals (int): number of 5 minute dispatch intervals
+        duids (list): DUIDs to include, e.g. from cleaned_gen_loads.csv
+        seed (int, optional): random seed
+
+    Returns:
+        DataFrame with SETTLEMENTDATE, DUID, INITIALMW, TOTALCLEARED and
+        FCAS enablement columns
+    '''
+    rng = _np.random.RandomState(seed)
+    duids = _np.asarray(duids)
+    intervals = _pd.date_range(start, periods=n_intervals, freq='5T')
+    n = n_intervals * len(duids)
+    capacity = _np.tile(rng.uniform(5, 700, len(duids)), n_intervals)
+    initial = capacity * rng.uniform(0, 1, n)
+    df = _pd.DataFrame({
+        'SETTLEMENTDATE': _np.repeat(intervals.strftime(_dt_fmt),
+                                     len(duids)),
+        'DUID': _np.tile(duids, n_intervals),
+        'INITIALMW': initial.round(3),
+        'TOTALCLEARED': (initial + rng.normal(0, 5, n)).clip(0).round(3)
+    })
+    for col in _fcas_cols:
+        enabled = rng.uniform(size=n) < 0.2
+        df[col] = _np.where(enabled, rng.uniform(0, 50, n), 0).round(3)
+    return df
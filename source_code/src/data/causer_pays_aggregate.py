@@ -0,0 +1,301 @@
+import argparse
+import logging
+import os
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from src.data.causer_pays_chunkpression import chunk_paths
+
+_read_cols = ['datetime', 'elementnumber', 'variablenumber', 'fcas_value']
+_valid_stats = ('sum', 'mean', 'min', 'max', 'count')
+
+
+def arg_parser():
+    description = ("Stream Causer Pays parquet chunks into aggregates.\n"
+                   + "Reduces row groups in parallel without a shuffle")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-path', type=str, required=True,
+                        help='directory containing chunk*.parquet files')
+    parser.add_argument('-out', type=str, required=True,
+                        help='parquet file to write aggregates to')
+    parser.add_argument('-bucket', type=str, default='5T',
+                        help='time bucket as a pandas offset, e.g. 4S, 5T')
+    parser.add_argument('-stats', type=str, nargs='+',
+                        default=['sum', 'mean', 'min', 'max', 'count'],
+                        help='statistics to compute')
+    parser.add_argument('-variables', type=int, nargs='+', default=None,
+                        help='only aggregate these variable numbers')
+    parser.add_argument('-area_mapping', type=str, default=None,
+                        help=('emsname_duid_region.csv. If provided,'
+                              + ' aggregate by Area instead of element'))
+    parser.add_argument('-workers', type=int, default=None,
+                        help='worker processes. Defaults to CPU count')
+    args = parser.parse_args()
+    return args
+
+
+def _bucket_codes(times, bucket_ns, label):
+    '''
+    Floors (label='left') or ceils (label='right') int64 ns times to buckets
+    '''
+    if label == 'right':
+        return (times - 1) // bucket_ns + 1
+    return times // bucket_ns
+
+
+def _reduce_sorted(bucket, variable, group, partials):
+    '''
+    Sorts keys and reduces each run of equal (bucket, variable, group) keys.
+    Sorting is stable, so partials are combined in the order they are given
+
+    Args:
+        bucket, variable, group (np.ndarray): int64 key arrays
+        partials (dict): 'sum', 'count', 'min', 'max' arrays aligned to keys
+
+    Returns:
+        dict of reduced key and partial arrays
+    '''
+    order = np.lexsort((group, variable, bucket))
+    bucket, variable, group = bucket[order], variable[order], group[order]
+    n = len(bucket)
+    if n == 0:
+        starts = np.zeros(0, dtype=np.int64)
+    else:
+        change = ((bucket[1:] != bucket[:-1])
+                  | (variable[1:] != variable[:-1])
+                  | (group[1:] != group[:-1]))
+        starts = np.flatnonzero(np.r_[True, change])
+    reduced = {'bucket': bucket[starts], 'variable': variable[starts],
+               'group': group[starts]}
+    if n == 0:
+        for stat, values in partials.items():
+            reduced[stat] = values[:0]
+        return reduced
+    reduced['sum'] = np.add.reduceat(partials['sum'][order], starts)
+    reduced['count'] = np.add.reduceat(partials['count'][order], starts)
+    reduced['min'] = np.minimum.reduceat(partials['min'][order], starts)
+    reduced['max'] = np.maximum.reduceat(partials['max'][order], starts)
+    return reduced
+
+
+def _reduce_row_group(task):
+    '''
+    Worker kernel. Reads one row group and returns its partial aggregates
+
+    Args:
+        task (tuple): (path, row group, bucket ns, label, variables,
+                       element numbers, group codes)
+
+    Returns:
+        dict of partial aggregate arrays
+    '''
+    path, row_group, bucket_ns, label, variables, elements, codes = task
+    if elements is not None and not len(elements):
+        # an empty element mapping maps no rows
+        return _empty_partials()
+    table = pq.ParquetFile(path).read_row_group(row_group, columns=_read_cols)
+    times = table.column('datetime').to_numpy()
+    times = times.astype('datetime64[ns]').view(np.int64)
+    element = table.column('elementnumber').to_numpy().astype(np.int64)
+    variable = table.column('variablenumber').to_numpy().astype(np.int64)
+    values = table.column('fcas_value').to_numpy().astype(np.float64)
+
+    keep = ~np.isnan(values)
+    if variables is not None:
+        keep &= np.isin(variable, variables)
+    if elements is not None:
+        # map element numbers to group codes, dropping unmapped elements
+        pos = np.searchsorted(elements, element)
+        pos[pos == len(elements)] = 0
+        mapped = elements[pos] == element
+        keep &= mapped
+        group = np.where(mapped, codes[pos], -1)
+    else:
+        group = element
+
+    values = values[keep]
+    partials = {'sum': values,
+                'count': np.ones(len(values), dtype=np.int64),
+                'min': values, 'max': values}
+    return _reduce_sorted(_bucket_codes(times[keep], bucket_ns, label),
+                          variable[keep], group[keep], partials)
+
+
+def _merge_partials(partials):
+    '''
+    Reduces a list of partials with a single sort. Earlier partials come
+    first, so summation order only depends on task order
+    '''
+    if len(partials) == 1:
+        return partials[0]
+    keys = ('bucket', 'variable', 'group')
+    stats = ('sum', 'count', 'min', 'max')
+    joined = {k: np.concatenate([p[k] for p in partials])
+              for k in keys + stats}
+    return _reduce_sorted(joined['bucket'], joined['variable'],
+                          joined['group'], {s: joined[s] for s in stats})
+
+
+class _PartialFold:
+    '''
+    Folds partials in order, buffering them until they hold as many rows
+    as the accumulator (or min_rows) before merging. Each row is then
+    re-sorted O(log n) times rather than once per row group
+    '''
+
+    def __init__(self, min_rows=1 << 20):
+        self.min_rows = min_rows
+        self._acc = None
+        self._buffer = []
+        self._buffered = 0
+
+    def add(self, partial):
+        self._buffer.append(partial)
+        self._buffered += len(partial['bucket'])
+        acc_rows = 0 if self._acc is None else len(self._acc['bucket'])
+        if self._buffered >= max(acc_rows, self.min_rows):
+            self._merge()
+
+    def _merge(self):
+        if not self._buffer:
+            return
+        head = [] if self._acc is None else [self._acc]
+        self._acc = _merge_partials(head + self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+    def result(self):
+        self._merge()
+        return self._acc
+
+
+def _row_group_tasks(paths):
+    tasks = []
+    for path in paths:
+        n_groups = pq.ParquetFile(path).num_row_groups
+        tasks.extend((path, rg) for rg in range(n_groups))
+    return tasks
+
+
+def _empty_partials():
+    empty_int = np.zeros(0, dtype=np.int64)
+    empty_float = np.zeros(0, dtype=np.float64)
+    return {'bucket': empty_int, 'variable': empty_int, 'group': empty_int,
+            'sum': empty_float, 'count': empty_int,
+            'min': empty_float, 'max': empty_float}
+
+
+def aggregate_chunks(path, bucket='5T', stats=_valid_stats,
+                     variables=None, element_groups=None, group_name='Area',
+                     label='left', workers=None):
+    '''
+    Streams the chunk*.parquet files in path row group by row group and
+    computes aggregates of fcas_value keyed by (time bucket, variable,
+    element) or (time bucket, variable, group) if element_groups is given.
+    Row groups are reduced to partial aggregates in a process pool and the
+    partials are merged in file/row group order, so results are
+    deterministic and peak memory scales with the output, not the input.
+
+    Args:
+        path (str or path): directory containing chunk*.parquet files
+        bucket (str): pandas offset for the time bucket, e.g. '4S', '5T'
+        stats (iterable): any of 'sum', 'mean', 'min', 'max', 'count'
+        variables (list, optional): only aggregate these variable numbers
+        element_groups (pandas Series, optional): maps element number to a
+                                                  group label, e.g. output
+                                                  of map_elements_to_areas.
+                                                  Unmapped elements dropped
+        group_name (str, optional): name of the group column
+        label (str): 'left' labels buckets by their start, 'right' by their
+                     end, i.e. (start, end] as for dispatch intervals
+        workers (int, optional): processes to use. Defaults to CPU count.
+                                 1 reduces in this process
+
+    Returns:
+        DataFrame with a datetime column, variablenumber, elementnumber
+        (or group_name) and a column per requested stat
+    '''
+    bad_stats = set(stats) - set(_valid_stats)
+    if bad_stats:
+        raise ValueError(f"Unsupported stats: {sorted(bad_stats)}")
+    if label not in ('left', 'right'):
+        raise ValueError("label should be 'left' or 'right'")
+    bucket_ns = pd.Timedelta(bucket).value
+    if variables is not None:
+        variables = np.asarray(sorted(variables), dtype=np.int64)
+
+    if element_groups is not None:
+        element_groups = element_groups.sort_index()
+        elements = element_groups.index.values.astype(np.int64)
+        codes, labels = pd.factorize(element_groups.values, sort=True)
+        codes = codes.astype(np.int64)
+    else:
+        elements = codes = labels = None
+
+    tasks = [(p, rg, bucket_ns, label, variables, elements, codes)
+             for p, rg in _row_group_tasks(chunk_paths(path))]
+    logging.info(f'Aggregating {len(tasks)} row groups')
+
+    fold = _PartialFold()
+    if workers == 1:
+        for task in tasks:
+            fold.add(_reduce_row_group(task))
+    else:
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # bounded, ordered submission keeps few partials in memory
+            pending = deque()
+            for task in tasks:
+                pending.append(executor.submit(_reduce_row_group, task))
+                if len(pending) >= 2 * workers:
+                    fold.add(pending.popleft().result())
+            while pending:
+                fold.add(pending.popleft().result())
+
+    acc = fold.result()
+    if acc is None:
+        acc = _empty_partials()
+    return _partials_to_frame(acc, bucket_ns, stats, labels, group_name)
+
+
+def _partials_to_frame(acc, bucket_ns, stats, labels, group_name):
+    df = pd.DataFrame({
+        'datetime': pd.to_datetime(acc['bucket'] * bucket_ns),
+        'variablenumber': acc['variable']
+    })
+    if labels is not None:
+        df[group_name] = np.asarray(labels)[acc['group']]
+    else:
+        df['elementnumber'] = acc['group']
+    for stat in stats:
+        if stat == 'mean':
+            df['mean'] = acc['sum'] / acc['count']
+        else:
+            df[stat] = acc[stat]
+    return df
+
+
+def main():
+    logging.basicConfig(format='\n%(levelname)s:%(message)s',
+                        level=logging.INFO)
+    args = arg_parser()
+    element_groups = None
+    if args.area_mapping:
+        from src.data.merge_mappings import map_elements_to_areas
+        element_groups = map_elements_to_areas(
+            pd.read_csv(args.area_mapping))
+    df = aggregate_chunks(args.path, bucket=args.bucket, stats=args.stats,
+                          variables=args.variables,
+                          element_groups=element_groups,
+                          workers=args.workers)
+    df.to_parquet(args.out, index=False)
+    logging.info(f'Aggregates in {args.out}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,37 @@
 import argparse
 import logging
 import os
+import re
+import tempfile
 import tqdm
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 
 from sys import getsizeof
 
+from src.data import causer_pays_gaps
+from src.data import causer_pays_preview
+from src.data import causer_pays_sketches
+from src.data import instrumentation
+from src.data import parquet_profiles
+
+original_cols = ['TIMESTAMP', 'ELEMENTNUMBER', 'VARIABLENUMBER',
+                 'VALUE', 'VALUEQUALITY']
+cols = ['datetime', 'elementnumber', 'variablenumber',
+        'fcas_value', 'valuequality']
+_timestamp_fmt = '%Y/%m/%d %H:%M:%S'
+_row_group_size = 1024 * 1024
+_chunk_name = re.compile(r'chunk(\d+)\.parquet')
+sidecar_names = {causer_pays_gaps.gap_index_name,
+                 causer_pays_sketches.sketches_name,
+                 causer_pays_sketches.summary_name,
+                 parquet_profiles.profile_name}
+
 
 def arg_parser():
     description = ("Merge FCAS data in directories to parquet chunks.\n"
@@ -20,50 +44,284 @@ def arg_parser():
     parser.add_argument('-memory_limit', type=int, required=True,
                         help=('memory (MB) before file write.'
                               + ' Recommended RAM/2'))
+    parser.add_argument('-report', type=str, default=None,
+                        help=('write a JSON report of per-stage timings and'
+                              + ' memory to this path'))
+    parser.add_argument('-trace_memory', action='store_true',
+                        help='with -report, also trace Python heap peaks')
+    parser.add_argument('-gap_index', action='store_true',
+                        help=('build a per-element gap and bad quality'
+                              + ' index sidecar in path'))
+    parser.add_argument('-sketches', action='store_true',
+                        help=('build per element, variable and day quantile'
+                              + ' sketches and summary statistics as'
+                              + ' sidecars in path'))
+    parser.add_argument('-preview', type=str, default=None,
+                        help=('also write a weighted sample of whole'
+                              + ' dispatch intervals to this directory,'
+                              + ' outside path, e.g. for Binder'))
+    parser.add_argument('-preview_mb', type=float, default=200,
+                        help='MB of data kept in the -preview sample')
+    parser.add_argument('-engine', type=str, default='pandas',
+                        choices=['pandas', 'arrow'],
+                        help=('arrow keeps files as Arrow tables and streams'
+                              + ' sorted row groups to parquet, using less'
+                              + ' memory per chunk'))
+    parser.add_argument('-tune_profile', type=int, default=0,
+                        help=('sample this many files to pick a storage'
+                              + ' profile (compression/encodings) before'
+                              + ' ingestion. A profile recorded in path'
+                              + ' is otherwise reused'))
+    parser.add_argument('-watch', action='store_true',
+                        help=('keep watching path, ingesting files as they'
+                              + ' land and flushing rolling Area/region'
+                              + ' aggregates. Needs -area_mapping'))
+    parser.add_argument('-area_mapping', type=str, default=None,
+                        help='emsname_duid_region.csv, for -watch')
+    parser.add_argument('-flush_interval', type=float, default=5,
+                        help='seconds between -watch flushes')
     args = parser.parse_args()
     return args
 
 
-def write_parquet(df_list, path, i):
-    concat_df = pd.concat(df_list)
-    concat_df = concat_df.sort_index()
+def write_parquet(df_list, path, i, profile=None):
+    with instrumentation.stage('concatenation') as s:
+        concat_df = pd.concat(df_list)
+        s.add(rows=len(concat_df))
+    with instrumentation.stage('sorting', rows=len(concat_df)):
+        concat_df = concat_df.sort_index()
     chunk_name = path + os.sep + f'chunk{i}.parquet'
-    concat_df.to_parquet(chunk_name)
+    with instrumentation.stage('parquet_write', rows=len(concat_df)) as s:
+        if profile:
+            # storage profiles are pyarrow write options
+            concat_df.to_parquet(chunk_name, engine='pyarrow', **profile)
+        else:
+            concat_df.to_parquet(chunk_name)
+        if instrumentation.is_enabled():
+            s.add(bytes_written=os.path.getsize(chunk_name))
     return chunk_name
 
 
-def pathfiles_to_chunks(path, fformat, mem_limit):
-    read_files = walk_dirs_for_files(path, fformat)
+def _pandas_schema(table):
+    '''
+    Schema of table with datetime moved last and pandas metadata attached,
+    so Arrow-written chunks read back indexed on datetime like write_parquet
+    '''
+    empty = table.schema.empty_table().to_pandas().set_index('datetime')
+    fields = [f for f in table.schema if f.name != 'datetime']
+    fields.append(table.schema.field('datetime'))
+    return pa.schema(fields,
+                     metadata=pa.Schema.from_pandas(empty).metadata)
+
+
+def write_arrow_chunk(table_list, path, i, profile=None):
+    '''
+    Arrow equivalent of write_parquet. Tables are concatenated by reference,
+    sorted with sort_indices and streamed to parquet one row group at a
+    time, so the only copy made is of the row group being written
+
+    Args:
+        table_list (list): Arrow tables from read_arrow
+        path (str or path): directory to write chunk to
+        i (int): chunk number
+        profile (dict, optional): storage profile (pyarrow write options)
+
+    Returns:
+        Chunk file path
+    '''
+    with instrumentation.stage('concatenation') as s:
+        table = pa.concat_tables(table_list)
+        s.add(rows=table.num_rows)
+    with instrumentation.stage('sorting', rows=table.num_rows):
+        indices = pc.sort_indices(table,
+                                  sort_keys=[('datetime', 'ascending')])
+    schema = _pandas_schema(table)
+    table = table.select(schema.names)
+    writer_options = dict(profile or {})
+    row_group_size = writer_options.pop('row_group_size', _row_group_size)
+    chunk_name = path + os.sep + f'chunk{i}.parquet'
+    with instrumentation.stage('parquet_write', rows=table.num_rows) as s:
+        writer = pq.ParquetWriter(chunk_name, schema, **writer_options)
+        try:
+            for start in range(0, table.num_rows, row_group_size):
+                row_group = table.take(
+                    indices[start:start + row_group_size])
+                writer.write_table(row_group)
+        finally:
+            writer.close()
+        if instrumentation.is_enabled():
+            s.add(bytes_written=os.path.getsize(chunk_name))
+    return chunk_name
+
+
+def chunk_paths(path):
+    '''
+    Lists the parquet chunks written by pathfiles_to_chunks in path,
+    ordered by chunk number (chunk2 before chunk10). Other chunk*.parquet
+    names, e.g. chunk_old.parquet, are skipped
+
+    Args:
+        path (str or path): directory containing chunk*.parquet files
+
+    Returns:
+        List of chunk file paths
+    '''
+    chunks = []
+    for f in os.listdir(path):
+        match = _chunk_name.fullmatch(f)
+        if match:
+            chunks.append((int(match.group(1)), f))
+    return [os.path.join(path, f) for _, f in sorted(chunks)]
+
+
+def _frame_arrays(df):
+    return (df.index.values, df['elementnumber'].values,
+            df['valuequality'].values)
+
+
+def _table_arrays(table):
+    return tuple(table.column(c).to_numpy()
+                 for c in ('datetime', 'elementnumber', 'valuequality'))
+
+
+def _table_frame(table):
+    return table.to_pandas().set_index('datetime')
+
+
+def _frame_values(df):
+    return (df.index.values, df['elementnumber'].values,
+            df['variablenumber'].values, df['fcas_value'].values)
+
+
+def _table_values(table):
+    return tuple(table.column(c).to_numpy(zero_copy_only=False)
+                 for c in ('datetime', 'elementnumber', 'variablenumber',
+                           'fcas_value'))
+
+
+def pathfiles_to_chunks(path, fformat, mem_limit, gap_index=False,
+                        engine='pandas', sketches=False, preview=None,
+                        preview_mb=200):
+    '''
+    Reads Causer Pays files in path and writes them to sorted parquet chunks
+    of roughly mem_limit MB in path
+
+    Args:
+        path (str or path): recursive search for files with fformat in path
+        fformat (str): csv or parquet
+        mem_limit (float): memory (MB) of data read before a chunk write
+        gap_index (bool, optional): build a gap and bad quality index of
+                                    each element in the same pass and write
+                                    it as a sidecar in path
+        engine (str, optional): 'pandas' or 'arrow'. The Arrow path avoids
+                                intermediate copies, see write_arrow_chunk
+        sketches (bool, optional): build quantile sketches of each element,
+                                   variable and day in the same pass and
+                                   write them as sidecars in path, see
+                                   causer_pays_sketches
+        preview (str or path, optional): directory to write a stratified
+                                         sample of whole dispatch intervals
+                                         to, see causer_pays_preview
+        preview_mb (float, optional): MB of data kept in the preview
+    '''
+    if engine == 'arrow':
+        read, write = read_arrow, write_arrow_chunk
+        nbytes, arrays = (lambda t: t.nbytes), _table_arrays
+        values, frame = _table_values, _table_frame
+    elif engine == 'pandas':
+        read, write = read_dataframes, write_parquet
+        nbytes, arrays = getsizeof, _frame_arrays
+        values, frame = _frame_values, (lambda df: df)
+    else:
+        raise ValueError("engine should be 'pandas' or 'arrow'")
+    gaps = causer_pays_gaps.GapIndexBuilder() if gap_index else None
+    sketch = causer_pays_sketches.SketchBuilder() if sketches else None
+    sampler = (causer_pays_preview.PreviewSampler(preview_mb)
+               if preview else None)
+    profile_name, profile = parquet_profiles.load_profile(path)
+    if profile_name:
+        logging.info(f'Using storage profile {profile_name}')
+    with instrumentation.stage('file_discovery') as s:
+        read_files = walk_dirs_for_files(path, fformat)
+        s.add(rows=len(read_files))
     concat_list = []
-    concat_df = pd.DataFrame()
     i = 0
     mem = 0
     for file in tqdm.tqdm(read_files, desc='Reading file:'):
-        df = read_dataframes(fformat, file)
+        df = read(fformat, file)
         concat_list.append(df)
-        df_mem = getsizeof(df)
+        if gaps is not None:
+            with instrumentation.stage('gap_index', rows=len(df)):
+                gaps.update(*arrays(df))
+        if sketch is not None:
+            with instrumentation.stage('sketches', rows=len(df)):
+                sketch.update(*values(df))
+        if sampler is not None:
+            with instrumentation.stage('preview', rows=len(df)):
+                sampler.update(frame(df))
+        df_mem = nbytes(df)
         mem += df_mem / 1e6
         if mem < mem_limit:
             logging.info(f'Memory: {mem}')
         elif mem >= mem_limit:
-            chunk_name = write_parquet(concat_list, path, i)
+            chunk_name = write(concat_list, path, i, profile)
             logging.info(f'Writing chunk {chunk_name}')
             i += 1
             concat_list = []
-            concat_df = pd.DataFrame()
             mem = 0
 
     final_len = len(concat_list)
     if final_len > 0:
-        chunk_name = write_parquet(concat_list, path, i)
+        chunk_name = write(concat_list, path, i, profile)
         logging.info(f'Writing chunk {chunk_name}')
 
+    if gaps is not None:
+        sidecar = causer_pays_gaps.write_gap_index(gaps.finish(), path)
+        logging.info(f'Writing gap index {sidecar}')
+    if sketch is not None:
+        sidecar = causer_pays_sketches.write_sketches(
+            sketch.finish(), path, sketch.buckets)
+        logging.info(f'Writing quantile sketches {sidecar}')
+    if sampler is not None:
+        chunk_name = causer_pays_preview.write_preview(sampler.finish(),
+                                                       preview)
+        logging.info(f'Writing preview {chunk_name}')
+
+
+def tune_storage_profile(path, fformat, n_files=10):
+    '''
+    Writes a sample of the files in path under each candidate storage
+    profile, then records the best profile in path for pathfiles_to_chunks
+
+    Args:
+        path (str or path): recursive search for files with fformat in path
+        fformat (str): csv or parquet
+        n_files (int, optional): files, evenly spaced in time, to sample
+
+    Returns:
+        Name of the winning profile
+    '''
+    read_files = walk_dirs_for_files(path, fformat)
+    step = max(len(read_files) // n_files, 1)
+    sample = [read_dataframes(fformat, f) for f in read_files[::step]]
+    sample = pd.concat(sample).sort_index()
+    with tempfile.TemporaryDirectory(dir=path) as workdir:
+        name, results = parquet_profiles.tune_profile(sample, workdir)
+    logging.info(f'Storage profile measurements:\n{results}')
+    parquet_profiles.save_profile(path, name, parquet_profiles.profiles[name],
+                                  results)
+    return name
+
 
 def walk_dirs_for_files(path, fformat):
     read_files = []
     for root, subs, files in os.walk(path):
         if files:
             logging.info(f' Reading files in {root}')
+            # chunks and sidecars written to path are not input files
+            if os.path.abspath(root) == os.path.abspath(path):
+                files = [x for x in files if x not in sidecar_names
+                         and not _chunk_name.fullmatch(x)]
             flist = [root + os.sep + x for x in files if fformat in x.lower()]
             if flist:
                 read_files.extend(flist)
@@ -75,31 +333,111 @@ def walk_dirs_for_files(path, fformat):
 
 
 def read_dataframes(fformat, path):
-    original_cols = ['TIMESTAMP', 'ELEMENTNUMBER', 'VARIABLENUMBER',
-                     'VALUE', 'VALUEQUALITY']
-    cols = ['datetime', 'elementnumber', 'variablenumber',
-            'fcas_value', 'valuequality']
-    if fformat == 'csv':
-        df = pd.read_csv(path)
-        verfied_cols = df.columns[df.columns.isin(original_cols)]
-        df = df[verfied_cols]
-        if len(verfied_cols) == 0:
-            df = pd.read_csv(path, header=None)
-        elif len(verfied_cols) < len(original_cols):
-            raise ValueError("Causer Pays data missing some columns")
-    elif fformat == 'parquet':
-        df = pd.read_parquet(path)
-    df.columns = cols
-    df['datetime'] = df['datetime'].astype(np.datetime64)
-    df = df.set_index('datetime')
+    with instrumentation.stage('parsing') as s:
+        if fformat == 'csv':
+            df = pd.read_csv(path)
+            verfied_cols = df.columns[df.columns.isin(original_cols)]
+            df = df[verfied_cols]
+            if len(verfied_cols) == 0:
+                df = pd.read_csv(path, header=None)
+            elif len(verfied_cols) < len(original_cols):
+                raise ValueError("Causer Pays data missing some columns")
+        elif fformat == 'parquet':
+            df = pd.read_parquet(path)
+        if instrumentation.is_enabled():
+            s.add(rows=len(df), bytes_read=os.path.getsize(path))
+    with instrumentation.stage('type_conversion', rows=len(df)):
+        df.columns = cols
+        df['datetime'] = df['datetime'].astype(np.datetime64)
+        df = df.set_index('datetime')
     return df
 
 
+def read_arrow(fformat, path):
+    '''
+    Arrow equivalent of read_dataframes. Returns an Arrow table with the
+    same columns, parsed without a round trip through pandas
+
+    Args:
+        fformat (str): csv or parquet
+        path (str or path): file to read
+
+    Returns:
+        Arrow table with datetime as a ns timestamp column
+    '''
+    with instrumentation.stage('parsing') as s:
+        if fformat == 'csv':
+            with open(path) as f:
+                header = f.readline().strip().split(',')
+            verified_cols = [c for c in header if c in original_cols]
+            if len(verified_cols) == 0:
+                read_options = pa_csv.ReadOptions(
+                    column_names=original_cols)
+            elif len(verified_cols) < len(original_cols):
+                raise ValueError("Causer Pays data missing some columns")
+            else:
+                read_options = pa_csv.ReadOptions()
+            convert_options = pa_csv.ConvertOptions(
+                include_columns=original_cols,
+                column_types={'TIMESTAMP': pa.string()})
+            table = pa_csv.read_csv(path, read_options=read_options,
+                                    convert_options=convert_options)
+        elif fformat == 'parquet':
+            table = pq.read_table(path)
+        if instrumentation.is_enabled():
+            s.add(rows=table.num_rows, bytes_read=os.path.getsize(path))
+    with instrumentation.stage('type_conversion', rows=table.num_rows):
+        table = table.rename_columns(cols)
+        times = table.column('datetime')
+        if pa.types.is_string(times.type):
+            try:
+                times = pc.strptime(times, format=_timestamp_fmt,
+                                    unit='ns')
+            except pa.ArrowInvalid:
+                times = times.cast(pa.timestamp('ns'))
+        else:
+            times = times.cast(pa.timestamp('ns'))
+        table = table.set_column(0, 'datetime', times)
+    return table
+
+
 def main():
     logging.basicConfig(format='\n%(levelname)s:%(message)s',
                         level=logging.INFO)
     args = arg_parser()
-    pathfiles_to_chunks(args.path, args.format, args.memory_limit)
+    if args.report:
+        instrumentation.enable(trace_memory=args.trace_memory)
+    if args.tune_profile:
+        name = tune_storage_profile(args.path, args.format,
+                                    args.tune_profile)
+        logging.info(f'Recorded storage profile {name}')
+    if args.watch:
+        from src.data.causer_pays_watch import CauserPaysWatcher
+        from src.data.merge_mappings import map_elements_to_areas
+        if not args.area_mapping:
+            raise ValueError('-watch needs -area_mapping')
+        unsupported = [flag for flag, used in (
+            ('-engine', args.engine != 'pandas'),
+            ('-gap_index', args.gap_index), ('-sketches', args.sketches),
+            ('-preview', args.preview is not None)) if used]
+        if unsupported:
+            raise ValueError('-watch does not support '
+                             + ', '.join(unsupported))
+        mapping = pd.read_csv(args.area_mapping)
+        groups = {'Area': map_elements_to_areas(mapping),
+                  'Region': map_elements_to_areas(mapping, region_map={})}
+        watcher = CauserPaysWatcher(args.path, args.format, groups,
+                                    mem_limit=args.memory_limit,
+                                    flush_interval=args.flush_interval)
+        watcher.run()
+    else:
+        pathfiles_to_chunks(args.path, args.format, args.memory_limit,
+                            gap_index=args.gap_index, engine=args.engine,
+                            sketches=args.sketches, preview=args.preview,
+                            preview_mb=args.preview_mb)
+    if args.report:
+        instrumentation.write_report(args.report)
+        logging.info(f'Run report in {args.report}')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,302 @@
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from src.data.causer_pays_chunkpression import chunk_paths
+from src.data.causer_pays_store import prune_row_groups, row_group_index
+
+_read_cols = ['datetime', 'elementnumber', 'variablenumber', 'fcas_value']
+_stats = ('mean', 'std', 'cumdev')
+fi_variable = 5
+freq_element = 32003
+
+
+def arg_parser():
+    description = ("Stream Causer Pays parquet chunks and detect high "
+                   + "deviation periods in Area FI and frequency")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-path', type=str, required=True,
+                        help='directory containing chunk*.parquet files')
+    parser.add_argument('-area_mapping', type=str, required=True,
+                        help='emsname_duid_region.csv')
+    parser.add_argument('-out', type=str, required=True,
+                        help='csv file to write period records to')
+    parser.add_argument('-thresholds', type=str, nargs='+', required=True,
+                        help=('signal=threshold pairs, e.g. Mainland=2000 '
+                              + 'Tasmania=200 frequency=0.5'))
+    parser.add_argument('-stat', type=str, default='cumdev', choices=_stats,
+                        help='rolling statistic compared to thresholds')
+    parser.add_argument('-window', type=str, default='5T',
+                        help='rolling window as a pandas offset')
+    parser.add_argument('-min_duration', type=str, default='1T',
+                        help='shortest period reported')
+    parser.add_argument('-start', type=str, default=None,
+                        help='start of the scan')
+    parser.add_argument('-end', type=str, default=None,
+                        help='end of the scan')
+    args = parser.parse_args()
+    return args
+
+
+def _signal_frame(times, element, variable, values, elements, codes, labels,
+                  freq_variable):
+    '''
+    Reduces raw rows to one row per timestamp with a column of summed FI
+    for each Area and the frequency element's value
+
+    Returns:
+        DataFrame indexed on datetime with a column per signal
+    '''
+    fi = variable == fi_variable
+    pos = np.searchsorted(elements, element).clip(0, len(elements) - 1)
+    fi &= elements[pos] == element
+    freq = element == freq_element
+    if freq_variable is not None:
+        freq &= variable == freq_variable
+
+    fi_df = pd.DataFrame({'datetime': times[fi],
+                          'signal': np.asarray(labels)[codes[pos[fi]]],
+                          'value': values[fi]})
+    fi_df = fi_df.groupby(['datetime', 'signal'])['value'].sum()
+    fi_df = fi_df.unstack('signal')
+    freq_s = pd.Series(values[freq], index=pd.DatetimeIndex(times[freq]))
+    freq_s = freq_s.groupby(level=0).mean().rename('frequency')
+    df = pd.concat([fi_df, freq_s], axis=1)
+    df.index.name = 'datetime'
+    return df.reindex(columns=list(labels) + ['frequency'])
+
+
+def stream_batches(path, start=None, end=None):
+    '''
+    Yields raw (times, element, variable, values) arrays for each row group
+    of the store in time order, restricted to start and end
+
+    Raises:
+        ValueError if row groups overlap in time, e.g. chunks each holding
+        a range of elements over the same period, as they can not be
+        streamed in time order
+    '''
+    index = row_group_index(chunk_paths(path))
+    index = prune_row_groups(index, start=start, end=end)
+    index = index.sort_values(['datetime_min', 'path', 'row_group'])
+    # rows at the same timestamp may straddle two row groups
+    overlaps = (index['datetime_min'].values[1:]
+                < index['datetime_max'].cummax().values[:-1])
+    if overlaps.any():
+        raise ValueError(f'Row groups of {path} overlap in time, so it can'
+                         + ' not be streamed in time order')
+    files = {}
+    for p, rg in zip(index['path'], index['row_group']):
+        if p not in files:
+            files = {p: pq.ParquetFile(p)}
+        table = files[p].read_row_group(rg, columns=_read_cols)
+        times = table.column('datetime').to_numpy().astype('datetime64[ns]')
+        arrays = [times,
+                  table.column('elementnumber').to_numpy().astype(np.int64),
+                  table.column('variablenumber').to_numpy().astype(np.int64),
+                  table.column('fcas_value').to_numpy().astype(np.float64)]
+        keep = ~np.isnan(arrays[3])
+        if start is not None:
+            keep &= times >= pd.Timestamp(start).to_datetime64()
+        if end is not None:
+            keep &= times <= pd.Timestamp(end).to_datetime64()
+        yield [a[keep] for a in arrays]
+
+
+def rolling_signal_stats(path, element_groups, window='5T', start=None,
+                         end=None, freq_variable=None):
+    '''
+    Streams the chunk store and computes rolling statistics of Area FI
+    (variable 5 summed over each Area's elements) and frequency (element
+    32003, FREQ_DEV NEM SOUTH). Only the last window of signal values and
+    the rows of the last timestamp of each row group are carried between
+    row groups, so memory does not depend on the date range
+
+    Args:
+        path (str or path): directory containing chunk*.parquet files
+        element_groups (pandas Series): element number to Area, e.g. output
+                                        of map_elements_to_areas
+        window (str, optional): rolling window as a pandas offset. Windows
+                                cover (t - window, t]
+        start, end (str or Timestamp, optional): bounds of the scan
+        freq_variable (int, optional): only use this variable of the
+                                       frequency element
+
+    Yields:
+        DataFrames with datetime, signal, value, mean, std and cumdev
+        (rolling sum of value) columns, in time order
+    '''
+    element_groups = element_groups.sort_index()
+    elements = element_groups.index.values.astype(np.int64)
+    codes, labels = pd.factorize(element_groups.values, sort=True)
+    codes = codes.astype(np.int64)
+    window_td = pd.Timedelta(window)
+
+    tail = None
+    held = None
+    batches = stream_batches(path, start, end)
+    while True:
+        batch = next(batches, None)
+        if batch is None:
+            if held is None:
+                break
+            arrays, held = held, None
+        else:
+            if held is not None:
+                batch = [np.concatenate([h, b]) for h, b in zip(held, batch)]
+            if not len(batch[0]):
+                continue
+            # the next row group may hold more rows of the last timestamp
+            last = batch[0].max()
+            at_last = batch[0] == last
+            held = [a[at_last] for a in batch]
+            arrays = [a[~at_last] for a in batch]
+            if not len(arrays[0]):
+                continue
+
+        signals = _signal_frame(*arrays, elements, codes, labels,
+                                freq_variable)
+        n_new = len(signals)
+        if tail is not None:
+            signals = pd.concat([tail, signals])
+        rolling = signals.rolling(window)
+        stats = {'value': signals, 'mean': rolling.mean(),
+                 'std': rolling.std(), 'cumdev': rolling.sum()}
+        tail = signals[signals.index > signals.index[-1] - window_td]
+
+        n_signals = signals.shape[1]
+        out = pd.DataFrame({
+            'datetime': np.repeat(signals.index.values[-n_new:], n_signals),
+            'signal': np.tile(signals.columns.values, n_new)})
+        for k, v in stats.items():
+            out[k] = v.values[-n_new:].ravel()
+        yield out.dropna(subset=['value']).reset_index(drop=True)
+
+
+def _runs(times, flagged, max_gap_ns):
+    '''
+    Start and end positions of runs of flagged samples no more than
+    max_gap_ns apart
+    '''
+    idx = np.flatnonzero(flagged)
+    if not len(idx):
+        return idx, idx
+    t = times[idx]
+    # a run breaks at an unflagged sample or a gap in the data
+    breaks = (np.diff(idx) > 1) | (np.diff(t) > max_gap_ns)
+    starts = idx[np.r_[True, breaks]]
+    ends = idx[np.r_[breaks, True]]
+    return starts, ends
+
+
+def detect_high_deviation(path, element_groups, thresholds, stat='cumdev',
+                          window='5T', min_duration='1T', max_gap='8S',
+                          start=None, end=None, freq_variable=None):
+    '''
+    Streams the chunk store and yields a record for each period in which
+    the absolute value of a rolling statistic of a signal is at or above
+    its threshold. Periods spanning row groups are carried until they
+    close
+
+    Args:
+        path (str or path): directory containing chunk*.parquet files
+        element_groups (pandas Series): element number to Area
+        thresholds (dict): signal (Area or 'frequency') to threshold.
+                           Signals without a threshold are not scanned
+        stat (str, optional): 'mean', 'std' or 'cumdev'
+        window (str, optional): rolling window as a pandas offset
+        min_duration (str, optional): shortest period reported
+        max_gap (str, optional): largest gap between samples of a period
+        start, end (str or Timestamp, optional): bounds of the scan
+        freq_variable (int, optional): only use this variable of the
+                                       frequency element
+
+    Yields:
+        dicts with signal, start, end, samples, peak (the statistic with
+        the largest magnitude) and stat
+    '''
+    if stat not in _stats:
+        raise ValueError(f'stat should be one of {_stats}')
+    max_gap_ns = pd.Timedelta(max_gap).value
+    min_duration = pd.Timedelta(min_duration)
+    open_periods = {}
+
+    def record(signal, period):
+        return {'signal': signal, 'start': pd.Timestamp(period['start']),
+                'end': pd.Timestamp(period['end']),
+                'samples': period['samples'], 'peak': period['peak'],
+                'stat': stat}
+
+    def closed(signal, period):
+        if pd.Timedelta(period['end'] - period['start']) >= min_duration:
+            return record(signal, period)
+        return None
+
+    for df in rolling_signal_stats(path, element_groups, window=window,
+                                   start=start, end=end,
+                                   freq_variable=freq_variable):
+        for signal, group in df.groupby('signal', sort=True):
+            if signal not in thresholds:
+                continue
+            times = group['datetime'].values.view(np.int64)
+            values = group[stat].values
+            flagged = np.abs(values) >= thresholds[signal]
+            starts, ends = _runs(times, flagged, max_gap_ns)
+            period = open_periods.pop(signal, None)
+            for i, (a, b) in enumerate(zip(starts, ends)):
+                seg = values[a:b + 1]
+                peak = seg[np.argmax(np.abs(seg))]
+                run = {'start': times[a], 'end': times[b],
+                       'samples': b - a + 1, 'peak': peak}
+                if (period is not None and i == 0 and a == 0
+                        and times[a] - period['end'] <= max_gap_ns):
+                    if abs(peak) > abs(period['peak']):
+                        period['peak'] = peak
+                    period['end'] = run['end']
+                    period['samples'] += run['samples']
+                    run = period
+                elif period is not None:
+                    result = closed(signal, period)
+                    if result:
+                        yield result
+                period = run
+            if period is not None and len(starts) and \
+                    ends[-1] == len(values) - 1:
+                open_periods[signal] = period
+            elif period is not None:
+                result = closed(signal, period)
+                if result:
+                    yield result
+
+    for signal, period in sorted(open_periods.items()):
+        result = closed(signal, period)
+        if result:
+            yield result
+
+
+def main():
+    logging.basicConfig(format='\n%(levelname)s:%(message)s',
+                        level=logging.INFO)
+    args = arg_parser()
+    from src.data.merge_mappings import map_elements_to_areas
+    element_groups = map_elements_to_areas(pd.read_csv(args.area_mapping))
+    thresholds = {}
+    for pair in args.thresholds:
+        signal, value = pair.split('=')
+        thresholds[signal] = float(value)
+    periods = detect_high_deviation(args.path, element_groups, thresholds,
+                                    stat=args.stat, window=args.window,
+                                    min_duration=args.min_duration,
+                                    start=args.start, end=args.end)
+    df = pd.DataFrame(list(periods),
+                      columns=['signal', 'start', 'end', 'samples', 'peak',
+                               'stat'])
+    df.to_csv(args.out, index=False)
+    logging.info(f'{len(df)} high deviation periods in {args.out}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import os as _os
+
+import numpy as _np
+import pandas as _pd
+
+gap_index_name = 'gap_index.parquet'
+_index_cols = ['elementnumber', 'kind', 'start', 'end', 'samples']
+_state_cols = ['first', 'last', 'last_bad', 'run_start', 'run_samples',
+               'samples']
+
+
+class GapIndexBuilder:
+    '''
+    Builds a per-element index of 4s data gaps and bad quality runs as
+    Causer Pays files are ingested, without keeping the data itself.
+    Files should be fed in time order, as walk_dirs_for_files returns them.
+    State for each element (last timestamp seen, any open bad quality run)
+    is carried between updates so gaps spanning files are found.
+
+    The index has a row per run:
+        span: first and last timestamp of the element and samples seen
+        gap: missing timestamps between two readings of the element
+        bad_quality: consecutive timestamps where any reading of the element
+                     had a VALUEQUALITY other than good_quality
+
+    Args:
+        cadence (str, optional): expected interval between readings
+        good_quality (int, optional): VALUEQUALITY of a good reading
+    '''
+
+    def __init__(self, cadence='4S', good_quality=0):
+        self.cadence = _pd.Timedelta(cadence).value
+        self.good_quality = good_quality
+        self._state = _pd.DataFrame(columns=_state_cols,
+                                    index=_pd.Index([], dtype=_np.int64),
+                                    dtype=_np.int64)
+        self._records = []
+
+    def update(self, times, elements, qualities):
+        '''
+        Adds a batch of readings (e.g. one file) to the index
+
+        Args:
+            times (array-like): reading timestamps
+            elements (array-like): element numbers
+            qualities (array-like): VALUEQUALITY of each reading
+        '''
+        times = _np.asarray(times).astype('datetime64[ns]').view(_np.int64)
+        elements = _np.asarray(elements).astype(_np.int64)
+        bad = (_np.asarray(qualities) != self.good_quality).astype(_np.int64)
+        if len(times) == 0:
+            return
+
+        # one row per element and timestamp, bad if any variable is bad
+        element, time, bad = _reduce_readings(elements, times, bad)
+
+        # prepend carried rows so runs and gaps continue across batches
+        carried = self._state.reindex(_np.unique(element)).dropna()
+        carried = carried.astype(_np.int64)
+        is_carried = _np.r_[_np.ones(len(carried), dtype=bool),
+                            _np.zeros(len(element), dtype=bool)]
+        element = _np.r_[carried.index.values, element]
+        time = _np.r_[carried['last'].values, time]
+        bad = _np.r_[carried['last_bad'].values, bad]
+        order = _np.lexsort((~is_carried, time, element))
+        element, time, bad = element[order], time[order], bad[order]
+        is_carried = is_carried[order]
+        # drop readings at or before the carried timestamp of the element
+        element_start = _np.r_[True, element[1:] != element[:-1]]
+        group_first = _np.maximum.accumulate(
+            _np.where(element_start, _np.arange(len(element)), 0))
+        carried_time = _np.where(is_carried[group_first], time[group_first],
+                                 _np.iinfo(_np.int64).min)
+        keep = is_carried | (time > carried_time)
+        element, time, bad = element[keep], time[keep], bad[keep]
+        is_carried = is_carried[keep]
+
+        n = len(element)
+        same = element[1:] == element[:-1]
+        diff = time[1:] - time[:-1]
+        last_of_element = _np.r_[~same, True]
+
+        # gaps between consecutive readings of an element
+        gaps = _np.flatnonzero(same & (diff > self.cadence))
+        if len(gaps):
+            self._records.append(_pd.DataFrame({
+                'elementnumber': element[gaps],
+                'kind': 'gap',
+                'start': time[gaps] + self.cadence,
+                'end': time[gaps + 1] - self.cadence,
+                'samples': diff[gaps] // self.cadence - 1
+            }))
+
+        # bad quality runs, broken by good readings or gaps
+        cont = _np.zeros(n, dtype=bool)
+        cont[1:] = (same & (bad[1:] == 1) & (bad[:-1] == 1)
+                    & (diff == self.cadence))
+        run_starts = _np.flatnonzero((bad == 1) & ~cont)
+        run_ends = _np.flatnonzero((bad == 1) & ~_np.r_[cont[1:], False])
+        start_time = time[run_starts]
+        samples = run_ends - run_starts + 1
+        # runs continuing from a previous batch keep their start and count
+        from_carried = is_carried[run_starts]
+        if from_carried.any():
+            carried_runs = self._state.loc[element[run_starts[from_carried]]]
+            start_time[from_carried] = carried_runs['run_start'].values
+            samples[from_carried] += carried_runs['run_samples'].values - 1
+        still_open = last_of_element[run_ends]
+        closed = ~still_open
+        if closed.any():
+            self._records.append(_pd.DataFrame({
+                'elementnumber': element[run_starts[closed]],
+                'kind': 'bad_quality',
+                'start': start_time[closed],
+                'end': time[run_ends[closed]],
+                'samples': samples[closed]
+            }))
+
+        # carry the last reading and any open run of each element
+        last = _np.flatnonzero(last_of_element)
+        new_samples = _np.bincount(
+            _np.searchsorted(element[last], element[~is_carried]),
+            minlength=len(last))
+        state = _pd.DataFrame({
+            'first': time[_np.flatnonzero(_np.r_[True, ~same])],
+            'last': time[last], 'last_bad': bad[last],
+            'run_start': -1, 'run_samples': 0, 'samples': new_samples
+        }, index=element[last])
+        open_elements = element[run_ends[still_open]]
+        state.loc[open_elements, 'run_start'] = start_time[still_open]
+        state.loc[open_elements, 'run_samples'] = samples[still_open]
+        previous = self._state.reindex(state.index)
+        seen = previous['first'].notna().values
+        state.loc[seen, 'first'] = previous.loc[seen, 'first'].values
+        state.loc[seen, 'samples'] += previous.loc[seen, 'samples'].values
+        self._state = _pd.concat(
+            [self._state.drop(state.index, errors='ignore'), state])
+        self._state = self._state.astype(_np.int64)
+
+    def finish(self):
+        '''
+        Closes open bad quality runs and returns the index
+
+        Returns:
+            DataFrame with elementnumber, kind, start, end and samples
+        '''
+        state = self._state.sort_index()
+        records = list(self._records)
+        records.append(_pd.DataFrame({
+            'elementnumber': state.index.values, 'kind': 'span',
+            'start': state['first'].values, 'end': state['last'].values,
+            'samples': state['samples'].values
+        }))
+        open_runs = state[state['run_start'] >= 0]
+        records.append(_pd.DataFrame({
+            'elementnumber': open_runs.index.values, 'kind': 'bad_quality',
+            'start': open_runs['run_start'].values,
+            'end': open_runs['last'].values,
+            'samples': open_runs['run_samples'].values
+        }))
+        index = _pd.concat(records, ignore_index=True)[_index_cols]
+        index['start'] = _pd.to_datetime(index['start'].astype(_np.int64))
+        index['end'] = _pd.to_datetime(index['end'].astype(_np.int64))
+        index = index.astype({'elementnumber': _np.int64,
+                              'samples': _np.int64})
+        return index.sort_values(['elementnumber', 'start', 'kind'],
+                                 ignore_index=True)
+
+
+def _reduce_readings(elements, times, bad):
+    '''
+    Collapses readings to one row per (element, time), bad if any is bad
+    '''
+    order = _np.lexsort((times, elements))
+    elements, times, bad = elements[order], times[order], bad[order]
+    starts = _np.flatnonzero(_np.r_[True, (elements[1:] != elements[:-1])
+                                    | (times[1:] != times[:-1])])
+    return (elements[starts], times[starts],
+            _np.maximum.reduceat(bad, starts))
+
+
+def write_gap_index(index, path):
+    '''
+    Writes the gap index as a sidecar next to the parquet chunks
+
+    Args:
+        index (pandas DataFrame): output of GapIndexBuilder.finish
+        path (str or path): chunk directory
+
+    Returns:
+        Path of the sidecar
+    '''
+    sidecar = _os.path.join(path, gap_index_name)
+    index.to_parquet(sidecar, index=False)
+    return sidecar
+
+
+def read_gap_index(path):
+    '''
+    Reads the gap index sidecar from a chunk directory
+
+    Args:
+        path (str or path): chunk directory
+
+    Returns:
+        DataFrame with elementnumber, kind, start, end and samples
+    '''
+    return _pd.read_parquet(_os.path.join(path, gap_index_name))
+
+
+def _clip_samples(runs, start, end, cadence):
+    '''
+    Number of cadence-spaced samples of each run within [start, end]
+    '''
+    lo = runs['start'].values.astype('datetime64[ns]').view(_np.int64)
+    hi = runs['end'].values.astype('datetime64[ns]').view(_np.int64)
+    if start is not None:
+        # align to the run's own sample grid
+        start = _pd.Timestamp(start).value
+        lo = _np.where(lo < start,
+                       lo + -(-(start - lo) // cadence) * cadence, lo)
+    if end is not None:
+        hi = _np.minimum(hi, _pd.Timestamp(end).value)
+    return _np.where(hi >= lo, (hi - lo) // cadence + 1, 0)
+
+
+def coverage(index, start=None, end=None, cadence='4S'):
+    '''
+    Per-element coverage between start and end (inclusive) from the gap
+    index alone. Expected samples are counted from the element's first to
+    last reading within the window
+
+    Args:
+        index (pandas DataFrame): gap index
+        start, end (str or Timestamp, optional): window bounds
+        cadence (str, optional): expected interval between readings
+
+    Returns:
+        DataFrame indexed on elementnumber with expected, missing and
+        bad_quality samples and the fraction of good samples (coverage)
+    '''
+    cadence = _pd.Timedelta(cadence).value
+    counts = index[['elementnumber', 'kind']].copy()
+    counts['samples'] = _clip_samples(index, start, end, cadence)
+    counts = counts.pivot_table(index='elementnumber', columns='kind',
+                                values='samples', aggfunc='sum',
+                                fill_value=0)
+    counts = counts.reindex(columns=['span', 'gap', 'bad_quality'],
+                            fill_value=0)
+    counts.columns.name = None
+    counts = counts.rename(columns={'span': 'expected', 'gap': 'missing'})
+    counts = counts[counts['expected'] > 0]
+    counts['coverage'] = ((counts['expected'] - counts['missing']
+                           - counts['bad_quality']) / counts['expected'])
+    return counts
+
+
+def invalid_intervals(index, freq='5T', kinds=('gap', 'bad_quality'),
+                      label='right'):
+    '''
+    Intervals (e.g. dispatch intervals) touched by a gap or bad quality run
+
+    Args:
+        index (pandas DataFrame): gap index
+        freq (str, optional): interval length
+        kinds (tuple, optional): run kinds that invalidate an interval
+        label (str, optional): 'right' labels intervals by their end, i.e.
+                               (start, end] as for dispatch intervals.
+                               'left' labels by start, i.e. [start, end)
+
+    Returns:
+        DataFrame of elementnumber and interval labels
+    '''
+    runs = index[index['kind'].isin(kinds)]
+    if label == 'right':
+        first = runs['start'].dt.ceil(freq)
+        last = runs['end'].dt.ceil(freq)
+    else:
+        first = runs['start'].dt.floor(freq)
+        last = runs['end'].dt.floor(freq)
+    step = _pd.Timedelta(freq).value
+    n = ((last.values.view(_np.int64) - first.values.view(_np.int64))
+         // step + 1)
+    offsets = _np.arange(n.sum()) - _np.repeat(_np.cumsum(n) - n, n)
+    intervals = (_np.repeat(first.values.view(_np.int64), n)
+                 + offsets * step)
+    invalid = _pd.DataFrame({
+        'elementnumber': _np.repeat(runs['elementnumber'].values, n),
+        'interval': _pd.to_datetime(intervals)
+    })
+    return invalid.drop_duplicates(ignore_index=True)
+
+
+def flag_invalid(df, index, freq='5T', kinds=('gap', 'bad_quality'),
+                 label='right', flag_col='invalid'):
+    '''
+    Adds a boolean column to Causer Pays data flagging readings that fall in
+    an interval with a gap or bad quality run for that element. Raw values
+    are not needed to build the flags
+
+    Args:
+        df (pandas DataFrame): data with elementnumber and a datetime index
+                               or column
+        index (pandas DataFrame): gap index
+        freq, kinds, label: see invalid_intervals
+        flag_col (str, optional): name of the flag column
+
+    Returns:
+        DataFrame with flag_col added
+    '''
+    invalid = invalid_intervals(index, freq=freq, kinds=kinds, label=label)
+    if 'datetime' in df.columns:
+        times = _pd.DatetimeIndex(df['datetime'])
+    else:
+        times = _pd.DatetimeIndex(df.index)
+    intervals = times.ceil(freq) if label == 'right' else times.floor(freq)
+    keys = _pd.MultiIndex.from_arrays([df['elementnumber'].values,
+                                       intervals])
+    invalid_keys = _pd.MultiIndex.from_frame(invalid)
+    df = df.copy()
+    df[flag_col] = keys.isin(invalid_keys)
+    return df
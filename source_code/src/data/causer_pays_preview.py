@@ -0,0 +1,184 @@
+import os as _os
+
+import numpy as _np
+import pandas as _pd
+
+strata_name = 'preview_strata.parquet'
+_strata_cols = ['variablenumber', 'hour', 'units_seen', 'units_kept',
+                'weight', 'mb_kept']
+
+
+class PreviewSampler:
+    '''
+    Draws a preview of the 4s Causer Pays data in one pass as files are
+    ingested, e.g. for Binder or a laptop, within a memory budget.
+
+    The sampling unit is one variable over one dispatch interval, with the
+    rows of every element, so Area sums of a sampled interval are exact.
+    Units are stratified by variable and hour of day, and each stratum
+    keeps a uniform reservoir of units sized to an equal share of
+    budget_mb, and at least one unit. Rows of the last interval of a batch
+    are held until the next batch, so files should be fed in time order.
+
+    Each row of the preview has the weight of its stratum (units seen /
+    units kept). Weighted sums and counts over the preview are unbiased
+    estimates of sums and counts over the full data.
+
+    Args:
+        budget_mb (float, optional): MB of data to keep
+        interval (str, optional): dispatch interval as a pandas offset.
+                                  Intervals are (start, end]
+        seed (int, optional): random seed
+    '''
+
+    def __init__(self, budget_mb=200, interval='5T', seed=None):
+        self.budget = budget_mb * 1e6
+        self.interval = interval
+        self._interval_td = _pd.Timedelta(interval)
+        self._rng = _np.random.default_rng(seed)
+        # stratum to [units seen, reservoir, bytes seen, capacity]
+        self._strata = {}
+        self._held = None
+
+    def _capacity(self, stratum):
+        '''
+        Units stratum can keep: an equal share of the budget over the mean
+        size of its units. Capacity never grows, as units rejected while it
+        was lower could not be drawn again and the reservoir would favour
+        later units
+        '''
+        entry = self._strata[stratum]
+        seen, _, nbytes, capacity = entry
+        share = self.budget / len(self._strata)
+        entry[3] = min(capacity, max(1, int(share // (nbytes / seen))))
+        return entry[3]
+
+    def update(self, df):
+        '''
+        Adds a batch of readings (e.g. one file) to the sample
+
+        Args:
+            df (pandas DataFrame): Causer Pays data indexed on datetime, as
+                                   read by read_dataframes
+        '''
+        if self._held is not None:
+            df = _pd.concat([self._held, df])
+            self._held = None
+        if not len(df):
+            return
+        labels = df.index.ceil(self.interval)
+        last = labels.max()
+        held = labels == last
+        self._held = df[held]
+        self._add_units(df[~held], labels[~held])
+
+    def _add_units(self, df, labels):
+        if not len(df):
+            return
+        # including the float64 weight column added by finish
+        row_bytes = df.memory_usage(index=True).sum() / len(df) + 8
+        keys = _pd.DataFrame({'interval': labels,
+                              'variablenumber': df['variablenumber'].values})
+        codes, units = _pd.factorize(_pd.MultiIndex.from_frame(keys))
+        rows = _np.bincount(codes, minlength=len(units))
+        order = _np.argsort(codes, kind='stable')
+        bounds = _np.r_[0, _np.cumsum(rows)]
+        intervals = units.get_level_values(0)
+        hours = (intervals - self._interval_td).hour
+        variables = units.get_level_values(1)
+
+        for u in _np.argsort(intervals, kind='stable'):
+            stratum = (int(variables[u]), int(hours[u]))
+            entry = self._strata.setdefault(stratum, [0, [], 0.0, _np.inf])
+            entry[0] += 1
+            entry[2] += rows[u] * row_bytes
+            reservoir = entry[1]
+            capacity = self._shrink_stratum(stratum)
+            if len(reservoir) < capacity:
+                slot = len(reservoir)
+                reservoir.append(None)
+            else:
+                slot = self._rng.integers(0, entry[0])
+                if slot >= capacity:
+                    continue
+            reservoir[slot] = df.iloc[order[bounds[u]:bounds[u + 1]]]
+        self._shrink()
+
+    def _shrink(self):
+        '''
+        New strata reduce the share of the others. Dropping units from a
+        reservoir uniformly at random keeps it a uniform sample
+        '''
+        for stratum in self._strata:
+            self._shrink_stratum(stratum)
+
+    def _shrink_stratum(self, stratum):
+        '''
+        Drops a stratum's units beyond its capacity and returns the capacity
+        '''
+        reservoir = self._strata[stratum][1]
+        capacity = self._capacity(stratum)
+        excess = len(reservoir) - capacity
+        if excess > 0:
+            drop = set(self._rng.choice(len(reservoir), excess,
+                                        replace=False))
+            reservoir[:] = [r for i, r in enumerate(reservoir)
+                            if i not in drop]
+        return capacity
+
+    def finish(self):
+        '''
+        Adds held rows and returns the preview
+
+        Returns:
+            Tuple of (preview, strata). preview is the sampled data indexed
+            on datetime with a weight column. strata has variablenumber,
+            hour, units_seen, units_kept, weight and mb_kept
+        '''
+        if self._held is not None:
+            held, self._held = self._held, None
+            self._add_units(held, held.index.ceil(self.interval))
+        frames, records = [], []
+        for (variable, hour), (seen, reservoir, _, _) in sorted(
+                self._strata.items()):
+            weight = seen / len(reservoir)
+            kept = [r.assign(weight=weight) for r in reservoir]
+            frames.extend(kept)
+            records.append({
+                'variablenumber': variable, 'hour': hour,
+                'units_seen': seen, 'units_kept': len(reservoir),
+                'weight': weight,
+                'mb_kept': sum(r.memory_usage(index=True).sum()
+                               for r in kept) / 1e6})
+        if not frames:
+            return _pd.DataFrame(), _pd.DataFrame(columns=_strata_cols)
+        preview = _pd.concat(frames).sort_index(kind='stable')
+        return preview, _pd.DataFrame(records, columns=_strata_cols)
+
+
+def write_preview(preview, path):
+    '''
+    Writes a preview as a single chunk store, so CauserPaysStore and the
+    notebooks' dd.read_parquet can read it in place of the full store
+
+    Args:
+        preview (tuple): output of PreviewSampler.finish
+        path (str or path): preview directory. Should not be inside the
+                            ingested directory
+
+    Returns:
+        Path of the preview chunk
+    '''
+    data, strata = preview
+    _os.makedirs(path, exist_ok=True)
+    chunk_name = _os.path.join(path, 'chunk0.parquet')
+    data.to_parquet(chunk_name)
+    strata.to_parquet(_os.path.join(path, strata_name), index=False)
+    return chunk_name
+
+
+def read_strata(path):
+    '''
+    Reads the sampling strata and weights of a preview directory
+    '''
+    return _pd.read_parquet(_os.path.join(path, strata_name))
@@ -0,0 +1,304 @@
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from src.data.causer_pays_deviation import freq_element, stream_batches
+
+gen_mw_variable = 2
+_sums = ('n', 'x', 'y', 'xx', 'yy', 'xy')
+_result_cols = ['elementnumber', 'variablenumber', 'gain', 'lag_s', 'corr',
+                'samples']
+
+
+def arg_parser():
+    description = ("Score the primary frequency response of every element "
+                   + "in a Causer Pays parquet store")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-path', type=str, required=True,
+                        help='directory containing chunk*.parquet files')
+    parser.add_argument('-out', type=str, required=True,
+                        help='csv file to write element scores to')
+    parser.add_argument('-variable', type=int, default=gen_mw_variable,
+                        help='variable number of element MW')
+    parser.add_argument('-max_lag', type=str, default='60S',
+                        help='largest response lag tested')
+    parser.add_argument('-period', type=str, default=None,
+                        help=('score each period separately, as a pandas'
+                              + ' period frequency, e.g. M'))
+    parser.add_argument('-start', type=str, default=None,
+                        help='start of the scan')
+    parser.add_argument('-end', type=str, default=None,
+                        help='end of the scan')
+    args = parser.parse_args()
+    return args
+
+
+def _demean_blocks(M, starts):
+    '''
+    Subtracts the mean of each block of rows (e.g. a dispatch interval)
+    from each column of M, ignoring NaN
+    '''
+    valid = ~np.isnan(M)
+    sums = np.add.reduceat(np.where(valid, M, 0), starts, axis=0)
+    counts = np.add.reduceat(valid, starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    sizes = np.diff(np.r_[starts, len(M)])
+    return M - np.repeat(means, sizes, axis=0)
+
+
+class ResponseAccumulator:
+    '''
+    Accumulates, for every element and every lag of frequency, the
+    sufficient statistics (n, sums of x, y, x^2, y^2 and xy) of a least
+    squares fit of element MW (y) against frequency deviation (x) lagged
+    by that many 4s steps. Both are taken as deviations from their mean in
+    each dispatch interval of y, which removes dispatch targets from y.
+    Each batch is aligned on a 4s grid as a (time x element) matrix, so
+    the statistics of all elements and lags are updated with a few matrix
+    products. Frequency of the last max_lag steps is carried between
+    batches so lags span batches. Batches should hold whole intervals.
+
+    Args:
+        max_lag (str, optional): largest lag tested
+        interval (str, optional): dispatch interval as a pandas offset
+        cadence (str, optional): interval between readings
+    '''
+
+    def __init__(self, max_lag='60S', interval='5T', cadence='4S'):
+        self.interval = interval
+        self.cadence = pd.Timedelta(cadence).value
+        self.lags = pd.Timedelta(max_lag).value // self.cadence
+        self.elements = np.array([], dtype=np.int64)
+        self._origin = None
+        self._x_tail = None
+        self._tail_end = None
+        self._stats = {}
+
+    def _grow(self, elements):
+        new = np.setdiff1d(elements, self.elements)
+        if not len(new):
+            return
+        self.elements = np.concatenate([self.elements, new])
+        for stats in self._stats.values():
+            for k in _sums:
+                stats[k] = np.pad(stats[k], ((0, len(new)), (0, 0)))
+
+    def _lagged(self, x, first_row):
+        '''
+        (time x lag) matrix of frequency lagged 0 to self.lags steps,
+        using the carried tail for rows before this batch
+        '''
+        prefix = np.full(self.lags, np.nan)
+        if self._tail_end is not None:
+            # rows first_row - lags .. first_row - 1 from the tail
+            offset = self._tail_end + 1 - first_row
+            if -self.lags < offset <= self.lags:
+                src = self._x_tail[max(0, -offset):self.lags - max(0, offset)]
+                prefix[max(0, offset):max(0, offset) + len(src)] = src
+        full = np.concatenate([prefix, x])
+        n = len(x)
+        lagged = np.column_stack([full[self.lags - k:self.lags - k + n]
+                                  for k in range(self.lags + 1)])
+        self._x_tail = full[-self.lags:] if self.lags else full[:0]
+        self._tail_end = first_row + n - 1
+        return lagged
+
+    def update(self, times, elements, y, freq_times, x, periods=None):
+        '''
+        Adds a batch of readings in time order
+
+        Args:
+            times (numpy array): datetime64 timestamps of element readings
+            elements (numpy array): element numbers
+            y (numpy array): MW of each reading
+            freq_times (numpy array): datetime64 timestamps of frequency
+            x (numpy array): frequency deviation
+            periods (str, optional): pandas period frequency. Statistics
+                                     are kept separately for each period
+        '''
+        if not len(freq_times) and not len(times):
+            return
+        t = times.astype('datetime64[ns]').view(np.int64)
+        ft = freq_times.astype('datetime64[ns]').view(np.int64)
+        if self._origin is None:
+            self._origin = min(np.r_[t, ft])
+        rows = (t - self._origin) // self.cadence
+        freq_rows = (ft - self._origin) // self.cadence
+        first_row = min(np.r_[rows, freq_rows])
+        n_rows = max(np.r_[rows, freq_rows]) - first_row + 1
+
+        self._grow(np.unique(elements))
+        cols = pd.Index(self.elements).get_indexer(elements)
+        Y = np.full((n_rows, len(self.elements)), np.nan)
+        Y[rows - first_row, cols] = y
+        x_grid = np.full(n_rows, np.nan)
+        x_grid[freq_rows - first_row] = x
+        X = self._lagged(x_grid, first_row)
+
+        grid = pd.DatetimeIndex(self._origin + (first_row + np.arange(n_rows))
+                                * self.cadence)
+        intervals = grid.ceil(self.interval)
+        blocks = np.flatnonzero(np.r_[True, intervals[1:] != intervals[:-1]])
+        Y = _demean_blocks(Y, blocks)
+        X = _demean_blocks(X, blocks)
+
+        if periods is None:
+            splits = [(None, 0, n_rows)]
+        else:
+            labels = grid.to_period(periods)
+            starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+            ends = np.r_[starts[1:], n_rows]
+            splits = [(labels[a], a, b) for a, b in zip(starts, ends)]
+        for period, a, b in splits:
+            self._accumulate(period, Y[a:b], X[a:b])
+
+    def _accumulate(self, period, Y, X):
+        if period not in self._stats:
+            shape = (len(self.elements), self.lags + 1)
+            self._stats[period] = {k: np.zeros(shape) for k in _sums}
+        stats = self._stats[period]
+        valid_y = ~np.isnan(Y)
+        valid_x = ~np.isnan(X)
+        Y0 = np.where(valid_y, Y, 0)
+        X0 = np.where(valid_x, X, 0)
+        My = valid_y.astype(np.float64)
+        Mx = valid_x.astype(np.float64)
+        # sums over timestamps where both the element and lagged x exist
+        stats['n'] += My.T @ Mx
+        stats['x'] += My.T @ X0
+        stats['xx'] += My.T @ (X0 * X0)
+        stats['y'] += Y0.T @ Mx
+        stats['yy'] += (Y0 * Y0).T @ Mx
+        stats['xy'] += Y0.T @ X0
+
+    def results(self, variable=gen_mw_variable, min_samples=100):
+        '''
+        Least squares gain, correlation and sample count of each element
+        at the lag with the strongest correlation
+
+        Args:
+            variable (int, optional): variable number of y, so results
+                                      join through merge_causpays_mappings
+            min_samples (int, optional): fewer samples give NaN scores
+
+        Returns:
+            DataFrame with elementnumber, variablenumber, gain (MW per unit
+            of frequency deviation), lag_s, corr and samples, and period if
+            statistics were kept per period
+        '''
+        frames = []
+        for period, s in self._stats.items():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                sxy = s['n'] * s['xy'] - s['x'] * s['y']
+                sxx = s['n'] * s['xx'] - s['x'] ** 2
+                syy = s['n'] * s['yy'] - s['y'] ** 2
+                gain = sxy / sxx
+                corr = sxy / np.sqrt(sxx * syy)
+            corr[s['n'] < min_samples] = np.nan
+            best = np.argmax(np.nan_to_num(np.abs(corr), nan=-1), axis=1)
+            idx = np.arange(len(self.elements))
+            df = pd.DataFrame({
+                'elementnumber': self.elements,
+                'variablenumber': variable,
+                'gain': gain[idx, best],
+                'lag_s': best * self.cadence / 1e9,
+                'corr': corr[idx, best],
+                'samples': s['n'][idx, best].astype(np.int64)})
+            df.loc[df['corr'].isna(), ['gain', 'lag_s']] = np.nan
+            if period is not None:
+                df.insert(0, 'period', period)
+            frames.append(df)
+        columns = (['period'] if None not in self._stats else []) \
+            + _result_cols
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        sort = ['period', 'elementnumber'] if 'period' in columns \
+            else ['elementnumber']
+        return pd.concat(frames).sort_values(sort, ignore_index=True)
+
+
+def score_frequency_response(path, variable=gen_mw_variable, elements=None,
+                             max_lag='60S', interval='5T', period=None,
+                             start=None, end=None, freq_variable=None,
+                             min_samples=100):
+    '''
+    Streams the chunk store and scores the primary frequency response of
+    each element: the gain, lag and correlation of its MW deviation from
+    the dispatch interval mean against frequency deviation (element 32003,
+    FREQ_DEV NEM SOUTH). Rows of the last dispatch interval of each row
+    group are carried to the next, so interval means use whole intervals.
+    Elements responding to frequency have a negative gain and correlation.
+
+    Args:
+        path (str or path): directory containing chunk*.parquet files
+        variable (int, optional): variable number of element MW
+        elements (list, optional): only score these element numbers
+        max_lag (str, optional): largest response lag tested
+        interval (str, optional): dispatch interval as a pandas offset
+        period (str, optional): score each pandas period separately, e.g. M
+        start, end (str or Timestamp, optional): bounds of the scan
+        freq_variable (int, optional): only use this variable of the
+                                       frequency element
+        min_samples (int, optional): fewer samples give NaN scores
+
+    Returns:
+        DataFrame with elementnumber, variablenumber, gain, lag_s, corr and
+        samples (and period), joinable with merge_causpays_mappings
+    '''
+    accumulator = ResponseAccumulator(max_lag=max_lag, interval=interval)
+
+    def add(arrays):
+        times, element, var, values = arrays
+        freq = element == freq_element
+        if freq_variable is not None:
+            freq &= var == freq_variable
+        unit = (var == variable) & (element != freq_element)
+        if elements is not None:
+            unit &= np.isin(element, elements)
+        freq_times, x = times[freq], values[freq]
+        # one frequency reading per timestamp
+        freq_times, first = np.unique(freq_times, return_index=True)
+        accumulator.update(times[unit], element[unit], values[unit],
+                           freq_times, x[first], periods=period)
+
+    held = None
+    for batch in stream_batches(path, start, end):
+        if not len(batch[0]):
+            continue
+        if held is not None:
+            held_label = pd.Timestamp(held[0][0]).ceil(interval)
+            if pd.Timestamp(batch[0].min()).ceil(interval) == held_label:
+                batch = [np.concatenate([h, b]) for h, b in zip(held, batch)]
+            else:
+                # the batch does not continue the held interval, e.g. after
+                # a gap in the data, which a joint grid would span
+                add(held)
+        # the next row group may hold more of the last interval
+        labels = pd.DatetimeIndex(batch[0]).ceil(interval)
+        at_last = (labels == labels.max())
+        held = [a[at_last] for a in batch]
+        arrays = [a[~at_last] for a in batch]
+        if len(arrays[0]):
+            add(arrays)
+    if held is not None:
+        add(held)
+    return accumulator.results(variable=variable, min_samples=min_samples)
+
+
+def main():
+    logging.basicConfig(format='\n%(levelname)s:%(message)s',
+                        level=logging.INFO)
+    args = arg_parser()
+    scores = score_frequency_response(args.path, variable=args.variable,
+                                      max_lag=args.max_lag,
+                                      period=args.period, start=args.start,
+                                      end=args.end)
+    scores.to_csv(args.out, index=False)
+    logging.info(f'Scores of {len(scores)} elements in {args.out}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,556 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from sys import getsizeof
+
+from src.data import parquet_profiles
+from src.data.causer_pays_chunkpression import chunk_paths
+from src.data.causer_pays_chunkpression import read_dataframes
+from src.data.causer_pays_chunkpression import walk_dirs_for_files
+from src.data.causer_pays_chunkpression import write_parquet
+
+_month_pattern = re.compile(r'(20\d{2})(0[1-9]|1[0-2])[0-3]\d')
+_max_element = 2 ** 31 - 1
+_stops_name = 'stops.json'
+_schema = '''
+CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS month_files (
+    month TEXT, path TEXT, PRIMARY KEY (month, path));
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    month TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    element_lo INTEGER NOT NULL,
+    element_hi INTEGER NOT NULL,
+    depends_on INTEGER REFERENCES jobs (id),
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL,
+    UNIQUE (kind, month, shard));
+'''
+
+
+def arg_parser():
+    description = ("Sharded Causer Pays backfill. plan splits ingestion by"
+                   + " month and rollups by month and element range into a"
+                   + " SQLite job queue, work claims and runs jobs, status"
+                   + " summarises the queue")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-mode', type=str, required=True,
+                        choices=['plan', 'work', 'status'])
+    parser.add_argument('-db', type=str, required=True,
+                        help='SQLite job queue on a filesystem shared by'
+                             + ' workers')
+    parser.add_argument('-path', type=str, default=None,
+                        help='plan: recursive search for files with format')
+    parser.add_argument('-format', type=str, default='csv',
+                        help='plan: csv or parquet')
+    parser.add_argument('-out', type=str, default=None,
+                        help='plan: directory for month/chunk shards')
+    parser.add_argument('-element_mapping', type=str, default=None,
+                        help='plan: elements_causpays_mapping.csv')
+    parser.add_argument('-element_shards', type=int, default=4,
+                        help='plan: rollup element ranges per month')
+    parser.add_argument('-memory_limit', type=int, default=500,
+                        help='plan: memory (MB) of data read before a'
+                             + ' chunk write')
+    parser.add_argument('-bucket', type=str, default='5T',
+                        help='plan: rollup bucket as a pandas offset')
+    parser.add_argument('-max_attempts', type=int, default=3,
+                        help='plan: attempts before a job is failed')
+    parser.add_argument('-lease', type=float, default=120,
+                        help='work: seconds a claim lasts without heartbeat')
+    parser.add_argument('-max_jobs', type=int, default=None,
+                        help='work: stop after this many jobs')
+    args = parser.parse_args()
+    return args
+
+
+def file_month(path):
+    '''
+    YYYYMM of the first YYYYMMDD timestamp in a file name, as in NEMWeb
+    Causer Pays file names, or None
+    '''
+    match = _month_pattern.search(os.path.basename(path))
+    if match is None:
+        return None
+    return match.group(1) + match.group(2)
+
+
+def element_ranges(elements, n_shards):
+    '''
+    Splits element numbers into n_shards contiguous, inclusive ranges of
+    roughly equal element counts. The first and last ranges are open
+    ended, so elements missing from the mapping are still ingested
+
+    Returns:
+        List of (lo, hi) tuples
+    '''
+    elements = np.unique(np.asarray(elements, dtype=np.int64))
+    n_shards = max(1, min(n_shards, len(elements)))
+    splits = np.array_split(elements, n_shards)
+    bounds = [int(s[0]) for s in splits[1:]]
+    los = [0] + bounds
+    his = [b - 1 for b in bounds] + [_max_element]
+    return list(zip(los, his))
+
+
+def connect(db):
+    '''
+    Opens the job queue in autocommit mode, so transactions are explicit
+    '''
+    conn = sqlite3.connect(db, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(_schema)
+    return conn
+
+
+def read_config(conn):
+    return {r['key']: json.loads(r['value'])
+            for r in conn.execute('SELECT key, value FROM config')}
+
+
+def plan(db, path, fformat, out, elements, n_shards=4, bucket='5T',
+         max_attempts=3, mem_limit=500):
+    '''
+    Adds an ingest job for every month of files, and a rollup job depending
+    on it for every element range. Planning again is idempotent; months
+    whose files have changed since they were planned are reset and run
+    again
+
+    Args:
+        db (str or path): SQLite job queue
+        path (str or path): recursive search for files with fformat
+        fformat (str): csv or parquet
+        out (str or path): each month is written to out/YYYYMM/ as a chunk
+                           store and rollups to out/YYYYMM/rollup{i}.parquet
+        elements (array-like): element numbers used to split ranges
+        n_shards (int, optional): rollup element ranges per month
+        bucket (str, optional): rollup bucket as a pandas offset
+        max_attempts (int, optional): attempts before a job is failed
+        mem_limit (float, optional): memory (MB) of data read before a
+                                     chunk write
+
+    Returns:
+        Number of months planned
+    '''
+    months = {}
+    for f in walk_dirs_for_files(path, fformat):
+        month = file_month(f)
+        if month is None:
+            logging.warning(f'No YYYYMMDD timestamp in {f}, skipping')
+            continue
+        months.setdefault(month, []).append(os.path.abspath(f))
+    ranges = element_ranges(elements, n_shards)
+    config = {'format': fformat, 'out': os.path.abspath(out),
+              'bucket': bucket, 'memory_limit': mem_limit}
+
+    conn = connect(db)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for key, value in config.items():
+            conn.execute('INSERT OR REPLACE INTO config VALUES (?, ?)',
+                         (key, json.dumps(value)))
+        for month, files in sorted(months.items()):
+            planned = {r['path'] for r in conn.execute(
+                'SELECT path FROM month_files WHERE month = ?', (month,))}
+            if planned and planned != set(files):
+                logging.info(f'Files changed for {month}, replanning')
+                conn.execute('DELETE FROM month_files WHERE month = ?',
+                             (month,))
+                conn.execute('''UPDATE jobs SET status = 'pending',
+                                attempts = 0, progress = 0, error = NULL,
+                                worker = NULL, lease_until = NULL
+                                WHERE month = ?''', (month,))
+                # chunks of the old file list must not be resumed
+                shutil.rmtree(_staging_dir(config['out'], month),
+                              ignore_errors=True)
+            conn.executemany('INSERT OR IGNORE INTO month_files VALUES (?, ?)',
+                             [(month, f) for f in sorted(files)])
+            # every file is read once, by the month's ingest job
+            conn.execute('''INSERT OR IGNORE INTO jobs (kind, month, shard,
+                            element_lo, element_hi, max_attempts)
+                            VALUES ('ingest', ?, 0, 0, ?, ?)''',
+                         (month, _max_element, max_attempts))
+            ingest_id = conn.execute(
+                '''SELECT id FROM jobs WHERE kind = 'ingest'
+                   AND month = ?''', (month,)).fetchone()['id']
+            for shard, (lo, hi) in enumerate(ranges):
+                conn.execute('''INSERT OR IGNORE INTO jobs (kind, month,
+                                shard, element_lo, element_hi, depends_on,
+                                max_attempts)
+                                VALUES ('rollup', ?, ?, ?, ?, ?, ?)''',
+                             (month, shard, lo, hi, ingest_id, max_attempts))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return len(months)
+
+
+def claim(conn, worker, lease):
+    '''
+    Claims the next runnable job: pending, or running with an expired
+    lease, with attempts left and its dependency done. BEGIN IMMEDIATE
+    takes the write lock before reading, so two workers cannot claim the
+    same job
+
+    Returns:
+        sqlite3.Row of the claimed job, or None
+    '''
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # expired claims without attempts left, and jobs whose dependency
+        # failed, can never run
+        conn.execute('''UPDATE jobs SET status = 'failed', updated = ?
+                        WHERE status = 'running' AND lease_until < ?
+                        AND attempts >= max_attempts''', (now, now))
+        conn.execute('''UPDATE jobs SET status = 'failed', updated = ?,
+                        error = 'dependency failed'
+                        WHERE status = 'pending' AND depends_on IN
+                        (SELECT id FROM jobs WHERE status = 'failed')''',
+                     (now,))
+        job = conn.execute(
+            '''SELECT j.* FROM jobs j LEFT JOIN jobs d ON j.depends_on = d.id
+               WHERE (j.status = 'pending'
+                      OR (j.status = 'running' AND j.lease_until < ?))
+               AND j.attempts < j.max_attempts
+               AND (j.depends_on IS NULL OR d.status = 'done')
+               ORDER BY j.month, j.kind, j.shard LIMIT 1''',
+            (now,)).fetchone()
+        if job is not None:
+            conn.execute('''UPDATE jobs SET status = 'running', worker = ?,
+                            lease_until = ?, attempts = attempts + 1,
+                            updated = ? WHERE id = ?''',
+                         (worker, now + lease, now, job['id']))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return job
+
+
+def _owned_update(conn, job_id, worker, sql, params=()):
+    '''
+    Runs an UPDATE of a job only while worker still holds its claim
+
+    Returns:
+        True if the claim was held
+    '''
+    cur = conn.execute(sql + " WHERE id = ? AND worker = ?"
+                       + " AND status = 'running'",
+                       tuple(params) + (job_id, worker))
+    return cur.rowcount == 1
+
+
+class LostLease(Exception):
+    pass
+
+
+class _Heartbeat(threading.Thread):
+    '''
+    Extends a job's lease every lease / 3 seconds on its own connection
+    '''
+
+    def __init__(self, db, job_id, worker, lease):
+        super().__init__(daemon=True)
+        self.db = db
+        self.job_id = job_id
+        self.worker = worker
+        self.lease = lease
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        conn = connect(self.db)
+        try:
+            while not self._stop_event.wait(self.lease / 3):
+                held = _owned_update(conn, self.job_id, self.worker,
+                                     'UPDATE jobs SET lease_until = ?',
+                                     (time.time() + self.lease,))
+                if not held:
+                    self.lost = True
+                    return
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _write_atomic(df, path, **kwargs):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.', suffix='.tmp')
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path, **kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _file_order(path):
+    # NEMWeb names sort in time order within a month
+    return os.path.basename(path), path
+
+
+def _staging_dir(out, month):
+    return os.path.join(out, f'.{month}.ingest')
+
+
+def _files_digest(files):
+    return hashlib.sha1('\n'.join(files).encode()).hexdigest()
+
+
+def _read_stops(staging, files):
+    '''
+    Files completed by each chunk in staging, if they were written for the
+    same list of files
+    '''
+    try:
+        with open(os.path.join(staging, _stops_name)) as f:
+            recorded = json.load(f)
+    except FileNotFoundError:
+        return []
+    if recorded.get('files') != _files_digest(files):
+        return []
+    return recorded['stops']
+
+
+def _write_stops(staging, files, stops):
+    fd, tmp_path = tempfile.mkstemp(dir=staging, prefix='.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'files': _files_digest(files), 'stops': stops}, f)
+    os.replace(tmp_path, os.path.join(staging, _stops_name))
+
+
+def _write_chunk_atomic(frames, staging, i, profile):
+    tmp_dir = tempfile.mkdtemp(dir=staging, prefix='.')
+    try:
+        # write_parquet sorts and applies the storage profile
+        tmp_chunk = write_parquet(frames, tmp_dir, i, profile)
+        os.replace(tmp_chunk, os.path.join(staging, f'chunk{i}.parquet'))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _swap_dir(staging, month_dir):
+    '''
+    Moves a finished staging directory into place, replacing an earlier
+    ingest of the month
+    '''
+    old = month_dir + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(month_dir):
+        os.replace(month_dir, old)
+    os.replace(staging, month_dir)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def run_ingest(conn, job, config, files, worker, heartbeat):
+    '''
+    Reads a month of files in time order, each file once, and writes them
+    as sorted chunks of roughly config['memory_limit'] MB, like
+    pathfiles_to_chunks. Chunks are written atomically to a staging
+    directory, out/.YYYYMM.ingest, with the number of files each chunk
+    completes, so a retried job resumes after the last chunk if the month's
+    files are unchanged. The staging
+    directory is then moved to out/YYYYMM, a chunk store whose chunks
+    cover consecutive time ranges
+    '''
+    month_dir = os.path.join(config['out'], job['month'])
+    staging = _staging_dir(config['out'], job['month'])
+    os.makedirs(staging, exist_ok=True)
+    files = sorted(files, key=_file_order)
+    stops = _read_stops(staging, files)
+    # chunks past the last recorded stop are from an interrupted attempt
+    for path in chunk_paths(staging)[len(stops):]:
+        os.remove(path)
+    profile = parquet_profiles.load_profile(config['out'])[1]
+    mem_limit = config.get('memory_limit', 500)
+
+    frames = []
+    mem = 0
+    first = stops[-1] if stops else 0
+    for i in range(first, len(files)):
+        df = read_dataframes(config['format'], files[i])
+        frames.append(df)
+        mem += getsizeof(df) / 1e6
+        if mem < mem_limit and i < len(files) - 1:
+            continue
+        if heartbeat.lost:
+            raise LostLease(f'Lost lease on job {job["id"]}')
+        _write_chunk_atomic(frames, staging, len(stops), profile)
+        stops.append(i + 1)
+        _write_stops(staging, files, stops)
+        frames = []
+        mem = 0
+        if not _owned_update(conn, job['id'], worker,
+                             'UPDATE jobs SET progress = ?, updated = ?',
+                             (i + 1, time.time())):
+            raise LostLease(f'Lost lease on job {job["id"]}')
+
+    os.remove(os.path.join(staging, _stops_name))
+    _swap_dir(staging, month_dir)
+
+
+def run_rollup(job, config):
+    '''
+    Aggregates the elements of a job's range in a committed month to bucket
+    sum, count, min, max and mean by element and variable. Chunks are
+    aggregated one at a time and the partial aggregates combined, as a
+    bucket can span two chunks. Buckets are labelled at their end, as
+    dispatch intervals
+    '''
+    month_dir = os.path.join(config['out'], job['month'])
+    keys = ['datetime', 'elementnumber', 'variablenumber']
+    partials = []
+    for path in chunk_paths(month_dir):
+        df = pd.read_parquet(path, filters=[
+            ('elementnumber', '>=', job['element_lo']),
+            ('elementnumber', '<=', job['element_hi'])])
+        df = df[df['fcas_value'].notna()]
+        groups = [df.index.ceil(config['bucket']).rename('datetime'),
+                  df['elementnumber'], df['variablenumber']]
+        partials.append(df.groupby(groups)['fcas_value'].agg(
+            ['sum', 'count', 'min', 'max']))
+    rollup = pd.concat(partials).groupby(level=keys).agg(
+        {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'})
+    rollup['mean'] = rollup['sum'] / rollup['count']
+    _write_atomic(rollup.reset_index(),
+                  os.path.join(month_dir, f'rollup{job["shard"]}.parquet'),
+                  index=False)
+
+
+def work(db, lease=120, max_jobs=None, worker=None, poll=5):
+    '''
+    Claims and runs jobs until the queue has no runnable jobs left. Any
+    number of workers, on hosts sharing the filesystem, can run at once.
+    A heartbeat thread extends the claim while a job runs; a worker that
+    dies stops heartbeating and its job is reclaimed once the lease
+    expires. Failed jobs are retried up to max_attempts
+
+    Args:
+        db (str or path): SQLite job queue
+        lease (float, optional): seconds a claim lasts without a heartbeat
+        max_jobs (int, optional): stop after this many jobs
+        worker (str, optional): worker id. Defaults to host:pid
+        poll (float, optional): seconds to wait when jobs are running but
+                                none are claimable
+
+    Returns:
+        Number of jobs completed
+    '''
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    conn = connect(db)
+    config = read_config(conn)
+    done = 0
+    try:
+        while max_jobs is None or done < max_jobs:
+            job = claim(conn, worker, lease)
+            if job is None:
+                unfinished = conn.execute(
+                    '''SELECT COUNT(*) FROM jobs
+                       WHERE status IN ('running', 'pending')''').fetchone()[0]
+                if not unfinished:
+                    break
+                time.sleep(poll)
+                continue
+            name = f'{job["kind"]} {job["month"]} shard {job["shard"]}'
+            logging.info(f'{worker} claimed {name}')
+            heartbeat = _Heartbeat(db, job['id'], worker, lease)
+            heartbeat.start()
+            try:
+                if job['kind'] == 'ingest':
+                    files = [r['path'] for r in conn.execute(
+                        '''SELECT path FROM month_files WHERE month = ?
+                           ORDER BY path''', (job['month'],))]
+                    run_ingest(conn, job, config, files, worker, heartbeat)
+                else:
+                    run_rollup(job, config)
+                heartbeat.stop()
+                if heartbeat.lost or not _owned_update(
+                        conn, job['id'], worker,
+                        "UPDATE jobs SET status = 'done', updated = ?",
+                        (time.time(),)):
+                    raise LostLease(f'Lost lease on job {job["id"]}')
+                done += 1
+                logging.info(f'{worker} finished {name}')
+            except LostLease as e:
+                heartbeat.stop()
+                logging.warning(str(e))
+            except Exception as e:
+                heartbeat.stop()
+                logging.exception(f'{worker} failed {name}')
+                _owned_update(conn, job['id'], worker,
+                              '''UPDATE jobs SET status = CASE
+                                 WHEN attempts < max_attempts
+                                 THEN 'pending' ELSE 'failed' END,
+                                 error = ?, updated = ?''',
+                              (f'{type(e).__name__}: {e}', time.time()))
+    finally:
+        conn.close()
+    return done
+
+
+def status(db):
+    '''
+    Job counts by kind and status
+
+    Returns:
+        DataFrame
+    '''
+    conn = connect(db)
+    try:
+        return pd.read_sql_query(
+            '''SELECT kind, status, COUNT(*) AS jobs FROM jobs
+               GROUP BY kind, status ORDER BY kind, status''', conn)
+    finally:
+        conn.close()
+
+
+def main():
+    logging.basicConfig(format='\n%(levelname)s:%(message)s',
+                        level=logging.INFO)
+    args = arg_parser()
+    if args.mode == 'plan':
+        if not (args.path and args.out and args.element_mapping):
+            raise ValueError('plan needs -path, -out and -element_mapping')
+        elements = pd.read_csv(args.element_mapping)['ELEMENTNUMBER']
+        n_months = plan(args.db, args.path, args.format, args.out, elements,
+                        n_shards=args.element_shards, bucket=args.bucket,
+                        max_attempts=args.max_attempts,
+                        mem_limit=args.memory_limit)
+        logging.info(f'Planned {n_months} months in {args.db}')
+    elif args.mode == 'work':
+        n_jobs = work(args.db, lease=args.lease, max_jobs=args.max_jobs)
+        logging.info(f'Completed {n_jobs} jobs')
+    print(status(args.db).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+import os as _os
+
+import numpy as _np
+import pandas as _pd
+import pyarrow as _pa
+import pyarrow.parquet as _pq
+
+sketches_name = 'quantile_sketches.parquet'
+summary_name = 'sketch_summary.parquet'
+_keys = ['elementnumber', 'variablenumber', 'date']
+_bucket_cols = _keys + ['bucket', 'count']
+_summary_cols = _keys + ['count', 'sum', 'min', 'max']
+_accuracy_key = b'relative_accuracy'
+_min_value_key = b'min_value'
+
+
+class LogBuckets:
+    '''
+    Maps values to logarithmically sized buckets so that any value in a
+    bucket is within relative_accuracy of the bucket's representative
+    value (as in DDSketch). Counts of the same buckets add, so sketches
+    built from different files or days merge exactly.
+
+    Bucket keys are monotonic in value: positive values have positive
+    keys, negative values the mirrored negative keys, and values with a
+    magnitude below min_value are counted in bucket 0.
+
+    Args:
+        relative_accuracy (float, optional): relative error of quantiles
+        min_value (float, optional): smallest magnitude kept apart from 0
+    '''
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-4):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy should be between 0 and 1')
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = _np.log(self.gamma)
+        self._offset = 1 - int(_np.ceil(_np.log(min_value) / self._log_gamma))
+
+    def key(self, values):
+        '''
+        Bucket key of each value
+
+        Args:
+            values (numpy array): finite values
+
+        Returns:
+            int32 numpy array of keys
+        '''
+        magnitude = _np.abs(values)
+        small = magnitude < self.min_value
+        with _np.errstate(divide='ignore'):
+            keys = _np.ceil(_np.log(_np.where(small, 1, magnitude))
+                            / self._log_gamma) + self._offset
+        keys = _np.where(small, 0, _np.maximum(keys, 1))
+        return (_np.sign(values) * keys).astype(_np.int32)
+
+    def value(self, keys):
+        '''
+        Representative value of each bucket key
+        '''
+        keys = _np.asarray(keys)
+        magnitude = (2 * self.gamma ** (_np.abs(keys) - self._offset)
+                     / (self.gamma + 1))
+        return _np.where(keys == 0, 0.0, _np.sign(keys) * magnitude)
+
+
+def _reduce(frames, keys, agg):
+    frame = _pd.concat(frames, ignore_index=True)
+    return frame.groupby(keys, sort=False).agg(agg).reset_index()
+
+
+_bucket_agg = {'count': 'sum'}
+_summary_agg = {'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'}
+
+
+class SketchBuilder:
+    '''
+    Builds mergeable quantile sketches and summary statistics of
+    fcas_value for each element, variable and day as Causer Pays files
+    are ingested, without keeping the data itself. Files can be fed in any
+    order.
+
+    The sketches are bucket counts (see LogBuckets) with a row per
+    element, variable, date and bucket. The summary has the exact count,
+    sum, min and max of each element, variable and date.
+
+    Args:
+        relative_accuracy (float, optional): relative error of quantiles
+        min_value (float, optional): smallest magnitude kept apart from 0
+        compact_rows (int, optional): pending bucket rows before they are
+                                      merged, bounding memory
+    '''
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-4,
+                 compact_rows=5000000):
+        self.buckets = LogBuckets(relative_accuracy, min_value)
+        self.compact_rows = compact_rows
+        self._counts = []
+        self._summaries = []
+        self._pending = 0
+
+    def update(self, times, elements, variables, values):
+        '''
+        Adds a batch of readings (e.g. one file) to the sketches
+
+        Args:
+            times (array-like): reading timestamps
+            elements (array-like): element numbers
+            variables (array-like): variable numbers
+            values (array-like): fcas_value of each reading
+        '''
+        values = _np.asarray(values, dtype=_np.float64)
+        keep = _np.isfinite(values)
+        if not keep.any():
+            return
+        df = _pd.DataFrame({
+            'elementnumber': _np.asarray(elements)[keep].astype(_np.int64),
+            'variablenumber': _np.asarray(variables)[keep].astype(_np.int64),
+            'date': _np.asarray(times)[keep].astype('datetime64[D]')
+                                               .astype('datetime64[ns]'),
+            'value': values[keep]})
+        df['bucket'] = self.buckets.key(df['value'].values)
+        counts = df.groupby(_keys + ['bucket'], sort=False).size()
+        self._counts.append(counts.rename('count').reset_index())
+        self._summaries.append(df.groupby(_keys, sort=False)['value'].agg(
+            ['count', 'sum', 'min', 'max']).reset_index())
+        self._pending += len(self._counts[-1])
+        if self._pending >= self.compact_rows:
+            self._compact()
+
+    def _compact(self):
+        if len(self._counts) > 1:
+            self._counts = [_reduce(self._counts, _keys + ['bucket'],
+                                    _bucket_agg)]
+            self._summaries = [_reduce(self._summaries, _keys,
+                                       _summary_agg)]
+        self._pending = len(self._counts[0]) if self._counts else 0
+
+    def finish(self):
+        '''
+        Merges pending updates and returns the sketches
+
+        Returns:
+            Tuple of (buckets, summary) DataFrames. buckets has
+            elementnumber, variablenumber, date, bucket and count, summary
+            has elementnumber, variablenumber, date, count, sum, min and max
+        '''
+        if not self._counts:
+            return (_pd.DataFrame(columns=_bucket_cols),
+                    _pd.DataFrame(columns=_summary_cols))
+        self._compact()
+        buckets = self._counts[0].sort_values(_keys + ['bucket'],
+                                              ignore_index=True)
+        summary = self._summaries[0].sort_values(_keys, ignore_index=True)
+        buckets = buckets.astype({'bucket': _np.int32, 'count': _np.int64})
+        summary = summary.astype({'count': _np.int64})
+        return buckets[_bucket_cols], summary[_summary_cols]
+
+
+def write_sketches(sketches, path, buckets):
+    '''
+    Writes sketches as sidecars next to the parquet chunks, recording the
+    bucket parameters in the parquet metadata
+
+    Args:
+        sketches (tuple): output of SketchBuilder.finish
+        path (str or path): chunk directory
+        buckets (LogBuckets): mapping used to build the sketches, e.g.
+                              SketchBuilder.buckets
+
+    Returns:
+        Path of the sketch sidecar
+    '''
+    counts, summary = sketches
+    table = _pa.Table.from_pandas(counts, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_accuracy_key] = str(buckets.relative_accuracy).encode()
+    metadata[_min_value_key] = str(buckets.min_value).encode()
+    sidecar = _os.path.join(path, sketches_name)
+    _pq.write_table(table.replace_schema_metadata(metadata), sidecar)
+    summary.to_parquet(_os.path.join(path, summary_name), index=False)
+    return sidecar
+
+
+def _filters(start, end, elements, variables):
+    filters = []
+    if start is not None:
+        filters.append(('date', '>=', _pd.Timestamp(start).floor('D')))
+    if end is not None:
+        filters.append(('date', '<=', _pd.Timestamp(end).floor('D')))
+    if elements is not None:
+        filters.append(('elementnumber', 'in', list(elements)))
+    if variables is not None:
+        filters.append(('variablenumber', 'in', list(variables)))
+    return filters or None
+
+
+def read_sketches(path, start=None, end=None, elements=None,
+                  variables=None):
+    '''
+    Reads the sketch sidecars from a chunk directory. Only whole days are
+    stored, so start and end select the days they fall on
+
+    Args:
+        path (str or path): chunk directory
+        start, end (str or Timestamp, optional): first and last day
+        elements (list, optional): element numbers
+        variables (list, optional): variable numbers
+
+    Returns:
+        Tuple of (buckets, summary, LogBuckets)
+    '''
+    filters = _filters(start, end, elements, variables)
+    table = _pq.read_table(_os.path.join(path, sketches_name),
+                           filters=filters)
+    metadata = _pq.read_schema(_os.path.join(path, sketches_name)).metadata
+    buckets = LogBuckets(float(metadata[_accuracy_key]),
+                         float(metadata[_min_value_key]))
+    summary = _pd.read_parquet(_os.path.join(path, summary_name),
+                               filters=filters)
+    return table.to_pandas(), summary, buckets
+
+
+def merge_sketches(counts, by=('elementnumber', 'variablenumber')):
+    '''
+    Merges bucket counts over everything not in by, e.g. over days
+
+    Args:
+        counts (pandas DataFrame): buckets from read_sketches
+        by (list, optional): columns to keep
+
+    Returns:
+        DataFrame of by, bucket and count, sorted by by and bucket
+    '''
+    by = list(by)
+    merged = counts.groupby(by + ['bucket'], sort=True)['count'].sum()
+    return merged.reset_index()
+
+
+def merge_summary(summary, by=('elementnumber', 'variablenumber')):
+    '''
+    Merges summary statistics over everything not in by and adds the mean
+    '''
+    merged = summary.groupby(list(by), sort=True).agg(_summary_agg)
+    merged['mean'] = merged['sum'] / merged['count']
+    return merged.reset_index()
+
+
+def quantiles(counts, q, buckets, by=('elementnumber', 'variablenumber'),
+              summary=None):
+    '''
+    Quantiles of each group from bucket counts alone. Results are within
+    the sketch's relative accuracy of the true (lower) quantile
+
+    Args:
+        counts (pandas DataFrame): buckets from read_sketches
+        q (float or list): quantiles between 0 and 1
+        buckets (LogBuckets): mapping the sketches were built with
+        by (list, optional): groups to merge days (and anything else) into
+        summary (pandas DataFrame, optional): summary from read_sketches.
+                                              Quantiles are clipped to the
+                                              exact min and max
+
+    Returns:
+        DataFrame of by with a column per quantile, empty if counts has no
+        rows
+    '''
+    by = list(by)
+    q = _np.atleast_1d(q)
+    merged = merge_sketches(counts, by)
+    if not len(merged):
+        return _pd.DataFrame(columns=by + list(q))
+    cum = _np.cumsum(merged['count'].values)
+    group_start = _np.r_[True, (merged[by].values[1:]
+                                != merged[by].values[:-1]).any(axis=1)]
+    starts = _np.flatnonzero(group_start)
+    ends = _np.r_[starts[1:], len(merged)] - 1
+    base = _np.r_[0, cum[ends[:-1]]]
+    n = cum[ends] - base
+    out = merged[by].iloc[starts].reset_index(drop=True)
+    keys = merged['bucket'].values
+    for quantile in q:
+        rank = base + _np.floor(quantile * (n - 1))
+        idx = _np.searchsorted(cum, rank, side='right')
+        out[quantile] = buckets.value(keys[idx])
+    if summary is not None:
+        limits = merge_summary(summary, by)
+        limits = out[by].merge(limits, on=by, how='left')
+        for quantile in q:
+            out[quantile] = out[quantile].clip(limits['min'].values,
+                                               limits['max'].values)
+    return out
+
+
+def exceedance(counts, threshold, buckets,
+               by=('elementnumber', 'variablenumber'), absolute=True):
+    '''
+    Count and fraction of samples of each group above threshold, from
+    bucket counts alone. Samples within the sketch's relative accuracy of
+    the threshold may be misclassified
+
+    Args:
+        counts (pandas DataFrame): buckets from read_sketches
+        threshold (float): value to compare against
+        buckets (LogBuckets): mapping the sketches were built with
+        by (list, optional): groups to merge days into
+        absolute (bool, optional): compare magnitudes, e.g. deviation of
+                                   either sign
+
+    Returns:
+        DataFrame of by, exceed, count and fraction, most exceeding first
+    '''
+    by = list(by)
+    values = buckets.value(counts['bucket'].values)
+    if absolute:
+        values = _np.abs(values)
+    df = counts[by].assign(exceed=_np.where(values > threshold,
+                                            counts['count'].values, 0),
+                           count=counts['count'].values)
+    out = df.groupby(by, sort=True)[['exceed', 'count']].sum()
+    out['fraction'] = out['exceed'] / out['count']
+    return out.reset_index().sort_values('exceed', ascending=False,
+                                         ignore_index=True)
+
+
+def histogram(counts, bins, buckets, by=('elementnumber', 'variablenumber')):
+    '''
+    Rebins bucket counts into a histogram with the given bin edges. Bins
+    are (left, right], buckets are binned by their representative value
+    and counts outside the edges are dropped
+
+    Args:
+        counts (pandas DataFrame): buckets from read_sketches
+        bins (list): increasing bin edges
+        buckets (LogBuckets): mapping the sketches were built with
+        by (list, optional): groups to merge days into
+
+    Returns:
+        DataFrame of by, bin (pandas Interval) and count
+    '''
+    by = list(by)
+    values = buckets.value(counts['bucket'].values)
+    df = counts[by].assign(bin=_pd.cut(values, bins),
+                           count=counts['count'].values)
+    out = df.groupby(by + ['bin'], sort=True, observed=False)['count'].sum()
+    return out.reset_index()
@@ -0,0 +1,301 @@
+import os as _os
+
+from collections import OrderedDict as _OrderedDict
+
+import numpy as _np
+import pandas as _pd
+import pyarrow as _pa
+import pyarrow.parquet as _pq
+
+from src.data import causer_pays_gaps as _gaps
+from src.data import causer_pays_sketches as _sketches
+from src.data import hot_cache as _hot_cache
+from src.data.causer_pays_chunkpression import chunk_paths as _chunk_paths
+
+_stat_cols = ['datetime', 'elementnumber', 'variablenumber']
+
+
+def _column_stats(row_group, schema_names, col):
+    '''
+    Returns (min, max) statistics of col in a row group metadata object,
+    or (None, None) if the statistics are unavailable
+    '''
+    if col not in schema_names:
+        return None, None
+    stats = row_group.column(schema_names.index(col)).statistics
+    if stats is None or not stats.has_min_max:
+        return None, None
+    return stats.min, stats.max
+
+
+def row_group_index(paths, cols=_stat_cols):
+    '''
+    Reads parquet footers and tabulates min/max statistics of cols for
+    every row group in paths. Only metadata is read.
+
+    Args:
+        paths (list): parquet file paths
+        cols (list, optional): columns to collect statistics for
+
+    Returns:
+        DataFrame with path, row_group, num_rows and {col}_min/{col}_max
+    '''
+    records = []
+    for path in paths:
+        metadata = _pq.ParquetFile(path).metadata
+        names = [metadata.schema.column(i).name
+                 for i in range(metadata.num_columns)]
+        for rg in range(metadata.num_row_groups):
+            row_group = metadata.row_group(rg)
+            record = {'path': path, 'row_group': rg,
+                      'num_rows': row_group.num_rows}
+            for col in cols:
+                record[f'{col}_min'], record[f'{col}_max'] = \
+                    _column_stats(row_group, names, col)
+            records.append(record)
+    columns = ['path', 'row_group', 'num_rows']
+    columns += [f'{c}_{s}' for c in cols for s in ('min', 'max')]
+    index = _pd.DataFrame(records, columns=columns)
+    for s in ('min', 'max'):
+        if 'datetime' in cols:
+            index[f'datetime_{s}'] = _pd.to_datetime(index[f'datetime_{s}'])
+    return index
+
+
+def prune_row_groups(index, start=None, end=None,
+                     variables=None, elements=None):
+    '''
+    Filters a row_group_index to row groups that may contain rows between
+    start and end (inclusive) for the given variables and elements.
+    Row groups without statistics are always kept.
+
+    Args:
+        index (pandas DataFrame): output of row_group_index
+        start, end (str or Timestamp, optional): datetime bounds
+        variables, elements (list, optional): variable and element numbers
+
+    Returns:
+        Filtered index
+    '''
+    keep = _np.ones(len(index), dtype=bool)
+    if start is not None:
+        keep &= ~(index['datetime_max'] < _pd.Timestamp(start)).values
+    if end is not None:
+        keep &= ~(index['datetime_min'] > _pd.Timestamp(end)).values
+    for col, values in (('variablenumber', variables),
+                        ('elementnumber', elements)):
+        if values is None:
+            continue
+        values = _np.asarray(sorted(values))
+        lo = index[f'{col}_min'].values
+        hi = index[f'{col}_max'].values
+        has_stats = ~(_pd.isna(lo) | _pd.isna(hi))
+        overlaps = _np.ones(len(index), dtype=bool)
+        # a row group is needed if any value lies within [lo, hi]
+        overlaps[has_stats] = (
+            _np.searchsorted(values, hi[has_stats].astype(_np.int64),
+                             side='right')
+            > _np.searchsorted(values, lo[has_stats].astype(_np.int64),
+                               side='left'))
+        keep &= overlaps
+    return index[keep]
+
+
+def _row_mask(table, start, end, variables, elements):
+    '''
+    Boolean mask over table rows satisfying the query filters
+    '''
+    mask = _np.ones(table.num_rows, dtype=bool)
+    if start is not None or end is not None:
+        times = table.column('datetime').to_numpy()
+        times = times.astype('datetime64[ns]')
+        if start is not None:
+            mask &= times >= _pd.Timestamp(start).to_datetime64()
+        if end is not None:
+            mask &= times <= _pd.Timestamp(end).to_datetime64()
+    if variables is not None:
+        mask &= _np.isin(table.column('variablenumber').to_numpy(),
+                         list(variables))
+    if elements is not None:
+        mask &= _np.isin(table.column('elementnumber').to_numpy(),
+                         list(elements))
+    return mask
+
+
+class CauserPaysStore:
+    '''
+    Reader for the chunk*.parquet store written by causer_pays_chunkpression.
+    Queries use parquet footer statistics to skip chunks and row groups,
+    filter rows in Arrow before conversion to pandas and keep an LRU cache
+    of recent results, so repeated slices of the same window are free.
+
+    Args:
+        path (str or path): directory containing chunk*.parquet files
+        cache_size (int, optional): number of query results to keep
+        hot_cache (HotCache, optional): on-disk cache of query results
+                                        shared across kernel restarts
+    '''
+
+    def __init__(self, path, cache_size=16, hot_cache=None):
+        self.path = path
+        self.cache_size = cache_size
+        self.hot_cache = hot_cache
+        self.hits = 0
+        self.misses = 0
+        self._cache = _OrderedDict()
+        self._index = None
+        self._signature = None
+
+    def _store_signature(self):
+        signature = []
+        for chunk in _chunk_paths(self.path):
+            stat = _os.stat(chunk)
+            signature.append((chunk, stat.st_size, stat.st_mtime_ns))
+        return tuple(signature)
+
+    @property
+    def index(self):
+        '''
+        Row group statistics of the store. Rebuilt, and the result cache
+        cleared, if chunks have been added or rewritten
+        '''
+        signature = self._store_signature()
+        if signature != self._signature:
+            self._index = row_group_index([s[0] for s in signature])
+            self._signature = signature
+            self._cache.clear()
+        return self._index
+
+    def row_groups(self, start=None, end=None, variables=None, elements=None):
+        '''
+        Returns the row group index entries a query would need to read
+        '''
+        return prune_row_groups(self.index, start=start, end=end,
+                                variables=variables, elements=elements)
+
+    def gap_index(self):
+        '''
+        Gap and bad quality index sidecar written with -gap_index
+        '''
+        return _gaps.read_gap_index(self.path)
+
+    def coverage(self, start=None, end=None):
+        '''
+        Per-element coverage between start and end from the gap index,
+        without reading any values. See causer_pays_gaps.coverage
+        '''
+        return _gaps.coverage(self.gap_index(), start=start, end=end)
+
+    def quantiles(self, q, start=None, end=None, variables=None,
+                  elements=None, by=('elementnumber', 'variablenumber')):
+        '''
+        Per-element quantiles of the days between start and end from the
+        sketch sidecars written with -sketches, without reading any values.
+        See causer_pays_sketches.quantiles
+        '''
+        counts, summary, buckets = _sketches.read_sketches(
+            self.path, start=start, end=end, elements=elements,
+            variables=variables)
+        return _sketches.quantiles(counts, q, buckets, by=by,
+                                   summary=summary)
+
+    def exceedance(self, threshold, start=None, end=None, variables=None,
+                   elements=None, by=('elementnumber', 'variablenumber'),
+                   absolute=True):
+        '''
+        Per-element count and fraction of samples above threshold from the
+        sketch sidecars. See causer_pays_sketches.exceedance
+        '''
+        counts, _, buckets = _sketches.read_sketches(
+            self.path, start=start, end=end, elements=elements,
+            variables=variables)
+        return _sketches.exceedance(counts, threshold, buckets, by=by,
+                                    absolute=absolute)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def _cache_key(self, start, end, variables, elements, columns):
+        def norm(values):
+            return None if values is None else tuple(sorted(values))
+        return (None if start is None else _pd.Timestamp(start),
+                None if end is None else _pd.Timestamp(end),
+                norm(variables), norm(elements),
+                None if columns is None else tuple(columns))
+
+    def query(self, start=None, end=None, variables=None, elements=None,
+              columns=None):
+        '''
+        Returns Causer Pays data between start and end (inclusive, as with
+        pandas datetime slicing) for the given variables and elements.
+
+        Args:
+            start, end (str or Timestamp, optional): datetime bounds
+            variables (list, optional): variable numbers to return
+            elements (list, optional): element numbers to return
+            columns (list, optional): data columns to return. The datetime
+                                      index is always returned
+
+        Returns:
+            DataFrame indexed on datetime, as read by dd.read_parquet.
+            Results are shallow copies of cached frames, so adding columns
+            is safe but in-place edits of values would alter the cache
+        '''
+        index = self.index
+        key = self._cache_key(start, end, variables, elements, columns)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key].copy(deep=False)
+        self.misses += 1
+
+        if self.hot_cache is not None:
+            hot_key = _hot_cache.make_key(_os.path.abspath(self.path),
+                                          self._signature, key)
+            df = self.hot_cache.cached(hot_key, lambda: self._read(
+                index, start, end, variables, elements, columns))
+        else:
+            df = self._read(index, start, end, variables, elements, columns)
+
+        self._cache[key] = df
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return df.copy(deep=False)
+
+    def _read(self, index, start, end, variables, elements, columns):
+        selected = prune_row_groups(index, start=start, end=end,
+                                    variables=variables, elements=elements)
+        read_cols = None
+        if columns is not None:
+            filter_cols = ['datetime']
+            if variables is not None:
+                filter_cols.append('variablenumber')
+            if elements is not None:
+                filter_cols.append('elementnumber')
+            read_cols = list(columns) + [c for c in filter_cols
+                                         if c not in columns]
+
+        tables = []
+        for path, rgs in selected.groupby('path', sort=False)['row_group']:
+            table = _pq.ParquetFile(path).read_row_groups(
+                list(rgs), columns=read_cols, use_pandas_metadata=True)
+            mask = _row_mask(table, start, end, variables, elements)
+            tables.append(table.filter(_pa.array(mask)))
+
+        if tables:
+            df = _pa.concat_tables(tables).to_pandas()
+        else:
+            df = self._empty_frame(read_cols)
+        if 'datetime' in df.columns:
+            df = df.set_index('datetime')
+        if columns is not None:
+            df = df[list(columns)]
+        return df
+
+    def _empty_frame(self, read_cols):
+        chunks = _chunk_paths(self.path)
+        if not chunks:
+            raise ValueError(f'No parquet chunks in {self.path}')
+        schema = _pq.read_schema(chunks[0])
+        return schema.empty_table().to_pandas()[
+            [c for c in (read_cols or schema.names) if c != 'datetime']]
@@ -0,0 +1,354 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.data import parquet_profiles
+from src.data.causer_pays_chunkpression import chunk_paths
+from src.data.causer_pays_chunkpression import read_dataframes
+from src.data.causer_pays_chunkpression import sidecar_names
+from src.data.causer_pays_chunkpression import write_parquet
+from src.data.causer_pays_store import CauserPaysStore
+
+open_partition_name = 'open_partition.parquet'
+aggregates_name = 'rolling_aggregates.parquet'
+state_name = 'watch_state.json'
+_files_key = b'watch_files'
+_agg_keys = ['datetime', 'level', 'group', 'variablenumber']
+_agg_cols = _agg_keys + ['sum', 'count', 'min', 'max', 'mean']
+
+
+def _atomic_path(path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    suffix='.tmp')
+    os.close(fd)
+    return tmp_path
+
+
+def _write_table_atomic(table, path):
+    tmp_path = _atomic_path(path)
+    try:
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _empty_aggregates():
+    return pd.DataFrame({'datetime': pd.Series(dtype='datetime64[ns]'),
+                         'level': pd.Series(dtype=object),
+                         'group': pd.Series(dtype=object),
+                         'variablenumber': pd.Series(dtype=np.int64),
+                         'sum': pd.Series(dtype=np.float64),
+                         'count': pd.Series(dtype=np.int64),
+                         'min': pd.Series(dtype=np.float64),
+                         'max': pd.Series(dtype=np.float64)})
+
+
+def aggregate_groups(df, groups, bucket='5T', variables=None):
+    '''
+    Partial aggregates of fcas_value by (bucket, level, group, variable).
+    Buckets are labelled at their end, (start, end], as dispatch intervals
+
+    Args:
+        df (pandas DataFrame): Causer Pays data indexed on datetime
+        groups (dict): level name (e.g. 'Area', 'Region') to a Series
+                       mapping element number to group
+        bucket (str, optional): pandas offset of the aggregation bucket
+        variables (list, optional): only aggregate these variable numbers
+
+    Returns:
+        DataFrame with datetime, level, group, variablenumber, sum, count,
+        min and max
+    '''
+    if variables is not None:
+        df = df[df['variablenumber'].isin(variables)]
+    df = df[df['fcas_value'].notna()]
+    times = df.index.ceil(bucket)
+    frames = []
+    for level, mapping in groups.items():
+        group = df['elementnumber'].map(mapping)
+        mapped = group.notna().values
+        part = pd.DataFrame({'datetime': times[mapped], 'level': level,
+                             'group': group.values[mapped],
+                             'variablenumber':
+                             df['variablenumber'].values[mapped],
+                             'fcas_value': df['fcas_value'].values[mapped]})
+        frames.append(part.groupby(_agg_keys[:4], sort=False)['fcas_value']
+                      .agg(['sum', 'count', 'min', 'max']).reset_index())
+    if not frames:
+        return _empty_aggregates()
+    return pd.concat(frames, ignore_index=True)
+
+
+def merge_aggregates(left, right):
+    '''
+    Combines two sets of partial aggregates
+    '''
+    both = pd.concat([left, right], ignore_index=True)
+    merged = both.groupby(_agg_keys, sort=True).agg(
+        {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'})
+    return merged.reset_index()
+
+
+class CauserPaysWatcher:
+    '''
+    Tails a directory for newly arriving 4s Causer Pays files and ingests
+    each one once its size and modification time have stopped changing.
+    Parsed files are appended to an open partition that is sealed into the
+    next chunk*.parquet once it exceeds mem_limit. Rolling Area/region
+    aggregates are updated in memory as files land and flushed every
+    flush_interval seconds, together with open_partition.parquet, so they
+    are queryable within a few seconds of a file arriving.
+
+    Restarts are recovered from disk: watch_state.json records sealed
+    chunks and their source files, and the open partition's parquet
+    metadata records the files it contains. Anything else is parsed again,
+    and aggregates are rebuilt from data within the retention window.
+
+    Args:
+        path (str or path): directory to watch. Chunks and watch files are
+                            written here, as with pathfiles_to_chunks
+        fformat (str): csv or parquet
+        groups (dict): level name to a Series mapping element number to
+                       group, e.g. {'Area': map_elements_to_areas(...)}
+        mem_limit (float, optional): MB of data before a chunk is sealed
+        bucket (str, optional): aggregation bucket as a pandas offset
+        retain (str, optional): aggregates older than this before the latest
+                                bucket are dropped
+        flush_interval (float, optional): seconds between flushes
+        settle (float, optional): seconds a file must be unchanged before it
+                                  is parsed
+        variables (list, optional): only aggregate these variable numbers
+    '''
+
+    def __init__(self, path, fformat, groups, mem_limit=1000, bucket='5T',
+                 retain='2H', flush_interval=5, settle=1.0, variables=None):
+        self.path = path
+        self.fformat = fformat
+        self.groups = groups
+        self.mem_limit = mem_limit
+        self.bucket = bucket
+        self.retain = pd.Timedelta(retain)
+        self.flush_interval = flush_interval
+        self.settle = settle
+        self.variables = variables
+        self.profile = parquet_profiles.load_profile(path)[1]
+        self._partition = []
+        self._partition_files = []
+        self._partition_mb = 0
+        self._sealed_files = set()
+        self._next_chunk = 0
+        self._candidates = {}
+        self._dirty = False
+        self._last_flush = 0
+        self.aggregates = _empty_aggregates()
+        self.recover()
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    def _is_output(self, root, name):
+        if os.path.abspath(root) != os.path.abspath(self.path):
+            return False
+        return (name.startswith('chunk') or name.endswith('.tmp')
+                or name in sidecar_names
+                or name in (open_partition_name, aggregates_name,
+                            state_name))
+
+    def _write_state(self):
+        state = {'next_chunk': self._next_chunk,
+                 'sealed_files': sorted(self._sealed_files)}
+        tmp_path = _atomic_path(self._path(state_name))
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._path(state_name))
+
+    def recover(self):
+        '''
+        Restores sealed files, the open partition and aggregates from disk
+        '''
+        state_path = self._path(state_name)
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            self._next_chunk = state['next_chunk']
+            self._sealed_files = set(state['sealed_files'])
+        else:
+            existing = chunk_paths(self.path)
+            if existing:
+                last = os.path.basename(existing[-1])
+                self._next_chunk = int(last[len('chunk'):-len('.parquet')]) + 1
+
+        open_path = self._path(open_partition_name)
+        if os.path.exists(open_path):
+            table = pq.read_table(open_path)
+            files = json.loads(table.schema.metadata[_files_key])
+            # files sealed after the last flush are already in a chunk
+            if not set(files) & self._sealed_files:
+                self._partition = [table.to_pandas()]
+                self._partition_files = files
+                self._partition_mb = table.nbytes / 1e6
+        logging.info(f'Recovered {len(self._sealed_files)} sealed and'
+                     + f' {len(self._partition_files)} open files')
+        self._rebuild_aggregates()
+
+    def _rebuild_aggregates(self):
+        frames = list(self._partition)
+        if chunk_paths(self.path):
+            store = CauserPaysStore(self.path)
+            latest = store.index['datetime_max'].max()
+            frames.insert(0, store.query(start=latest - self.retain,
+                                         variables=self.variables))
+        aggregates = _empty_aggregates()
+        for df in frames:
+            aggregates = merge_aggregates(
+                aggregates, aggregate_groups(df, self.groups, self.bucket,
+                                             self.variables))
+        self.aggregates = self._trim(aggregates)
+        self._dirty = True
+
+    def _trim(self, aggregates):
+        if not len(aggregates):
+            return aggregates
+        cutoff = aggregates['datetime'].max() - self.retain
+        return aggregates[aggregates['datetime'] > cutoff].reset_index(
+            drop=True)
+
+    def stable_files(self):
+        '''
+        Polls path and returns unprocessed files whose size and modification
+        time are unchanged since the last poll and at least settle seconds
+        old, oldest name first
+        '''
+        processed = self._sealed_files | set(self._partition_files)
+        seen = {}
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if (self.fformat not in name.lower()
+                        or self._is_output(root, name)):
+                    continue
+                file = os.path.join(root, name)
+                if file in processed:
+                    continue
+                try:
+                    stat = os.stat(file)
+                except FileNotFoundError:
+                    continue
+                seen[file] = (stat.st_size, stat.st_mtime)
+        now = time.time()
+        stable = [f for f, sig in seen.items()
+                  if self._candidates.get(f) == sig
+                  and now - sig[1] >= self.settle]
+        self._candidates = seen
+        return sorted(stable)
+
+    def ingest(self, file):
+        '''
+        Parses a file into the open partition and updates the aggregates
+        '''
+        df = read_dataframes(self.fformat, file)
+        self._partition.append(df)
+        self._partition_files.append(file)
+        self._partition_mb += df.memory_usage(index=True).sum() / 1e6
+        self.aggregates = self._trim(merge_aggregates(
+            self.aggregates, aggregate_groups(df, self.groups, self.bucket,
+                                              self.variables)))
+        self._dirty = True
+        if self._partition_mb >= self.mem_limit:
+            self.seal()
+
+    def seal(self):
+        '''
+        Writes the open partition to the next chunk and starts a new one
+        '''
+        if not self._partition:
+            return
+        # written aside and moved into place, so readers never see a torn
+        # chunk
+        tmp_dir = tempfile.mkdtemp(dir=self.path, prefix='.')
+        try:
+            tmp_chunk = write_parquet(self._partition, tmp_dir,
+                                      self._next_chunk, self.profile)
+            chunk = os.path.join(self.path, os.path.basename(tmp_chunk))
+            os.replace(tmp_chunk, chunk)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logging.info(f'Writing chunk {chunk}')
+        self._next_chunk += 1
+        self._sealed_files.update(self._partition_files)
+        self._write_state()
+        self._partition = []
+        self._partition_files = []
+        self._partition_mb = 0
+        open_path = self._path(open_partition_name)
+        if os.path.exists(open_path):
+            os.remove(open_path)
+        self._dirty = True
+
+    def flush(self):
+        '''
+        Atomically rewrites open_partition.parquet and
+        rolling_aggregates.parquet
+        '''
+        if self._partition:
+            df = pd.concat(self._partition).sort_index()
+            table = pa.Table.from_pandas(df)
+            metadata = dict(table.schema.metadata or {})
+            metadata[_files_key] = json.dumps(self._partition_files).encode()
+            _write_table_atomic(table.replace_schema_metadata(metadata),
+                                self._path(open_partition_name))
+        aggregates = self.aggregates.copy()
+        aggregates['mean'] = aggregates['sum'] / aggregates['count']
+        _write_table_atomic(
+            pa.Table.from_pandas(aggregates[_agg_cols], preserve_index=False),
+            self._path(aggregates_name))
+        self._dirty = False
+        self._last_flush = time.time()
+
+    def run(self, poll_interval=1.0, max_polls=None):
+        '''
+        Polls for files until interrupted (or max_polls polls), flushing
+        every flush_interval seconds. The open partition is flushed, not
+        sealed, on exit so the next run continues it
+        '''
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                for file in self.stable_files():
+                    self.ingest(file)
+                    logging.info(f'Ingested {file}')
+                if (self._dirty and time.time() - self._last_flush
+                        >= self.flush_interval):
+                    self.flush()
+                polls += 1
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            logging.info('Stopping watch')
+        finally:
+            if self._dirty:
+                self.flush()
+
+
+def read_aggregates(path, level=None):
+    '''
+    Reads the rolling aggregates flushed by a CauserPaysWatcher
+
+    Args:
+        path (str or path): watched directory
+        level (str, optional): only return this level, e.g. 'Area'
+
+    Returns:
+        DataFrame of aggregates
+    '''
+    filters = [('level', '=', level)] if level else None
+    return pd.read_parquet(os.path.join(path, aggregates_name),
+                           filters=filters)
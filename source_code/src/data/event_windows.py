@@ -0,0 +1,199 @@
+import numpy as _np
+import pandas as _pd
+import pyarrow.parquet as _pq
+
+from src.data import merge_mappings as _merge_mappings
+from src.data.causer_pays_store import row_group_index as _row_group_index
+
+_dispatch_time_fmt = '%Y/%m/%d %H:%M:%S'
+
+
+def _parse_windows(windows):
+    '''
+    Returns window starts and ends as datetime64 arrays
+    '''
+    if not len(windows):
+        raise ValueError('No event windows provided')
+    starts = _pd.to_datetime([w[0] for w in windows]).values
+    ends = _pd.to_datetime([w[1] for w in windows]).values
+    if (ends < starts).any():
+        raise ValueError('Event windows must have start <= end')
+    return starts, ends
+
+
+def _to_datetime(values, fmt):
+    if fmt is None:
+        return _pd.to_datetime(values)
+    return _pd.to_datetime(values, format=fmt)
+
+
+def _scan_windows(index, windows, time_col, read_row_group, time_fmt=None):
+    '''
+    Reads each row group overlapping any window once, in time order, and
+    slices every overlapping window out of it
+
+    Args:
+        index (pandas DataFrame): row_group_index with {time_col}_min/_max
+        windows (tuple): (starts, ends) from _parse_windows
+        time_col (str): timestamp column
+        read_row_group (callable): (path, row_group) -> DataFrame
+        time_fmt (str, optional): format of string timestamps
+
+    Returns:
+        List of lists of DataFrame pieces, one list per window
+    '''
+    starts, ends = windows
+    pieces = [[] for _ in starts]
+    lo = _to_datetime(index[f'{time_col}_min'], time_fmt).values
+    hi = _to_datetime(index[f'{time_col}_max'], time_fmt).values
+    # row groups without statistics cannot be skipped
+    no_stats = _pd.isna(lo) | _pd.isna(hi)
+    overlaps = no_stats[:, None] | ((starts[None, :] <= hi[:, None])
+                                    & (ends[None, :] >= lo[:, None]))
+    needed = _np.flatnonzero(overlaps.any(axis=1))
+    needed = needed[_np.argsort(lo[needed], kind='mergesort')]
+
+    for i in needed:
+        df = read_row_group(index['path'].iat[i], index['row_group'].iat[i])
+        df = df.assign(**{time_col: _to_datetime(df[time_col], time_fmt)})
+        times = df[time_col].values
+        order = _np.argsort(times, kind='mergesort')
+        sorted_times = times[order]
+        for w in _np.flatnonzero(overlaps[i]):
+            a = _np.searchsorted(sorted_times, starts[w], side='left')
+            b = _np.searchsorted(sorted_times, ends[w], side='right')
+            if b > a:
+                pieces[w].append(df.iloc[_np.sort(order[a:b])])
+    return pieces
+
+
+def _row_group_reader(columns=None):
+    '''
+    Returns a (path, row_group) reader that keeps parquet files open
+    '''
+    files = {}
+
+    def read(path, row_group):
+        if path not in files:
+            files[path] = _pq.ParquetFile(path)
+        return files[path].read_row_group(row_group, columns=columns,
+                                          use_pandas_metadata=True
+                                          ).to_pandas()
+    return read
+
+
+def _assemble(pieces, template, time_col):
+    '''
+    Concatenates the pieces of each window into one frame with an 'event'
+    column giving the window's position
+    '''
+    frames = []
+    for event, event_pieces in enumerate(pieces):
+        df = (_pd.concat(event_pieces) if event_pieces
+              else template.iloc[:0].copy())
+        df = df.sort_values(time_col, kind='mergesort')
+        df.insert(0, 'event', event)
+        frames.append(df)
+    return _pd.concat(frames, ignore_index=True)
+
+
+def _split_events(df, n_events):
+    groups = dict(tuple(df.groupby('event', sort=True)))
+    return [groups.get(event, df.iloc[:0]).reset_index(drop=True)
+            for event in range(n_events)]
+
+
+def extract_dispatchload_events(paths, windows, gen_loads, fcas,
+                                columns=None):
+    '''
+    Extracts several event windows from monthly DISPATCHLOAD parquet files
+    in a single pass. Row groups are skipped using the statistics of the
+    SETTLEMENTDATE strings, and each row group that is read is sliced for
+    every window it overlaps
+
+    Args:
+        paths (list): DISPATCHLOAD parquet files as compiled by NEMOSIS
+        windows (list): (start, end) tuples. Bounds are inclusive
+        gen_loads (pandas DataFrame): Generators and Scheduled Loads df, as
+                                      for merge_duid_mappings
+        fcas (""): Unique FCAS providers df
+        columns (list, optional): DISPATCHLOAD columns to read. SETTLEMENTDATE
+                                  and DUID are always read
+
+    Returns:
+        List of DataFrames, one per window in the order given, with
+        SETTLEMENTDATE as datetime, an 'event' column and DUID identifiers
+        merged in
+    '''
+    time_col = 'SETTLEMENTDATE'
+    parsed = _parse_windows(windows)
+    if columns is not None:
+        columns = list(columns) + [c for c in (time_col, 'DUID')
+                                   if c not in columns]
+    index = _row_group_index(list(paths), cols=[time_col])
+    read = _row_group_reader(columns)
+    pieces = _scan_windows(index, parsed, time_col, read,
+                           time_fmt=_dispatch_time_fmt)
+
+    template = _pq.read_schema(paths[0]).empty_table().to_pandas()
+    if columns is not None:
+        template = template[columns]
+    df = _assemble(pieces, template, time_col)
+    df = _merge_mappings.merge_duid_mappings(df, gen_loads, fcas)
+    return _split_events(df, len(windows))
+
+
+def extract_causer_pays_events(store, windows, variables=None, elements=None,
+                               columns=None, mappings=None):
+    '''
+    Extracts several event windows from a CauserPaysStore in a single pass.
+    Row groups are pruned on datetime, variable and element statistics
+
+    Args:
+        store (CauserPaysStore): chunk store
+        windows (list): (start, end) tuples. Bounds are inclusive
+        variables (list, optional): variable numbers to return
+        elements (list, optional): element numbers to return
+        columns (list, optional): data columns to read
+        mappings (dict, optional): merge_causpays_mappings kwargs
+                                   (elements, variables, ems_duid,
+                                   gen_loads or ems_duid_versions). If
+                                   given, mappings are merged in
+
+    Returns:
+        List of DataFrames, one per window in the order given, with
+        datetime as a column and an 'event' column
+    '''
+    time_col = 'datetime'
+    parsed = _parse_windows(windows)
+    index = store.row_groups(start=parsed[0].min(), end=parsed[1].max(),
+                             variables=variables, elements=elements)
+    read_cols = None
+    if columns is not None:
+        read_cols = list(columns) + [c for c in (time_col, 'variablenumber',
+                                                 'elementnumber')
+                                     if c not in columns]
+    read = _row_group_reader(read_cols)
+
+    def read_filtered(path, row_group):
+        df = read(path, row_group).reset_index()
+        mask = _np.ones(len(df), dtype=bool)
+        if variables is not None:
+            mask &= df['variablenumber'].isin(variables).values
+        if elements is not None:
+            mask &= df['elementnumber'].isin(elements).values
+        return df[mask]
+
+    pieces = _scan_windows(index, parsed, time_col, read_filtered)
+    if not len(store.index):
+        raise ValueError(f'No parquet chunks in {store.path}')
+    template = _pq.read_schema(store.index['path'].iat[0]).empty_table()
+    template = template.to_pandas().reset_index()
+    if read_cols is not None:
+        template = template[read_cols]
+    df = _assemble(pieces, template, time_col)
+    if columns is not None:
+        df = df[['event', time_col] + [c for c in columns if c != time_col]]
+    if mappings is not None:
+        df = _merge_mappings.merge_causpays_mappings(df, **mappings)
+    return _split_events(df, len(windows))
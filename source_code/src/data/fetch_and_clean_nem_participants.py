@@ -1,9 +1,9 @@
 import argparse as _argparse
 import logging as _logging
+import os as _os
 
 from src.data import nem_participants as _nem_p
-from src.data.nem_participants import _dummy_start
-from src.data.nem_participants import _dummy_end
+from src.data import static_fetch as _static_fetch
 
 
 def create_parser():
@@ -13,6 +13,11 @@ def create_parser():
                         help='path to save fetched raw files')
     parser.add_argument('-proc_path', type=str, required=True,
                         help='path to save cleaned files')
+    parser.add_argument('-cache_dir', type=str,
+                        default=_static_fetch.default_cache_dir,
+                        help=('download cache. An unchanged Registration and '
+                              + 'Exemption List is not downloaded or '
+                              + 'reprocessed'))
     args = parser.parse_args()
     return args
 
@@ -24,9 +29,24 @@ args = create_parser()
 raw_path = args.raw_path
 proc_path = args.proc_path
 gen_loads_outname = 'cleaned_gen_loads.csv'
-# fetch raw generators and loads and clean, then save to processed path
-raw_gen_loads = _nem_p.fetch_gen_scheduled_loads(raw_path, raw_path,
-                                                 _dummy_start, _dummy_end)
+nemosis_table = 'Generators and Scheduled Loads'
+outputs = [_os.path.join(proc_path, gen_loads_outname),
+           _os.path.join(proc_path, 'unique_fcas_providers.csv')]
+
+cache = _static_fetch.DownloadCache(args.cache_dir)
+xls, changed = _static_fetch.fetch_static_tables([nemosis_table],
+                                                 cache)[nemosis_table]
+# fetch_ancillary_service_providers reads the workbook from raw_path
+_static_fetch.materialise(xls, _os.path.join(
+    raw_path, 'NEM Registration and Exemption List.xls'), changed)
+if not changed and all(_os.path.exists(f) for f in outputs):
+    _logging.info('Registration and Exemption List unchanged, skipping')
+    raise SystemExit
+
+# read raw generators and loads and clean, then save to processed path
+raw_gen_loads = _static_fetch.read_static_table(nemosis_table, xls)
+raw_gen_loads.to_csv(_os.path.join(raw_path, 'generators_and_loads.csv'),
+                     index=False)
 cleaned_tech = _nem_p.clean_gen_loads_tech(df=raw_gen_loads)
 clean_tech_cap = _nem_p.clean_gen_loads_capacities(df=cleaned_tech,
                                                    table_loc=proc_path,
@@ -1,11 +1,8 @@
 import argparse as _argparse
 import logging as _logging
 import os as _os
-import pandas as _pd
-from shutil import rmtree as _rmtree
 
-from src.data.nem_participants import _dummy_start, _dummy_end
-from nemosis.data_fetch_methods import static_table as _static_fetch
+from src.data import static_fetch as _static_fetch
 
 
 def create_parser():
@@ -13,6 +10,10 @@ def create_parser():
     parser = _argparse.ArgumentParser(description=description)
     parser.add_argument('-path', type=str, required=True,
                         help='path to save fetched raw files')
+    parser.add_argument('-cache_dir', type=str,
+                        default=_static_fetch.default_cache_dir,
+                        help=('download cache. Unchanged tables are not '
+                              + 'downloaded or rewritten'))
     args = parser.parse_args()
     return args
 
@@ -21,21 +22,17 @@ _logging.basicConfig(format='\n%(levelname)s:%(message)s',
                      level=_logging.INFO)
 args = create_parser()
 raw_loc = args.path
-tmp_dir = _os.path.join(raw_loc, 'tmp')
-
-_os.mkdir(tmp_dir)
-elements = _static_fetch(start_time=_dummy_start, end_time=_dummy_end,
-                         table_name='ELEMENTS_FCAS_4_SECOND',
-                         raw_data_location=tmp_dir)
-
-variables = _static_fetch(start_time=_dummy_start, end_time=_dummy_end,
-                          table_name='VARIABLES_FCAS_4_SECOND',
-                          raw_data_location=tmp_dir)
-
-elements.to_csv(_os.path.join(raw_loc, 'elements_causpays_mapping.csv'),
-                index=False)
-variables.to_csv(_os.path.join(raw_loc, 'variables_causpays_mapping.csv'),
-                 index=False)
-_rmtree(tmp_dir)
+outnames = {'ELEMENTS_FCAS_4_SECOND': 'elements_causpays_mapping.csv',
+            'VARIABLES_FCAS_4_SECOND': 'variables_causpays_mapping.csv'}
+
+cache = _static_fetch.DownloadCache(args.cache_dir)
+fetched = _static_fetch.fetch_static_tables(list(outnames), cache)
+for table, (path, changed) in fetched.items():
+    outpath = _os.path.join(raw_loc, outnames[table])
+    if not changed and _os.path.exists(outpath):
+        _logging.info(f'{table} unchanged, skipping')
+        continue
+    df = _static_fetch.read_static_table(table, path)
+    df.to_csv(outpath, index=False)
 
 _logging.info(f'FCAS mappings in {raw_loc}')
@@ -0,0 +1,174 @@
+import hashlib as _hashlib
+import logging as _logging
+import os as _os
+import tempfile as _tempfile
+
+import pandas as _pd
+import pyarrow as _pa
+
+default_cache_dir = _os.path.join(_os.path.expanduser('~'), '.cache',
+                                  'nem-data-analysis', 'hot')
+_suffix = '.arrow'
+
+
+def make_key(*parts):
+    '''
+    Hashes the repr of parts (paths, query bounds, filters...) to a key
+
+    Returns:
+        str key usable as a file name
+    '''
+    return _hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+class HotCache:
+    '''
+    Local cache of recently used data windows stored as uncompressed Arrow
+    IPC (Feather v2) files. Reads memory-map the file, so reopening a window
+    costs no decompression or parsing, and kernels on the same machine
+    share the pages through the OS page cache. Files are evicted least
+    recently used first when the cache exceeds its disk budget.
+
+    Args:
+        cache_dir (str or path, optional): cache directory. Defaults to
+                                           ~/.cache/nem-data-analysis/hot
+        budget_mb (float, optional): disk budget in MB
+    '''
+
+    def __init__(self, cache_dir=default_cache_dir, budget_mb=4096):
+        self.cache_dir = cache_dir
+        self.budget_mb = budget_mb
+        _os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return _os.path.join(self.cache_dir, key + _suffix)
+
+    def get_table(self, key):
+        '''
+        Memory-maps a cached window. Buffers of the returned table point
+        into the mapped file, so nothing is read until it is used
+
+        Returns:
+            Arrow table, or None if key is not cached
+        '''
+        path = self._path(key)
+        try:
+            source = _pa.memory_map(path, 'r')
+        except (FileNotFoundError, OSError):
+            return None
+        # mtime records last use for LRU eviction
+        _os.utime(path)
+        return _pa.ipc.open_file(source).read_all()
+
+    def get(self, key):
+        '''
+        Returns a cached window as a DataFrame, or None if not cached.
+        Columns without nulls convert without copying where pandas allows
+        '''
+        table = self.get_table(key)
+        if table is None:
+            return None
+        return table.to_pandas(split_blocks=True)
+
+    def put(self, key, data):
+        '''
+        Writes a DataFrame (index preserved) or Arrow table to the cache.
+        Files are written to a temporary name and renamed, so concurrent
+        readers never see a partial file
+
+        Returns:
+            Path of the cached file
+        '''
+        if isinstance(data, _pd.DataFrame):
+            table = _pa.Table.from_pandas(data)
+        else:
+            table = data
+        fd, tmp_path = _tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with _os.fdopen(fd, 'wb') as sink:
+                with _pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            path = self._path(key)
+            _os.replace(tmp_path, path)
+        except BaseException:
+            _os.remove(tmp_path)
+            raise
+        self.evict(keep=path)
+        return path
+
+    def cached(self, key, loader):
+        '''
+        Returns the cached window for key, or calls loader, caches and
+        returns its result
+
+        Args:
+            key (str): cache key, see make_key
+            loader (callable): returns a DataFrame when called
+        '''
+        df = self.get(key)
+        if df is None:
+            df = loader()
+            self.put(key, df)
+        return df
+
+    def _entries(self):
+        entries = []
+        for f in _os.listdir(self.cache_dir):
+            if not f.endswith(_suffix):
+                continue
+            path = _os.path.join(self.cache_dir, f)
+            try:
+                stat = _os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size_mb(self):
+        return sum(e[1] for e in self._entries()) / 1e6
+
+    def evict(self, keep=None):
+        '''
+        Removes least recently used files until the cache is within budget.
+        Kernels that have a removed file mapped keep their mapping (POSIX)
+        '''
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        budget = self.budget_mb * 1e6
+        for _, size, path in entries:
+            if total <= budget:
+                break
+            if path == keep:
+                continue
+            try:
+                _os.remove(path)
+                total -= size
+            except OSError as e:
+                # e.g. file still mapped on Windows
+                _logging.warning(f'Could not evict {path}: {e}')
+
+    def clear(self):
+        for _, _, path in self._entries():
+            _os.remove(path)
+
+
+def cached_read_parquet(path, cache, columns=None, filters=None):
+    '''
+    pd.read_parquet through a HotCache. The key includes the file's size and
+    modification time, so rewritten files are read again
+
+    Args:
+        path (str or path): parquet file, e.g. a month of DISPATCHLOAD
+        cache (HotCache): cache to use
+        columns (list, optional): columns to read
+        filters (list, optional): pyarrow filters, e.g.
+                                  [('DUID', 'in', ['BW01', 'BW02'])]
+
+    Returns:
+        DataFrame
+    '''
+    stat = _os.stat(path)
+    key = make_key(_os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                   columns, filters)
+    return cache.cached(key, lambda: _pd.read_parquet(path, columns=columns,
+                                                      filters=filters))
@@ -0,0 +1,269 @@
+import datetime as _datetime
+import functools as _functools
+import json as _json
+import os as _os
+import sys as _sys
+import time as _time
+import tracemalloc as _tracemalloc
+
+try:
+    import resource as _resource
+except ImportError:
+    # not available on Windows
+    _resource = None
+
+_state = {'enabled': False, 'trace_memory': False, 'started': None,
+          'records': [], 'stack': []}
+
+
+def enable(trace_memory=False):
+    '''
+    Turns on stage instrumentation and clears previous records
+
+    Args:
+        trace_memory (bool, optional): also track Python heap peaks with
+                                       tracemalloc. Slows allocation heavy
+                                       code, so off by default
+    '''
+    reset()
+    _state['enabled'] = True
+    _state['trace_memory'] = trace_memory
+    _state['started'] = _datetime.datetime.now().isoformat(timespec='seconds')
+    if trace_memory and not _tracemalloc.is_tracing():
+        _tracemalloc.start()
+
+
+def disable():
+    if _state['trace_memory'] and _tracemalloc.is_tracing():
+        _tracemalloc.stop()
+    _state['enabled'] = False
+    _state['trace_memory'] = False
+
+
+def is_enabled():
+    return _state['enabled']
+
+
+def reset():
+    _state['records'] = []
+    _state['stack'] = []
+
+
+_statm = '/proc/self/statm'
+_page_size = (_os.sysconf('SC_PAGE_SIZE') if hasattr(_os, 'sysconf')
+              else None)
+
+
+def _peak_rss_mb():
+    '''
+    Peak resident set size of the process so far, in MB
+    '''
+    if _resource is None:
+        return None
+    peak = _resource.getrusage(_resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB on Linux
+    if _sys.platform == 'darwin':
+        return peak / 1e6
+    return peak * 1024 / 1e6
+
+
+def _rss_mb():
+    '''
+    Current resident set size of the process in MB, or None where
+    /proc/self/statm is not available
+    '''
+    try:
+        with open(_statm) as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * _page_size / 1e6
+
+
+def _fold_rss():
+    '''
+    Samples current RSS into all open stages. Called as stages open and
+    close, so a stage's peak covers the boundaries of its nested stages
+    '''
+    rss = _rss_mb()
+    if rss is None:
+        return None
+    for open_stage in _state['stack']:
+        open_stage.rss_peak = max(open_stage.rss_peak or 0, rss)
+    return rss
+
+
+def _fold_traced_peak():
+    '''
+    Attributes the tracemalloc peak since the last fold to all open stages,
+    then resets the peak (Python 3.9+) so nested stages are measured alone
+    '''
+    if not _state['trace_memory'] or not _tracemalloc.is_tracing():
+        return
+    peak = _tracemalloc.get_traced_memory()[1]
+    for open_stage in _state['stack']:
+        open_stage.traced_peak = max(open_stage.traced_peak, peak)
+    if hasattr(_tracemalloc, 'reset_peak'):
+        _tracemalloc.reset_peak()
+
+
+class _NullStage:
+    '''
+    Returned by stage when instrumentation is disabled. Does nothing
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, rows=0, bytes_read=0, bytes_written=0):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+class _Stage:
+    '''
+    Records wall time, counters and memory of a pipeline stage. Memory is
+    the change in resident set size over the stage and the largest RSS
+    seen within it, sampled as it and its nested stages open and close
+    (and the process peak if the stage raised it), rather than the
+    process' peak so far
+    '''
+
+    def __init__(self, name, rows=0, bytes_read=0, bytes_written=0):
+        self.name = name
+        self.rows = rows
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+        self.traced_peak = 0
+        self.rss_peak = None
+
+    def add(self, rows=0, bytes_read=0, bytes_written=0):
+        self.rows += rows
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+    def __enter__(self):
+        _fold_traced_peak()
+        _state['stack'].append(self)
+        self._rss_start = _fold_rss()
+        self._process_peak = _peak_rss_mb()
+        self._start = _time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = _time.perf_counter() - self._start
+        _fold_traced_peak()
+        rss_end = _fold_rss()
+        process_peak = _peak_rss_mb()
+        # a process high-water mark set during the stage was set by it
+        if (process_peak is not None and self.rss_peak is not None
+                and process_peak > self._process_peak):
+            self.rss_peak = max(self.rss_peak, process_peak)
+        _state['stack'].remove(self)
+        _state['records'].append({
+            'stage': self.name, 'wall_s': wall, 'rows': self.rows,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'rss_delta_mb': (rss_end - self._rss_start
+                             if rss_end is not None else None),
+            'rss_peak_mb': self.rss_peak,
+            'traced_peak_mb': (self.traced_peak / 1e6
+                               if _state['trace_memory'] else None)
+        })
+        return False
+
+
+def stage(name, rows=0, bytes_read=0, bytes_written=0):
+    '''
+    Context manager timing a pipeline stage. Counters can be given up front
+    or added within the block through the returned object's add method.
+    When instrumentation is disabled a shared no-op object is returned
+
+    Args:
+        name (str): stage name. Repeated stages are summed in the report
+        rows (int, optional): rows processed
+        bytes_read, bytes_written (int, optional): bytes of I/O
+
+    Returns:
+        Stage context manager
+    '''
+    if not _state['enabled']:
+        return _null_stage
+    return _Stage(name, rows, bytes_read, bytes_written)
+
+
+def instrumented(name=None):
+    '''
+    Decorator recording each call of a function as a stage. If the function
+    returns something with a length (e.g. a DataFrame), it is used as rows
+
+    Args:
+        name (str, optional): stage name. Defaults to module.function
+    '''
+    def decorator(func):
+        stage_name = name or f'{func.__module__}.{func.__name__}'
+
+        @_functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return func(*args, **kwargs)
+            with _Stage(stage_name) as s:
+                result = func(*args, **kwargs)
+                try:
+                    s.add(rows=len(result))
+                except TypeError:
+                    pass
+            return result
+        return wrapper
+    return decorator
+
+
+def report():
+    '''
+    Summarises recorded stages. Stages are listed in order of first entry
+
+    Returns:
+        dict with run metadata, the process' peak RSS and per-stage totals
+    '''
+    stages = {}
+    for record in _state['records']:
+        summary = stages.setdefault(record['stage'], {
+            'calls': 0, 'wall_s': 0.0, 'rows': 0, 'bytes_read': 0,
+            'bytes_written': 0, 'rss_delta_mb': None, 'rss_peak_mb': None,
+            'traced_peak_mb': None
+        })
+        summary['calls'] += 1
+        for counter in ('wall_s', 'rows', 'bytes_read', 'bytes_written'):
+            summary[counter] += record[counter]
+        # largest of each call, e.g. the most a single chunk write grew RSS
+        for peak in ('rss_delta_mb', 'rss_peak_mb', 'traced_peak_mb'):
+            if record[peak] is not None:
+                summary[peak] = (record[peak] if summary[peak] is None
+                                 else max(summary[peak], record[peak]))
+    for summary in stages.values():
+        wall = summary['wall_s']
+        summary['rows_per_s'] = summary['rows'] / wall if wall else None
+    return {'started': _state['started'],
+            'trace_memory': _state['trace_memory'],
+            'process_peak_rss_mb': _peak_rss_mb(),
+            'stages': stages}
+
+
+def write_report(path):
+    '''
+    Writes report() to path as JSON
+
+    Args:
+        path (str or path): JSON file to write
+    '''
+    directory = _os.path.dirname(path)
+    if directory:
+        _os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        _json.dump(report(), f, indent=2)
+    return path
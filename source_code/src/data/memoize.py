@@ -0,0 +1,412 @@
+import functools as _functools
+import hashlib as _hashlib
+import inspect as _inspect
+import json as _json
+import logging as _logging
+import os as _os
+import tempfile as _tempfile
+import time as _time
+
+import numpy as _np
+import pandas as _pd
+import pyarrow as _pa
+import pyarrow.parquet as _pq
+
+default_cache_dir = _os.path.join(_os.path.expanduser('~'), '.cache',
+                                  'nem-data-analysis', 'memo')
+_suffix = '.parquet'
+_meta_key = b'memoize'
+_state = {'cache': None, 'stats': {}, 'depth': 0}
+# content digests of files, keyed by (path, size, mtime)
+_file_digests = {}
+
+
+class MemoCache:
+    '''
+    Directory of memoized results stored as parquet files named by the
+    fingerprint of the call that produced them. Files are evicted least
+    recently used first when the cache exceeds its disk budget.
+
+    Args:
+        cache_dir (str or path, optional): cache directory. Defaults to
+                                           ~/.cache/nem-data-analysis/memo
+        budget_mb (float, optional): disk budget in MB
+    '''
+
+    def __init__(self, cache_dir=default_cache_dir, budget_mb=2048):
+        self.cache_dir = cache_dir
+        self.budget_mb = budget_mb
+        _os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return _os.path.join(self.cache_dir, key + _suffix)
+
+    def get(self, key):
+        '''
+        Returns (result, metadata) for key, or (None, None) if not cached
+        '''
+        path = self._path(key)
+        try:
+            table = _pq.read_table(path)
+        except (FileNotFoundError, OSError, _pa.ArrowInvalid):
+            return None, None
+        # mtime records last use for LRU eviction
+        _os.utime(path)
+        meta = _json.loads(table.schema.metadata[_meta_key])
+        result = _restore_nans(table.to_pandas(), meta)
+        if meta['kind'] == 'series':
+            result = result.iloc[:, 0].rename(meta['name'])
+        return result, meta
+
+    def put(self, key, result, meta):
+        '''
+        Writes a DataFrame or Series result. Files are written to a
+        temporary name and renamed, so concurrent kernels never read a
+        partial file. Results that would not read back identically,
+        dtypes and missing values included, are not stored
+
+        Returns:
+            Path of the cached file, or None if the result can not be
+            stored as parquet
+        '''
+        meta = dict(meta)
+        if isinstance(result, _pd.Series):
+            meta.update(kind='series', name=result.name)
+            result = result.to_frame('value')
+        else:
+            meta['kind'] = 'frame'
+        meta['nan_columns'] = [i for i, kinds in enumerate(_null_kinds(result))
+                               if kinds == ['float']]
+        try:
+            table = _pa.Table.from_pandas(result)
+        except (_pa.ArrowException, TypeError, ValueError) as e:
+            _logging.warning(f'Result of {meta["function"]} not cached: {e}')
+            return None
+        if not _same_frame(result, _restore_nans(table.to_pandas(), meta)):
+            _logging.warning(f'Result of {meta["function"]} not cached: it'
+                             + ' does not survive a parquet round trip')
+            return None
+        metadata = dict(table.schema.metadata or {})
+        metadata[_meta_key] = _json.dumps(meta, default=str).encode()
+        fd, tmp_path = _tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        _os.close(fd)
+        try:
+            _pq.write_table(table.replace_schema_metadata(metadata), tmp_path)
+            path = self._path(key)
+            _os.replace(tmp_path, path)
+        except BaseException:
+            _os.remove(tmp_path)
+            raise
+        self.evict(keep=path)
+        return path
+
+    def _entries(self):
+        entries = []
+        for f in _os.listdir(self.cache_dir):
+            if not f.endswith(_suffix):
+                continue
+            path = _os.path.join(self.cache_dir, f)
+            try:
+                stat = _os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size_mb(self):
+        return sum(e[1] for e in self._entries()) / 1e6
+
+    def evict(self, keep=None):
+        '''
+        Removes least recently used files until the cache is within budget
+        '''
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        budget = self.budget_mb * 1e6
+        for _, size, path in entries:
+            if total <= budget:
+                break
+            if path == keep:
+                continue
+            try:
+                _os.remove(path)
+                total -= size
+            except OSError as e:
+                _logging.warning(f'Could not evict {path}: {e}')
+
+    def clear(self):
+        for _, _, path in self._entries():
+            _os.remove(path)
+
+
+def _null_kinds(df):
+    '''
+    Type names of the missing values (NaN, None, NaT) in each object column
+    of df, as parquet reads all of them back as None
+    '''
+    kinds = []
+    for i in range(df.shape[1]):
+        col = df.iloc[:, i]
+        if col.dtype != object:
+            kinds.append([])
+            continue
+        kinds.append(sorted({type(v).__name__ for v in col[col.isna()]}))
+    return kinds
+
+
+def _restore_nans(df, meta):
+    '''
+    Puts back NaN in object columns that held NaN rather than None
+    '''
+    for i in meta.get('nan_columns', []):
+        col = df.iloc[:, i]
+        df.iloc[:, i] = col.where(col.notna(), _np.nan)
+    return df
+
+
+def _same_frame(a, b):
+    return (list(a.dtypes) == list(b.dtypes)
+            and a.index.dtype == b.index.dtype
+            and list(a.index.names) == list(b.index.names)
+            and a.equals(b) and _null_kinds(a) == _null_kinds(b))
+
+
+def enable(cache_dir=default_cache_dir, budget_mb=2048):
+    '''
+    Turns on memoization of decorated functions and clears hit and miss
+    counts. Results are kept between kernel restarts in cache_dir
+
+    Args:
+        cache_dir (str or path, optional): cache directory
+        budget_mb (float, optional): disk budget in MB
+    '''
+    reset()
+    _state['cache'] = MemoCache(cache_dir, budget_mb)
+
+
+def disable():
+    _state['cache'] = None
+
+
+def is_enabled():
+    return _state['cache'] is not None
+
+
+def reset():
+    _state['stats'] = {}
+
+
+def stats():
+    '''
+    Hit and miss counts of each memoized function since enable
+
+    Returns:
+        DataFrame with function, hits, misses, uncached (calls that
+        bypassed the cache or returned something that is not a frame),
+        saved_s (compute time of the original calls that hits replaced) and
+        hit_s (time spent reading hits)
+    '''
+    cols = ['function', 'hits', 'misses', 'uncached', 'saved_s', 'hit_s']
+    return _pd.DataFrame([dict(function=f, **s)
+                          for f, s in _state['stats'].items()], columns=cols)
+
+
+def _digest_file(path):
+    stat = _os.stat(path)
+    key = (_os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        sha = _hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        _file_digests[key] = sha.hexdigest()
+    return _file_digests[key]
+
+
+def _digest_dir(path):
+    '''
+    Directories (e.g. a chunk store) are fingerprinted by the size and
+    modification time of their files rather than their contents
+    '''
+    listing = []
+    for root, _, files in _os.walk(path):
+        for f in sorted(files):
+            stat = _os.stat(_os.path.join(root, f))
+            listing.append((_os.path.relpath(_os.path.join(root, f), path),
+                            stat.st_size, stat.st_mtime_ns))
+    return sorted(listing)
+
+
+def _update(sha, obj):
+    '''
+    Feeds a canonical representation of obj into sha. Frames are hashed by
+    value with hash_pandas_object, paths of existing files by content and
+    Dask collections by their token
+    '''
+    if isinstance(obj, (_pd.DataFrame, _pd.Series, _pd.Index)):
+        dtypes = (obj.dtypes.tolist() if isinstance(obj, _pd.DataFrame)
+                  else [obj.dtype])
+        sha.update(repr((type(obj).__name__, obj.shape,
+                         list(getattr(obj, 'columns', [])),
+                         getattr(obj, 'name', None), [str(d) for d in dtypes],
+                         getattr(obj, 'index', obj).names)).encode())
+        sha.update(_pd.util.hash_pandas_object(obj, index=True).values
+                   .tobytes())
+    elif isinstance(obj, _np.ndarray):
+        sha.update(repr((obj.dtype.str, obj.shape)).encode())
+        sha.update(_np.ascontiguousarray(obj).tobytes()
+                   if obj.dtype != object else repr(obj.tolist()).encode())
+    elif isinstance(obj, (str, _os.PathLike)) and _os.path.isfile(obj):
+        sha.update(f'file:{_digest_file(obj)}'.encode())
+    elif isinstance(obj, (str, _os.PathLike)) and _os.path.isdir(obj):
+        sha.update(f'dir:{_digest_dir(obj)}'.encode())
+    elif isinstance(obj, (list, tuple)):
+        sha.update(f'{type(obj).__name__}:{len(obj)}'.encode())
+        for o in obj:
+            _update(sha, o)
+    elif isinstance(obj, dict):
+        sha.update(f'dict:{len(obj)}'.encode())
+        for k in sorted(obj, key=repr):
+            _update(sha, k)
+            _update(sha, obj[k])
+    elif _is_dask(obj):
+        from dask.base import tokenize
+        sha.update(f'dask:{tokenize(obj)}'.encode())
+    else:
+        sha.update(repr(obj).encode())
+
+
+def _is_dask(obj):
+    try:
+        import dask
+    except ImportError:
+        return False
+    return dask.is_dask_collection(obj)
+
+
+def _source(func):
+    try:
+        return _inspect.getsource(func)
+    except (OSError, TypeError):
+        # e.g. defined in an exec'd string
+        code = func.__code__
+        return repr((code.co_code, code.co_consts))
+
+
+def _code_digest(func):
+    '''
+    Digest of the source of func's whole module, so edits to helpers it
+    calls in the same module change it too. Falls back to func's own
+    source if the module is not a file
+    '''
+    module = _inspect.getmodule(func)
+    path = getattr(module, '__file__', None)
+    if path and path.endswith('.py') and _os.path.isfile(path):
+        return f'module:{_digest_file(path)}'
+    return f'source:{_source(func)}'
+
+
+def fingerprint(func, bound_args, version=None):
+    '''
+    Hashes a function's name, the source of its module and a version salt
+    with its bound arguments
+
+    Args:
+        func (callable): the undecorated function
+        bound_args (dict): argument name to value, defaults applied
+        version (str, optional): salt to bump when code the function
+                                 depends on in other modules changes
+
+    Returns:
+        str digest usable as a file name
+    '''
+    sha = _hashlib.sha1()
+    sha.update(f'{func.__module__}.{func.__qualname__}'.encode())
+    sha.update(_code_digest(func).encode())
+    sha.update(repr(version).encode())
+    for name in sorted(bound_args):
+        sha.update(name.encode())
+        _update(sha, bound_args[name])
+    return sha.hexdigest()
+
+
+def memoized(name=None, bypass=(), ignore=(), version=None):
+    '''
+    Decorator caching a function's DataFrame or Series results on disk
+    while memoization is enabled (see enable). Calls are keyed on a
+    fingerprint of the source of the function's module and its arguments,
+    so a call with identical frames, file contents and arguments returns
+    the stored result, and edits to the module or changed inputs miss.
+    Only decorate functions whose result depends on nothing but their
+    arguments and that do not modify them, as a hit skips the call.
+
+    Code in other modules, including memoized functions there (nested
+    calls run uncached and are covered by the caller's result), is not
+    part of the fingerprint. Bump version when such code changes, or
+    clear the cache.
+
+    Args:
+        name (str, optional): name in stats. Defaults to module.function
+        bypass (tuple, optional): arguments that, if truthy, skip the cache,
+                                  e.g. table_loc of functions that write
+                                  files as a side effect
+        ignore (tuple, optional): arguments left out of the fingerprint
+        version (str, optional): salt added to the fingerprint
+    '''
+    def decorator(func):
+        func_name = name or f'{func.__module__}.{func.__name__}'
+        signature = _inspect.signature(func)
+
+        @_functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = _state['cache']
+            # calls made by a memoized function are covered by its result
+            if cache is None or _state['depth']:
+                return func(*args, **kwargs)
+            counts = _state['stats'].setdefault(func_name, {
+                'hits': 0, 'misses': 0, 'uncached': 0, 'saved_s': 0.0,
+                'hit_s': 0.0})
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            if any(arguments.get(b) for b in bypass):
+                counts['uncached'] += 1
+                return func(*args, **kwargs)
+            for i in ignore:
+                arguments.pop(i, None)
+            key = fingerprint(func, arguments, version)
+
+            start = _time.perf_counter()
+            result, meta = cache.get(key)
+            if meta is not None:
+                counts['hits'] += 1
+                counts['hit_s'] += _time.perf_counter() - start
+                counts['saved_s'] += meta['compute_s']
+                _logging.info(f'memoize hit {func_name}')
+                return result
+
+            start = _time.perf_counter()
+            _state['depth'] += 1
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                _state['depth'] -= 1
+            compute_s = _time.perf_counter() - start
+            if (isinstance(result, (_pd.DataFrame, _pd.Series))
+                    and cache.put(key, result, {'function': func_name,
+                                                'compute_s': compute_s})):
+                counts['misses'] += 1
+                _logging.info(f'memoize miss {func_name}')
+            else:
+                counts['uncached'] += 1
+            return result
+        return wrapper
+    return decorator
+
+
+def cached_call(func, *args, **kwargs):
+    '''
+    Calls func through the cache without decorating it, e.g. a notebook
+    function wrapping a Dask groupby and compute
+    '''
+    return memoized()(func)(*args, **kwargs)
@@ -1,7 +1,15 @@
 import numpy as _np
 import pandas as _pd
 
+from src.data.instrumentation import instrumented as _instrumented
+from src.data.memoize import memoized as _memoized
 
+area_region_map = {'NSW1': 'Mainland', 'SA1': 'Mainland', 'VIC1': 'Mainland',
+                   'QLD1': 'Mainland', 'TAS1': 'Tasmania'}
+
+
+@_instrumented()
+@_memoized()
 def merge_duid_mappings(df, gen_loads, fcas):
     '''
     Provided a DataFrame that has DUID as an identifier,
@@ -31,8 +39,102 @@ def merge_duid_mappings(df, gen_loads, fcas):
     return df
 
 
+def prepare_mapping_versions(versions, on='ELEMENTNUMBER'):
+    '''
+    Prepares a time-versioned element mapping, such as
+    data/external/emsname_duid_versions.csv, for merge_versioned_mappings.
+    Each row maps a key (an element number or EMSNAME) to a DUID over the
+    interval [VALID_FROM, VALID_TO). Blank bounds are open ended
+    Args:
+        versions (pandas DataFrame): mapping with cols on, 'VALID_FROM' &
+                                     'VALID_TO'
+        on (str, optional): key col of the mapping
+    Returns:
+        DataFrame with parsed bounds, sorted on VALID_FROM
+    Raises:
+        ValueError if a key has overlapping validity intervals
+    '''
+    versions = versions.copy()
+    versions['VALID_FROM'] = _pd.to_datetime(
+        versions['VALID_FROM']).fillna(_pd.Timestamp.min)
+    versions['VALID_TO'] = _pd.to_datetime(
+        versions['VALID_TO']).fillna(_pd.Timestamp.max)
+    if 'ELEMENTNUMBER' in versions:
+        versions['ELEMENTNUMBER'] = versions['ELEMENTNUMBER'].astype(
+            _np.int64)
+    versions = versions.sort_values([on, 'VALID_FROM'])
+    same_key = versions[on].values[1:] == versions[on].values[:-1]
+    overlaps = (versions['VALID_FROM'].values[1:]
+                < versions['VALID_TO'].values[:-1])
+    if (same_key & overlaps).any():
+        clashes = versions[on].values[1:][same_key & overlaps]
+        raise ValueError((f'Overlapping validity intervals for {on} '
+                          + f'{sorted(set(clashes))}'))
+    return versions.sort_values('VALID_FROM', kind='mergesort')
+
+
+@_memoized()
+def merge_versioned_mappings(df, versions, time_col='datetime',
+                             left_on='elementnumber',
+                             right_on='ELEMENTNUMBER'):
+    '''
+    Provided a DataFrame containing Causer Pays 4s data, attaches the
+    element mapping that was valid at each row's timestamp. Each row is
+    resolved with a vectorised as-of lookup: versions sorted on (key,
+    VALID_FROM) are binary searched for the last version starting at or
+    before the row's timestamp, and rows at or after that version's
+    VALID_TO are left unmapped
+    Args:
+        df (pandas DataFrame): Causer Pays data with cols left_on &
+                               time_col
+        versions (''): time-versioned mapping, see prepare_mapping_versions
+        time_col (str, optional): timestamp column of df
+        left_on (str, optional): key col of df
+        right_on (str, optional): key col of versions
+    Returns:
+        DataFrame in the order of df with mapping columns (e.g. 'EMSNAME',
+        'DUID') attached
+    '''
+    # open bounds of versions read with parse_dates are NaT, so bounds
+    # are always filled and checked
+    versions = prepare_mapping_versions(versions, on=right_on)
+    versions = versions.sort_values([right_on, 'VALID_FROM'])
+    map_cols = [c for c in versions.columns
+                if c not in (right_on, 'VALID_FROM', 'VALID_TO')]
+
+    v_from = versions['VALID_FROM'].values
+    keys_index = _pd.Index(versions[right_on].unique())
+    v_codes = keys_index.get_indexer(versions[right_on])
+    # rank timestamps against the few distinct VALID_FROM bounds so that
+    # (key, time) packs into a single sortable int64 key. Versions are
+    # sorted on key, so their codes are ascending
+    bounds = _np.unique(v_from)
+    width = len(bounds) + 1
+    v_keys = v_codes * width + _np.searchsorted(bounds, v_from, side='right')
+
+    codes = keys_index.get_indexer(df[left_on])
+    times = _pd.to_datetime(df[time_col]).values
+    keys = codes.clip(0) * width + _np.searchsorted(bounds, times,
+                                                    side='right')
+    pos = _np.searchsorted(v_keys, keys, side='right') - 1
+    pos_ok = pos.clip(0)
+    found = ((codes >= 0) & (pos >= 0) & (v_codes[pos_ok] == codes)
+             & (times < versions['VALID_TO'].values[pos_ok]))
+
+    df = df.copy()
+    for col in map_cols:
+        values = versions[col].values[pos_ok]
+        if not found.all():
+            values = _pd.Series(values).where(found).values
+        df[col] = values
+    return df
+
+
+@_instrumented()
+@_memoized()
 def merge_causpays_mappings(df, elements, variables,
-                            ems_duid=None, gen_loads=None):
+                            ems_duid=None, gen_loads=None,
+                            ems_duid_versions=None):
     '''
     Provided a DataFrame containing Causer Pays 4s data,
     returns a DataFrame with element and variable
@@ -45,7 +147,11 @@ def merge_causpays_mappings(df, elements, variables,
         ems_duid ('', optional): mapping between EMSNAME and DUID as a df
         gen_loads ('', optional): Generators and Scheduled loads
                                   (DUID identifiers). If this is supplied,
-                                  provide ems_duid
+                                  provide ems_duid or ems_duid_versions
+        ems_duid_versions ('', optional): time-versioned mapping between
+                                          EMSNAME and DUID, used instead
+                                          of ems_duid. df must then have a
+                                          'datetime' col
     Retuns:
         DataFrame with element and variable identifiers
     '''
@@ -56,12 +162,44 @@ def merge_causpays_mappings(df, elements, variables,
                    left_on='variablenumber', right_on='VARIABLENUMBER')
     # map ems to duid and gen+load info if DataFrames provided
 
-    if ems_duid is not None:
+    if ems_duid_versions is not None:
+        # keyed on EMSNAME like ems_duid, so open ended versions give
+        # the same result
+        df = df.drop('ELEMENTNUMBER', axis=1)
+        df = merge_versioned_mappings(df, ems_duid_versions,
+                                      left_on='EMSNAME', right_on='EMSNAME')
+    elif ems_duid is not None:
         df = df.drop('ELEMENTNUMBER', axis=1)
         df = _pd.merge(left=df, right=ems_duid, how='left',
                        on='EMSNAME')
     if gen_loads is not None:
+        if ems_duid_versions is not None:
+            # versioned cols, e.g. a Region, take precedence over today's
+            gen_loads = gen_loads.drop(columns=[
+                c for c in gen_loads.columns if c != 'DUID' and c in df])
         df = _pd.merge(left=df, right=gen_loads, how='left',
                        on='DUID')
 
     return df
+
+
+def map_elements_to_areas(ems_duid_region, region_map=None):
+    '''
+    Provided the EMSNAME-DUID-Region mapping, returns a Series mapping
+    each Causer Pays element number to its Area (Mainland or Tasmania).
+    Elements without a region are dropped
+    Args:
+        ems_duid_region (pandas DataFrame): mapping with cols
+                                            'ELEMENTNUMBER' & 'Region'
+        region_map (dict, optional): Region to Area mapping. Defaults to
+                                     area_region_map
+    Returns:
+        Series of Areas indexed by element number
+    '''
+    if region_map is None:
+        region_map = area_region_map
+    mapping = ems_duid_region.dropna(subset=['Region'])
+    mapping = mapping.drop_duplicates('ELEMENTNUMBER')
+    areas = mapping['Region'].replace(region_map)
+    areas.index = mapping['ELEMENTNUMBER'].values
+    return areas
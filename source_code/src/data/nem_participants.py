@@ -3,10 +3,14 @@ import pandas as _pd
 
 from nemosis import data_fetch_methods as _data_fetch_methods
 
+from src.data.instrumentation import instrumented as _instrumented
+from src.data.memoize import memoized as _memoized
+
 _dummy_start = '2018/01/01 00:00:00'
 _dummy_end = '2018/12/31 23:59:59'
 
 
+@_instrumented()
 def fetch_gen_scheduled_loads(raw_loc, table_loc, dummy_start, dummy_end):
     '''
     Fetches the Registration and Exemptions xlsx and returns the Generators
@@ -32,6 +36,7 @@ def fetch_gen_scheduled_loads(raw_loc, table_loc, dummy_start, dummy_end):
     return df
 
 
+@_instrumented()
 def fetch_ancillary_service_providers(reg_exemps_xlsx_loc, table_loc=None):
     '''
     Looks at the Ancillary Services tab of the Registration and Exemptions xlsx
@@ -59,6 +64,8 @@ def fetch_ancillary_service_providers(reg_exemps_xlsx_loc, table_loc=None):
     return df
 
 
+@_instrumented()
+@_memoized(bypass=('table_loc',))
 def clean_gen_loads_tech(gen_loads_path=None, df=None, table_loc=None,
                          outname='generators_and_loads.csv'):
     '''
@@ -93,6 +100,9 @@ def clean_gen_loads_tech(gen_loads_path=None, df=None, table_loc=None,
     if gen_loads_path:
         df = _pd.read_csv(_os.path.join(gen_loads_path,
                           'generators_and_loads.csv'))
+    else:
+        # leave the caller's frame unchanged, as memoized hits do
+        df = df.copy()
     df['Technology Type - Descriptor'] =\
         df['Technology Type - Descriptor'].apply(replace)
 
@@ -103,6 +113,8 @@ def clean_gen_loads_tech(gen_loads_path=None, df=None, table_loc=None,
     return df
 
 
+@_instrumented()
+@_memoized(bypass=('table_loc',))
 def clean_gen_loads_capacities(gen_loads_path=None, df=None, table_loc=None,
                                outname='generators_and_loads.csv'):
     '''
@@ -123,6 +135,9 @@ def clean_gen_loads_capacities(gen_loads_path=None, df=None, table_loc=None,
     if gen_loads_path:
         df = _pd.read_csv(_os.path.join(gen_loads_path,
                           'generators_and_loads.csv'))
+    else:
+        # leave the caller's frame unchanged, as memoized hits do
+        df = df.copy()
     df['Reg Cap (MW)'] = df['Reg Cap (MW)'].str.replace('-', '0')
     df['Reg Cap (MW)'] = df['Reg Cap (MW)'].astype('float64')
 
@@ -132,6 +147,8 @@ def clean_gen_loads_capacities(gen_loads_path=None, df=None, table_loc=None,
     return df
 
 
+@_instrumented()
+@_memoized(bypass=('table_loc',))
 def find_unique_fcas_providers(gen_loads_path, ancillary_services_path,
                                table_loc=None):
     '''
@@ -0,0 +1,162 @@
+import json as _json
+import logging as _logging
+import os as _os
+import time as _time
+
+import numpy as _np
+import pandas as _pd
+import pyarrow.parquet as _pq
+
+profile_name = 'storage_profile.json'
+
+_dict_cols = ['elementnumber', 'variablenumber', 'valuequality']
+_encodings = {'datetime': 'DELTA_BINARY_PACKED',
+              'fcas_value': 'BYTE_STREAM_SPLIT'}
+
+# to_parquet (pyarrow engine) kwargs for each candidate profile
+profiles = {
+    'snappy': {'compression': 'snappy'},
+    'zstd1': {'compression': 'zstd', 'compression_level': 1},
+    'zstd3_dict': {'compression': 'zstd', 'compression_level': 3,
+                   'use_dictionary': _dict_cols},
+    'zstd9_dict': {'compression': 'zstd', 'compression_level': 9,
+                   'use_dictionary': _dict_cols},
+    'zstd3_encoded': {'compression': 'zstd', 'compression_level': 3,
+                      'use_dictionary': _dict_cols,
+                      'column_encoding': _encodings},
+    'zstd3_encoded_small_groups': {'compression': 'zstd',
+                                   'compression_level': 3,
+                                   'use_dictionary': _dict_cols,
+                                   'column_encoding': _encodings,
+                                   'row_group_size': 250000},
+    'lz4_encoded': {'compression': 'lz4', 'use_dictionary': _dict_cols,
+                    'column_encoding': _encodings}
+}
+
+
+def _timed(func):
+    start = _time.perf_counter()
+    result = func()
+    return _time.perf_counter() - start, result
+
+
+def measure_profile(df, path, kwargs, filter_elements):
+    '''
+    Writes df under a profile and measures size and read throughput
+
+    Args:
+        df (pandas DataFrame): Causer Pays data indexed on datetime
+        path (str or path): parquet file to write
+        kwargs (dict): to_parquet kwargs of the profile
+        filter_elements (list): elements used for the filtered read
+
+    Returns:
+        dict of file size, write time and read/filter throughputs (rows/s)
+    '''
+    write_s, _ = _timed(lambda: df.to_parquet(path, engine='pyarrow',
+                                              **kwargs))
+    read_s, _ = _timed(lambda: _pq.read_table(path).to_pandas())
+    mid = df.index[len(df) // 2]
+    window = [('elementnumber', 'in', list(filter_elements)),
+              ('datetime', '>=', mid), ('datetime', '<=', df.index[-1])]
+    filter_s, _ = _timed(lambda: _pq.read_table(
+        path, filters=window).to_pandas())
+    return {'bytes': _os.path.getsize(path), 'write_s': write_s,
+            'read_rows_per_s': len(df) / read_s,
+            'filter_rows_per_s': len(df) / filter_s}
+
+
+def tune_profile(df, workdir, candidates=None, weights=(1.0, 1.0, 1.0),
+                 n_filter_elements=5):
+    '''
+    Writes a sample of Causer Pays data under candidate storage profiles
+    and ranks them on file size, full read and filtered read throughput.
+    Profiles the installed pyarrow does not support are skipped
+
+    Args:
+        df (pandas DataFrame): sample data, indexed on sorted datetime
+        workdir (str or path): directory for candidate files
+        candidates (dict, optional): name to to_parquet kwargs. Defaults to
+                                     profiles
+        weights (tuple, optional): weights of (size, read, filtered read)
+                                   in the score
+        n_filter_elements (int, optional): elements used in filtered reads
+
+    Returns:
+        Tuple of (winning profile name, DataFrame of measurements by
+        profile sorted on score, lower is better)
+    '''
+    if candidates is None:
+        candidates = profiles
+    rng = _np.random.RandomState(0)
+    elements = _np.unique(df['elementnumber'])
+    filter_elements = rng.choice(elements, min(n_filter_elements,
+                                               len(elements)),
+                                 replace=False).tolist()
+    results = {}
+    for name, kwargs in candidates.items():
+        path = _os.path.join(workdir, f'profile_{name}.parquet')
+        try:
+            results[name] = measure_profile(df, path, kwargs,
+                                            filter_elements)
+        except (TypeError, ValueError, NotImplementedError, OSError) as e:
+            _logging.warning(f'Skipping storage profile {name}: {e}')
+        finally:
+            if _os.path.exists(path):
+                _os.remove(path)
+    if not results:
+        raise ValueError('No storage profile could be written')
+
+    results = _pd.DataFrame.from_dict(results, orient='index')
+    size_w, read_w, filter_w = weights
+    # each metric relative to the best candidate
+    results['score'] = (
+        size_w * results['bytes'] / results['bytes'].min()
+        + read_w * results['read_rows_per_s'].max()
+        / results['read_rows_per_s']
+        + filter_w * results['filter_rows_per_s'].max()
+        / results['filter_rows_per_s'])
+    results = results.sort_values('score')
+    return results.index[0], results
+
+
+def save_profile(path, name, kwargs, results=None):
+    '''
+    Records a storage profile in path, where pathfiles_to_chunks will apply
+    it to subsequent chunk writes
+
+    Args:
+        path (str or path): chunk directory
+        name (str): profile name
+        kwargs (dict): to_parquet kwargs
+        results (pandas DataFrame, optional): tune_profile measurements
+
+    Returns:
+        Path of the profile file
+    '''
+    record = {'name': name, 'kwargs': kwargs}
+    if results is not None:
+        record['measurements'] = results.to_dict(orient='index')
+    profile_path = _os.path.join(path, profile_name)
+    with open(profile_path, 'w') as f:
+        _json.dump(record, f, indent=2)
+    return profile_path
+
+
+def load_profile(path):
+    '''
+    Reads the storage profile recorded in path
+
+    Args:
+        path (str or path): chunk directory
+
+    Returns:
+        Tuple of (profile name, to_parquet kwargs), or (None, {}) if no
+        profile has been recorded
+    '''
+    profile_path = _os.path.join(path, profile_name)
+    if not _os.path.exists(profile_path):
+        return None, {}
+    with open(profile_path) as f:
+        record = _json.load(f)
+    return record['name'], record['kwargs']
@@ -0,0 +1,191 @@
+import hashlib as _hashlib
+import json as _json
+import logging as _logging
+import os as _os
+import re as _re
+import shutil as _shutil
+import tempfile as _tempfile
+
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+from urllib.error import HTTPError as _HTTPError
+from urllib.parse import urljoin as _urljoin
+from urllib.request import Request as _Request
+from urllib.request import urlopen as _urlopen
+
+import pandas as _pd
+
+from nemosis import data_fetch_methods as _data_fetch_methods
+from nemosis import defaults as _defaults
+
+default_cache_dir = _os.path.join(_os.path.expanduser('~'), '.cache',
+                                  'nem-data-analysis', 'downloads')
+# AEMO rejects requests without a browser user agent
+_headers = {'User-Agent': ('Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
+                           + ' AppleWebKit/537.36 (KHTML, like Gecko)')}
+
+
+class DownloadCache:
+    '''
+    Persistent download cache. Each URL is stored with its ETag and
+    Last-Modified headers, which are sent back on the next fetch so the
+    server can reply 304 Not Modified instead of resending the file.
+    Safe to use from several threads for different URLs
+
+    Args:
+        cache_dir (str or path, optional): cache directory. Defaults to
+                                           ~/.cache/nem-data-analysis/downloads
+        timeout (float, optional): request timeout in seconds
+    '''
+
+    def __init__(self, cache_dir=default_cache_dir, timeout=60):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        _os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, url):
+        key = _hashlib.sha1(url.encode()).hexdigest()
+        return (_os.path.join(self.cache_dir, key),
+                _os.path.join(self.cache_dir, key + '.json'))
+
+    def _read_meta(self, meta_path):
+        if not _os.path.exists(meta_path):
+            return {}
+        with open(meta_path) as f:
+            return _json.load(f)
+
+    def _write_atomic(self, path, write):
+        fd, tmp_path = _tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with _os.fdopen(fd, 'wb') as f:
+                write(f)
+            _os.replace(tmp_path, path)
+        except BaseException:
+            _os.remove(tmp_path)
+            raise
+
+    def fetch(self, url):
+        '''
+        Returns a local copy of url, revalidating a cached copy with the
+        server rather than downloading it again
+
+        Args:
+            url (str): URL to fetch
+
+        Returns:
+            Tuple of (local path, True if the file was (re)downloaded)
+        '''
+        data_path, meta_path = self._paths(url)
+        meta = self._read_meta(meta_path)
+        headers = dict(_headers)
+        if _os.path.exists(data_path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            response = _urlopen(_Request(url, headers=headers),
+                                timeout=self.timeout)
+        except _HTTPError as e:
+            if e.code == 304:
+                _logging.info(f'Not modified: {url}')
+                return data_path, False
+            raise
+        with response:
+            self._write_atomic(data_path,
+                               lambda f: _shutil.copyfileobj(response, f))
+            meta = {'url': url, 'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified')}
+        self._write_atomic(meta_path,
+                           lambda f: f.write(_json.dumps(meta).encode()))
+        _logging.info(f'Downloaded {url}')
+        return data_path, True
+
+
+def _latest_listing_link(listing_path, url):
+    '''
+    Last file linked from a NEMWeb directory listing, as NEMOSIS uses for
+    the FCAS elements file
+    '''
+    with open(listing_path, errors='replace') as f:
+        links = _re.findall(r'href="([^"]+)"', f.read(), flags=_re.I)
+    links = [link for link in links if not link.endswith('/')]
+    if not links:
+        raise ValueError(f'No files listed at {url}')
+    return _urljoin(url, links[-1])
+
+
+def fetch_static_table(table, cache, url=None):
+    '''
+    Fetches the raw file of a NEMOSIS static table through cache. URLs
+    ending in '/' are treated as directory listings and the latest file
+    listed is fetched
+
+    Args:
+        table (str): NEMOSIS static table name
+        cache (DownloadCache): download cache
+        url (str, optional): overrides nemosis.defaults.static_table_url
+
+    Returns:
+        Tuple of (local path, True if the file changed)
+    '''
+    url = url or _defaults.static_table_url[table]
+    if url.endswith('/'):
+        listing_path, _ = cache.fetch(url)
+        url = _latest_listing_link(listing_path, url)
+    return cache.fetch(url)
+
+
+def fetch_static_tables(tables, cache, urls=None, max_workers=4):
+    '''
+    Fetches independent static tables concurrently
+
+    Args:
+        tables (list): NEMOSIS static table names
+        cache (DownloadCache): download cache
+        urls (dict, optional): table to URL overrides, e.g. to point at a
+                               local HTTP server
+        max_workers (int, optional): concurrent downloads
+
+    Returns:
+        dict of table to (local path, changed)
+    '''
+    urls = urls or {}
+    with _ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {table: executor.submit(fetch_static_table, table, cache,
+                                          urls.get(table))
+                   for table in tables}
+        return {table: future.result() for table, future in futures.items()}
+
+
+def read_static_table(table, path):
+    '''
+    Reads a fetched static table file through NEMOSIS's own static_table,
+    so column selection, stripping, de-duplication and fill values match
+    a NEMOSIS download exactly
+
+    Args:
+        table (str): NEMOSIS static table name
+        path (str or path): local file from fetch_static_table
+
+    Returns:
+        pandas DataFrame
+    '''
+    with _tempfile.TemporaryDirectory() as raw_dir:
+        # static_table reads an existing file under its NEMOSIS name
+        # rather than downloading it
+        _shutil.copyfile(path, _os.path.join(raw_dir,
+                                             _defaults.names[table]))
+        return _data_fetch_methods.static_table(table, raw_dir)
+
+
+def materialise(path, dest, changed):
+    '''
+    Copies a cached file to dest if it changed or dest does not exist
+
+    Returns:
+        True if dest was written
+    '''
+    if changed or not _os.path.exists(dest):
+        _shutil.copyfile(path, dest)
+        return True
+    return False
@@ -0,0 +1,384 @@
+import argparse
+import hashlib
+import importlib
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+manifest_name = '.render_manifest.json'
+_data_cache = OrderedDict()
+_data_cache_size = 4
+
+
+def arg_parser():
+    description = ("Render report figures from a JSON list of figure specs"
+                   + " in parallel, skipping figures whose inputs are"
+                   + " unchanged")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-specs', type=str, required=True,
+                        help=('JSON file of figure specs. Data paths are'
+                              + ' relative to this file'))
+    parser.add_argument('-out', type=str, required=True,
+                        help='directory to save figures, e.g. reports/figures')
+    parser.add_argument('-workers', type=int, default=None,
+                        help='worker processes. Defaults to CPU count')
+    parser.add_argument('-style', type=str, default=None,
+                        help=('matplotlib style file, e.g.'
+                              + ' matplotlibrc.mplstyle'))
+    parser.add_argument('-force', action='store_true',
+                        help='render all figures')
+    args = parser.parse_args()
+    return args
+
+
+def _format(obj, params):
+    '''
+    Substitutes {param} placeholders in every string of a spec. Other
+    braces, e.g. mathtext such as '$f_{ref}$', are left as is
+    '''
+    if isinstance(obj, str):
+        if not params or '{' not in obj:
+            return obj
+        names = '|'.join(re.escape(p) for p in params)
+        return re.sub(r'\{(' + names + r')\}',
+                      lambda m: str(params[m.group(1)]), obj)
+    if isinstance(obj, list):
+        return [_format(o, params) for o in obj]
+    if isinstance(obj, dict):
+        return {k: _format(v, params) for k, v in obj.items()}
+    return obj
+
+
+def expand_specs(specs):
+    '''
+    Expands specs with an 'expand' mapping of parameter to values into one
+    spec per combination of values, e.g. per region, month and service
+
+    Args:
+        specs (list): figure specs
+
+    Returns:
+        list of specs without 'expand'
+    '''
+    expanded = []
+    for spec in specs:
+        spec = dict(spec)
+        grid = spec.pop('expand', None)
+        if not grid:
+            expanded.append(spec)
+            continue
+        names = sorted(grid)
+        for values in itertools.product(*(grid[n] for n in names)):
+            expanded.append(_format(spec, dict(zip(names, values))))
+    return expanded
+
+
+def _resolve_paths(spec, base_dir):
+    spec = dict(spec)
+    spec['data'] = {
+        name: dict(source, path=os.path.abspath(
+            os.path.join(base_dir, source['path'])))
+        for name, source in spec.get('data', {}).items()}
+    return spec
+
+
+def _import(dotted):
+    '''
+    Imports a dotted path to a function, class or method, e.g.
+    'pandas.DataFrame.melt'
+    '''
+    parts = dotted.split('.')
+    for i in range(len(parts) - 1, 0, -1):
+        try:
+            obj = importlib.import_module('.'.join(parts[:i]))
+        except ImportError:
+            continue
+        for attr in parts[i:]:
+            obj = getattr(obj, attr)
+        return obj
+    raise ImportError(f'Cannot import {dotted}')
+
+
+def _calls(obj):
+    '''
+    Dotted paths of all calls in a spec
+    '''
+    if isinstance(obj, dict):
+        found = [obj['call']] if 'call' in obj else []
+        for v in obj.values():
+            found.extend(_calls(v))
+        return found
+    if isinstance(obj, list):
+        return [c for o in obj for c in _calls(o)]
+    return []
+
+
+def _source_digest(dotted):
+    '''
+    Digest of the source file of a project function, so figures are
+    re-rendered when plotting code changes
+    '''
+    if not dotted.startswith('src.'):
+        return None
+    module = sys.modules.get(getattr(_import(dotted), '__module__', None))
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def fingerprint(spec):
+    '''
+    Hashes a spec together with the size and modification time of its data
+    files and the source of the project functions it calls
+
+    Returns:
+        str digest
+    '''
+    inputs = {}
+    for name, source in sorted(spec.get('data', {}).items()):
+        stat = os.stat(source['path'])
+        inputs[name] = (stat.st_size, stat.st_mtime_ns)
+    code = {c: _source_digest(c) for c in sorted(set(_calls(spec)))}
+    blob = json.dumps([spec, inputs, code], sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest()
+
+
+def read_manifest(out_dir):
+    path = os.path.join(out_dir, manifest_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, manifest_name)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _init_worker(style=None):
+    '''
+    Pool initializer. Selects the headless Agg backend before pyplot is
+    imported by any plotting module
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    if style is not None:
+        import matplotlib.pyplot as plt
+        plt.style.use(style)
+
+
+def _load(source):
+    '''
+    Reads a data source through the worker's cache, so figures rendered by
+    the same worker from the same file only read it once
+    '''
+    stat = os.stat(source['path'])
+    read_kwargs = source.get('read_kwargs', {})
+    key = json.dumps([source['path'], stat.st_size, stat.st_mtime_ns,
+                      read_kwargs, source.get('parse_dates', [])],
+                     sort_keys=True)
+    if key in _data_cache:
+        _data_cache.move_to_end(key)
+        df = _data_cache[key]
+    else:
+        if source['path'].endswith('.parquet'):
+            df = pd.read_parquet(source['path'], **read_kwargs)
+        else:
+            df = pd.read_csv(source['path'], **read_kwargs)
+        for col in source.get('parse_dates', []):
+            df[col] = pd.to_datetime(df[col])
+        _data_cache[key] = df
+        if len(_data_cache) > _data_cache_size:
+            _data_cache.popitem(last=False)
+    if 'query' in source:
+        return df.query(source['query'])
+    # steps may modify their data, which must not reach later figures
+    return df.copy()
+
+
+def _resolve(obj, context):
+    '''
+    Resolves {'ref': name} references to data or axes ('ax', 'fig'),
+    {'ref': 'ax', 'index': i} to one of several axes and {'call': dotted
+    path, 'args': [...], 'kwargs': {...}} to the result of the call. Other
+    strings, e.g. mathtext labels such as '$\\Delta f$', are left as is
+    '''
+    if isinstance(obj, list):
+        return [_resolve(o, context) for o in obj]
+    if isinstance(obj, dict):
+        if 'ref' in obj:
+            value = context[obj['ref']]
+            if 'index' in obj:
+                idx = obj['index']
+                value = value.flat[idx] if hasattr(value, 'flat') \
+                    else value[idx]
+            return value
+        if 'call' in obj:
+            func = _import(obj['call'])
+            return func(*_resolve(obj.get('args', []), context),
+                        **_resolve(obj.get('kwargs', {}), context))
+        return {k: _resolve(v, context) for k, v in obj.items()}
+    return obj
+
+
+def render_figure(task):
+    '''
+    Worker kernel. Loads a spec's data, creates the figure, runs its steps
+    and saves it
+
+    Args:
+        task (tuple): (spec, output path)
+
+    Returns:
+        Tuple of (output path, error message or None)
+    '''
+    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
+    spec, out_path = task
+    fig = None
+    try:
+        context = {name: _load(source)
+                   for name, source in spec.get('data', {}).items()}
+        if 'subplots' in spec:
+            fig, ax = plt.subplots(**spec['subplots'])
+            context.update(fig=fig, ax=ax)
+        for step in spec['steps']:
+            result = _resolve(step, context)
+            # functions such as stacked_bar_subplots create the figure
+            if (fig is None and isinstance(result, tuple)
+                    and isinstance(result[0], Figure)):
+                fig, ax = result[0], result[1]
+                context.update(fig=fig, ax=ax)
+        if fig is None:
+            raise ValueError('Spec has no subplots and no step returned a'
+                             + ' figure')
+        if 'title' in spec:
+            fig.suptitle(spec['title'])
+        if spec.get('tight_layout', False):
+            fig.tight_layout()
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        fig.savefig(out_path, **spec.get('savefig', {}))
+        return out_path, None
+    except Exception as e:
+        return out_path, f'{type(e).__name__}: {e}'
+    finally:
+        if fig is not None:
+            plt.close(fig)
+
+
+def render_figures(specs, out_dir, base_dir='.', workers=None, style=None,
+                   force=False):
+    '''
+    Renders figure specs in a process pool using the Agg backend. Specs
+    are ordered by their data inputs and handed to workers in batches, so
+    figures sharing inputs are usually rendered by a worker that already
+    has the data loaded. Figures whose spec, data files and plotting code
+    are unchanged since the last render are skipped.
+
+    A spec is a dict with:
+        output: figure path relative to out_dir, e.g.
+                'regulation_march_2020/fi_{region}.png'
+        data (optional): name to {'path', 'read_kwargs', 'parse_dates',
+                         'query'}. Referenced in steps as {'ref': name}
+        subplots (optional): plt.subplots kwargs. The axes are
+                             {'ref': 'ax'} or {'ref': 'ax', 'index': i}
+                             and the figure {'ref': 'fig'}. Omit if a step
+                             returns (fig, ax)
+        steps: list of {'call': dotted path, 'args', 'kwargs'}, e.g.
+               'src.visualization.generic_plots.plot_value_by_element'
+        expand (optional): parameter to list of values. One figure is
+                           rendered per combination, with {parameter}
+                           substituted in strings
+        title, savefig, tight_layout (optional)
+
+    Args:
+        specs (list): figure specs
+        out_dir (str or path): directory to save figures
+        base_dir (str or path, optional): directory data paths are relative to
+        workers (int, optional): processes to use. Defaults to CPU count.
+                                 1 renders in this process, switching it
+                                 to the Agg backend
+        style (str, optional): matplotlib style file
+        force (bool, optional): render all figures
+
+    Returns:
+        dict with lists of 'rendered', 'skipped' and 'failed' outputs
+    '''
+    specs = [_resolve_paths(s, base_dir) for s in expand_specs(specs)]
+    manifest = read_manifest(out_dir)
+    summary = {'rendered': [], 'skipped': [], 'failed': []}
+    tasks, digests = [], {}
+    for spec in specs:
+        out_path = os.path.join(out_dir, spec['output'])
+        digest = fingerprint(spec)
+        if (not force and manifest.get(spec['output']) == digest
+                and os.path.exists(out_path)):
+            summary['skipped'].append(spec['output'])
+            continue
+        digests[out_path] = (spec['output'], digest)
+        tasks.append((spec, out_path))
+    tasks.sort(key=lambda t: sorted(s['path']
+                                    for s in t[0].get('data', {}).values()))
+    logging.info(f'Rendering {len(tasks)} figures,'
+                 + f' {len(summary["skipped"])} unchanged')
+
+    if workers == 1:
+        _init_worker(style)
+        results = [render_figure(task) for task in tasks]
+    else:
+        workers = workers or os.cpu_count()
+        chunksize = max(1, len(tasks) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(style,)) as executor:
+            results = list(executor.map(render_figure, tasks,
+                                        chunksize=chunksize))
+
+    for out_path, error in results:
+        output, digest = digests[out_path]
+        if error is None:
+            manifest[output] = digest
+            summary['rendered'].append(output)
+        else:
+            manifest.pop(output, None)
+            summary['failed'].append(output)
+            logging.error(f'{output}: {error}')
+    os.makedirs(out_dir, exist_ok=True)
+    write_manifest(out_dir, manifest)
+    return summary
+
+
+def main():
+    logging.basicConfig(format='\n%(levelname)s:%(message)s',
+                        level=logging.INFO)
+    args = arg_parser()
+    with open(args.specs) as f:
+        specs = json.load(f)
+    summary = render_figures(specs, args.out,
+                             base_dir=os.path.dirname(
+                                 os.path.abspath(args.specs)),
+                             workers=args.workers, style=args.style,
+                             force=args.force)
+    logging.info(f'{len(summary["rendered"])} rendered,'
+                 + f' {len(summary["skipped"])} skipped,'
+                 + f' {len(summary["failed"])} failed')
+    if summary['failed']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
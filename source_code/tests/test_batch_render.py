@@ -0,0 +1,21 @@
+import pandas as pd
+
+from src.visualization import batch_render
+
+
+def test_expand_leaves_mathtext_braces():
+    specs = [{'output': 'fi_{region}.png',
+              'title': r'$\Delta f_{x}$ and $f_{ref}$ in {region}',
+              'expand': {'region': ['NSW1', 'VIC1']}}]
+    expanded = batch_render.expand_specs(specs)
+    assert [s['output'] for s in expanded] == ['fi_NSW1.png', 'fi_VIC1.png']
+    assert expanded[0]['title'] == r'$\Delta f_{x}$ and $f_{ref}$ in NSW1'
+
+
+def test_loaded_data_is_not_shared_between_figures(tmp_path):
+    path = tmp_path / 'data.csv'
+    pd.DataFrame({'x': [1, 2, 3]}).to_csv(path, index=False)
+    source = {'path': str(path)}
+    first = batch_render._load(source)
+    first['x'] = 0
+    assert batch_render._load(source)['x'].tolist() == [1, 2, 3]
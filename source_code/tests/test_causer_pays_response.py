@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+from src.data import causer_pays_response
+
+
+def _write_store(path, starts, n=3000):
+    rng = np.random.default_rng(0)
+    for i, start in enumerate(starts):
+        times = pd.date_range(start, periods=n, freq='4S') \
+            + pd.Timedelta('2S')
+        freq = rng.normal(size=n)
+        frames = [pd.DataFrame({'elementnumber': 32003, 'variablenumber': 1,
+                                'fcas_value': freq}, index=times)]
+        for element in (1, 2):
+            frames.append(pd.DataFrame({
+                'elementnumber': element, 'variablenumber': 2,
+                'fcas_value': -element * freq + rng.normal(size=n)},
+                index=times))
+        df = pd.concat(frames).sort_index(kind='stable')
+        df.index.name = 'datetime'
+        df.to_parquet(path / f'chunk{i}.parquet', row_group_size=2000)
+
+
+def test_gap_between_row_groups_is_not_gridded(tmp_path, monkeypatch):
+    _write_store(tmp_path, ['2020-01-01', '2020-03-01'])
+    spans = []
+    update = causer_pays_response.ResponseAccumulator.update
+
+    def recording_update(self, times, *args, **kwargs):
+        if len(times):
+            spans.append(times.max() - times.min())
+        return update(self, times, *args, **kwargs)
+
+    monkeypatch.setattr(causer_pays_response.ResponseAccumulator, 'update',
+                        recording_update)
+    scores = causer_pays_response.score_frequency_response(tmp_path,
+                                                           min_samples=10)
+    assert max(spans) < np.timedelta64(1, 'D')
+    assert scores['samples'].tolist() == [6000, 6000]
+    assert np.allclose(scores['gain'], [-1, -2], atol=0.1)
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+from src.data import causer_pays_shards
+from src.data.causer_pays_chunkpression import chunk_paths
+from src.data.causer_pays_deviation import stream_batches
+
+elements = [1, 2, 3, 32003]
+
+
+def _write_files(path, n_files=4):
+    path.mkdir()
+    for i in range(n_files):
+        times = pd.date_range(pd.Timestamp('2020-03-01')
+                              + pd.Timedelta(hours=6 * i),
+                              periods=5400, freq='4S')
+        df = pd.DataFrame({
+            'TIMESTAMP': np.tile(times.strftime('%Y/%m/%d %H:%M:%S'),
+                                 len(elements)),
+            'ELEMENTNUMBER': np.repeat(elements, len(times)),
+            'VARIABLENUMBER': 2, 'VALUE': 1.0, 'VALUEQUALITY': 0})
+        df.to_csv(path / f'FCAS_20200301{6 * i:02d}00.csv', index=False)
+
+
+def test_month_is_a_time_ordered_chunk_store(tmp_path):
+    _write_files(tmp_path / 'in')
+    out = tmp_path / 'out'
+    db = str(tmp_path / 'jobs.db')
+    causer_pays_shards.plan(db, str(tmp_path / 'in'), 'csv', str(out),
+                            elements, n_shards=2, mem_limit=1)
+    assert causer_pays_shards.work(db, poll=0.1) == 3
+
+    paths = chunk_paths(out / '202003')
+    assert len(paths) > 1
+    times = np.concatenate([b[0] for b in stream_batches(out / '202003')])
+    assert len(times) == 4 * 5400 * len(elements)
+    assert (np.diff(times) >= np.timedelta64(0)).all()
+
+    rollups = pd.concat([pd.read_parquet(out / '202003' / f'rollup{i}.parquet')
+                         for i in range(2)])
+    assert rollups['count'].sum() == len(times)
+    assert set(rollups['elementnumber']) == set(elements)
+
+
+def test_replanned_month_does_not_resume_old_chunks(tmp_path, monkeypatch):
+    _write_files(tmp_path / 'in')
+    out = tmp_path / 'out'
+    db = str(tmp_path / 'jobs.db')
+    causer_pays_shards.plan(db, str(tmp_path / 'in'), 'csv', str(out),
+                            elements, n_shards=1, max_attempts=1,
+                            mem_limit=0.1)
+    read = causer_pays_shards.read_dataframes
+    calls = []
+
+    def failing_read(fformat, path):
+        calls.append(path)
+        if len(calls) == 3:
+            raise OSError('read failed')
+        return read(fformat, path)
+
+    monkeypatch.setattr(causer_pays_shards, 'read_dataframes', failing_read)
+    assert causer_pays_shards.work(db, poll=0.1) == 0
+    assert (out / '.202003.ingest' / 'chunk1.parquet').exists()
+
+    # removing the first file shifts the index of every other file
+    (tmp_path / 'in' / 'FCAS_202003010000.csv').unlink()
+    causer_pays_shards.plan(db, str(tmp_path / 'in'), 'csv', str(out),
+                            elements, n_shards=1, mem_limit=0.1)
+    monkeypatch.setattr(causer_pays_shards, 'read_dataframes', read)
+    assert causer_pays_shards.work(db, poll=0.1) == 2
+
+    df = pd.concat([pd.read_parquet(p) for p in chunk_paths(out / '202003')])
+    assert len(df) == 3 * 5400 * len(elements)
+    assert df.index.min() == pd.Timestamp('2020-03-01 06:00')
+    assert not df.reset_index().duplicated().any()
@@ -0,0 +1,28 @@
+import os
+
+import numpy as np
+import pytest
+
+from src.data import instrumentation
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/statm'),
+                    reason='needs /proc/self/statm')
+def test_stage_memory_is_not_the_process_peak():
+    instrumentation.enable()
+    try:
+        with instrumentation.stage('large'):
+            large = np.ones(25_000_000)
+            # sampled as the nested stage opens
+            with instrumentation.stage('fill'):
+                large[:] = 2
+            del large
+        with instrumentation.stage('small'):
+            np.ones(1000)
+        report = instrumentation.report()
+    finally:
+        instrumentation.disable()
+    large, small = report['stages']['large'], report['stages']['small']
+    assert large['rss_peak_mb'] >= small['rss_peak_mb'] + 150
+    assert report['process_peak_rss_mb'] >= small['rss_peak_mb'] + 150
+    assert 'peak_rss_mb' not in small
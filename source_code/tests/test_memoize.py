@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data import memoize
+from src.data import nem_participants
+
+raw_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                       'data', 'raw')
+
+
+@pytest.fixture
+def cache(tmp_path):
+    memoize.enable(str(tmp_path / 'memo'))
+    yield
+    memoize.disable()
+
+
+def _hit_and_miss(func, *args, **kwargs):
+    miss = func(*args, **kwargs)
+    hit = func(*args, **kwargs)
+    return miss, hit
+
+
+def _assert_identical(miss, hit):
+    pd.testing.assert_frame_equal(hit, miss)
+    assert list(hit.dtypes) == list(miss.dtypes)
+    assert memoize._null_kinds(hit) == memoize._null_kinds(miss)
+
+
+def test_gen_loads_hit_matches_miss_without_modifying_input(cache):
+    gen_loads = pd.read_csv(os.path.join(raw_dir, 'generators_and_loads.csv'))
+    original = gen_loads.copy()
+    for func in (nem_participants.clean_gen_loads_tech,
+                 nem_participants.clean_gen_loads_capacities):
+        miss, hit = _hit_and_miss(func, df=gen_loads)
+        _assert_identical(miss, hit)
+        pd.testing.assert_frame_equal(gen_loads, original)
+    stats = memoize.stats().set_index('function')
+    assert (stats['hits'] == 1).all() and (stats['misses'] == 1).all()
+
+
+def test_missing_values_survive_a_hit(cache):
+    @memoize.memoized(name='missing_values')
+    def missing_values(n):
+        return pd.DataFrame({'name': ['a', np.nan] * n,
+                             'other': ['b', None] * n,
+                             'value': [1.0, np.nan] * n})
+
+    miss, hit = _hit_and_miss(missing_values, 2)
+    _assert_identical(miss, hit)
+    assert memoize.stats()['hits'].tolist() == [1]
+
+
+def test_results_that_change_in_parquet_are_not_cached(cache):
+    @memoize.memoized(name='mixed_missing')
+    def mixed_missing():
+        return pd.DataFrame({'name': ['a', np.nan, None]})
+
+    miss, hit = _hit_and_miss(mixed_missing)
+    _assert_identical(miss, hit)
+    assert memoize.stats()['uncached'].tolist() == [2]
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.merge_mappings import merge_causpays_mappings
+from src.data.merge_mappings import merge_versioned_mappings
+
+data_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                        'data')
+
+
+def _read(*parts):
+    return pd.read_csv(os.path.join(data_dir, *parts))
+
+
+def test_open_ended_versions_reproduce_static_join():
+    elements = _read('raw', 'elements_causpays_mapping.csv')
+    variables = _read('raw', 'variables_causpays_mapping.csv')
+    gen_loads = _read('processed', 'cleaned_gen_loads.csv')
+    # 110-112 are missing from the elements file, 9999 from both
+    numbers = np.r_[elements['ELEMENTNUMBER'].unique(), 110, 111, 112, 9999]
+    df = pd.DataFrame({
+        'datetime': pd.date_range('2020-01-01', periods=len(numbers),
+                                  freq='4S'),
+        'elementnumber': numbers, 'variablenumber': 1, 'fcas_value': 1.0})
+    static = merge_causpays_mappings(
+        df, elements, variables,
+        ems_duid=_read('external', 'emsname_duid.csv'), gen_loads=gen_loads)
+    versioned = merge_causpays_mappings(
+        df, elements, variables,
+        ems_duid_versions=_read('external', 'emsname_duid_versions.csv'),
+        gen_loads=gen_loads)
+    pd.testing.assert_frame_equal(versioned[static.columns], static)
+
+
+@pytest.mark.parametrize('parse_dates', [False, True])
+def test_open_ended_version_maps_later_rows(parse_dates):
+    versions = pd.DataFrame({
+        'ELEMENTNUMBER': [1, 1], 'DUID': ['A', 'B'],
+        'VALID_FROM': ['2019-01-01', '2020-01-01'],
+        'VALID_TO': ['2020-01-01', None]})
+    if parse_dates:
+        for col in ('VALID_FROM', 'VALID_TO'):
+            versions[col] = pd.to_datetime(versions[col])
+    df = pd.DataFrame({'elementnumber': 1,
+                       'datetime': pd.to_datetime(['2018-06-01', '2019-06-01',
+                                                   '2020-06-01',
+                                                   '2021-06-01'])})
+    mapped = merge_versioned_mappings(df, versions)
+    assert mapped['DUID'].tolist()[1:] == ['A', 'B', 'B']
+    assert pd.isna(mapped['DUID'].iloc[0])
+
+
+def test_overlapping_parsed_versions_are_rejected():
+    versions = pd.DataFrame({
+        'ELEMENTNUMBER': [1, 1], 'DUID': ['A', 'B'],
+        'VALID_FROM': pd.to_datetime(['2019-01-01', '2019-06-01']),
+        'VALID_TO': pd.to_datetime(['2020-01-01', None])})
+    df = pd.DataFrame({'elementnumber': [1],
+                       'datetime': pd.to_datetime(['2019-03-01'])})
+    with pytest.raises(ValueError):
+        merge_versioned_mappings(df, versions)
@@ -0,0 +1,96 @@
+import functools
+import http.server
+import os
+import shutil
+import threading
+
+import pandas as pd
+import pytest
+
+from nemosis import data_fetch_methods
+from nemosis import defaults
+
+from src.data import static_fetch
+
+raw_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir,
+                       'data', 'raw')
+gen_loads = 'Generators and Scheduled Loads'
+elements = 'ELEMENTS_FCAS_4_SECOND'
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    '''
+    Local HTTP stand-in for NEMWeb serving a copy of the registration list
+    and a directory listing of elements files. SimpleHTTPRequestHandler
+    answers If-Modified-Since with 304
+    '''
+    site = tmp_path / 'site'
+    (site / 'elements').mkdir(parents=True)
+    shutil.copyfile(os.path.join(raw_dir, defaults.names[gen_loads]),
+                    site / 'registration.xls')
+    rows = ['1,SUBSTN.LYPA.GEN.A1GEN,GEN, *MMS MarketName*',
+            '2,SUBSTN.LYPA.GEN.A2GEN,GEN,*MMS MarketName*']
+    (site / 'elements' / 'Elements_FCAS_201901.csv').write_text(rows[0])
+    (site / 'elements' / 'Elements_FCAS_202001.csv').write_text(
+        '\n'.join(rows))
+    handler = functools.partial(_QuietHandler, directory=str(site))
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield site, f'http://127.0.0.1:{httpd.server_address[1]}/'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _nemosis_frame(table, path, tmp_path):
+    nemosis_dir = tmp_path / 'nemosis'
+    nemosis_dir.mkdir(exist_ok=True)
+    shutil.copyfile(path, nemosis_dir / defaults.names[table])
+    return data_fetch_methods.static_table(table, str(nemosis_dir))
+
+
+def test_excel_matches_nemosis(server, tmp_path):
+    site, url = server
+    cache = static_fetch.DownloadCache(str(tmp_path / 'cache'))
+    path, changed = static_fetch.fetch_static_table(
+        gen_loads, cache, url + 'registration.xls')
+    assert changed
+    df = static_fetch.read_static_table(gen_loads, path)
+    expected = _nemosis_frame(gen_loads, site / 'registration.xls', tmp_path)
+    pd.testing.assert_frame_equal(df, expected)
+    # '-' capacities must survive for clean_gen_loads_capacities
+    assert df['Reg Cap (MW)'].notna().all()
+    assert (df.dtypes == object).all()
+
+
+def test_unchanged_file_is_not_downloaded(server, tmp_path):
+    _, url = server
+    cache = static_fetch.DownloadCache(str(tmp_path / 'cache'))
+    first, changed = static_fetch.fetch_static_table(
+        gen_loads, cache, url + 'registration.xls')
+    assert changed
+    second, changed = static_fetch.fetch_static_table(
+        gen_loads, cache, url + 'registration.xls')
+    assert not changed
+    assert first == second
+
+
+def test_listing_fetches_latest_elements_file(server, tmp_path):
+    site, url = server
+    cache = static_fetch.DownloadCache(str(tmp_path / 'cache'))
+    fetched = static_fetch.fetch_static_tables(
+        [elements], cache, urls={elements: url + 'elements/'})
+    path, changed = fetched[elements]
+    assert changed
+    df = static_fetch.read_static_table(elements, path)
+    expected = _nemosis_frame(
+        elements, site / 'elements' / 'Elements_FCAS_202001.csv', tmp_path)
+    pd.testing.assert_frame_equal(df, expected)
+    assert len(df) == 2
+    assert df.loc[0, 'MMSDESCRIPTOR'] == '*MMS MarketName*'